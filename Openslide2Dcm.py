@@ -2,14 +2,25 @@ import gc
 import os
 import json
 import shutil
+import threading
+import collections
 import pydicom
 import numpy as np
 
 from PIL import Image
+from concurrent import futures
+from multiprocessing import cpu_count
 from PySide6.QtCore import Signal
 from utils.Singleton import Singleton
-from api.imgs2dcm import imgs2dcm
+from api.imgs2dcm import imgs2dcm, parse_tag_file
 from api.imgfile_info import imgfile_info
+from api.tile_record import tile_record
+from api.pyramid_level import pyramid_level
+from api.tiff_output import write_tiff_pyramid, TIFF_TILE_SIZE
+from api.zarr_output import zarr_pyramid
+from api.tile_size import choose_tile_size
+from api.roi import clip_roi, roi_origin
+from api.level_selection import select_levels
 
 # 讀取 config.json 檔案
 with open('config.json', 'r', encoding='utf-8') as config_file:
@@ -24,13 +35,92 @@ else:
     os.environ['PATH'] = OPENSLIDE_PATH + ";" + os.environ['PATH']
     from openslide import OpenSlide
 
+try:
+    # openslide-python >= 1.3 才有可共用的tile cache
+    from openslide import OpenSlideCache
+except ImportError:
+    OpenSlideCache = None
+
+
+class openslide_reader():
+    """
+    多執行緒讀取同一個slide: 每個thread使用自己的OpenSlide handle，
+    所有handle共用同一個OpenSlideCache，相鄰的讀取可以重複使用已解碼的來源tile。
+    openslide解碼時會釋放GIL，因此讀取可以平行進行。
+    """
+
+    def __init__(self, input_file, threads, cache_size) -> None:
+        self.input_file = input_file
+        self.threads = max(1, int(threads))
+        self.cache = OpenSlideCache(cache_size) if OpenSlideCache is not None and cache_size > 0 else None
+        self.local = threading.local()
+        self.handles = []
+        self.lock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.threads)
+        pass
+
+    def handle(self):
+        """
+        目前thread的OpenSlide handle，第一次使用時開啟
+        """
+        slide = getattr(self.local, "slide", None)
+        if slide is None:
+            slide = OpenSlide(self.input_file)
+            if self.cache is not None:
+                slide.set_cache(self.cache)
+            self.local.slide = slide
+            with self.lock:
+                self.handles.append(slide)
+        return slide
+
+    def read_region(self, location, level, size):
+        return self.handle().read_region(location, level, size)
+
+    def map(self, func, items):
+        """
+        在thread pool內執行func(item)，依照items的順序回傳結果。
+        同時最多 threads*2 個工作，避免讀出的圖塊全部堆在記憶體。
+        """
+        pending = collections.deque()
+        for item in items:
+            pending.append(self.executor.submit(func, item))
+            if len(pending) >= self.threads * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for slide in self.handles:
+            slide.close()
+        self.handles = []
+
+
 class Openslide2Dcm(Singleton):
     
     split_blocks = 100
     tileSize = 1024
+    # True: 每層依照原生tile大小自動選擇frame大小(偏好tileSize)；False: 固定使用tileSize
+    auto_tile_size = True
     tmp_folder = "./temp/"
+    # 轉換DICOM時是否同時輸出OME-Zarr ({output_folder}/{檔名}.zarr)
+    zarr_output = False
+    # 轉換完的每個DICOM instance交給sink(例如stow_sink)上傳，None為不上傳
+    dicom_sink = None
+    # 有提供tile_ring時frame由encoder process編碼
+    tile_ring = None
+    # 寫入TIFF/Zarr時壓縮用的thread數量，0為cpu_count()
+    write_threads = 0
+    # 平行讀取的thread數量(每個thread一個OpenSlide handle)以及共用的OpenSlideCache大小
+    read_threads = min(8, cpu_count())
+    cache_size = 256 * 1024 * 1024
+    # 只轉換這些區域 [(x0, y0, x1, y1)] (第0層像素)，每個ROI輸出到 {output_folder}/roi_{n}/，空list為整張slide
+    rois = []
+    # 要轉換的level (api.level_selection.parse_levels的結果)，"default"為level 1 ~ N-1
+    levels = "default"
 
     def convert(self, file_info:imgfile_info, tmp_folder):
+        slide, reader = None, None
         try:
             # Check if the file exists
             if not os.path.exists(file_info.input_file):
@@ -47,12 +137,19 @@ class Openslide2Dcm(Singleton):
             print(f"Processing file: {processing_file}")
 
             slide = OpenSlide(input_file)
+            reader = openslide_reader(input_file, self.read_threads, self.cache_size)
+            zarr_writer = zarr_pyramid(os.path.join(raw_outputFolder, f"{image_name}.zarr"), image_name, self.write_threads or None) if self.zarr_output else None
 
-            # 依序將每個level都轉換
-            for i in range(slide.level_count - 1, 0, -1):
+            # 沒有ROI時轉換整張slide，否則每個ROI各自一組instance
+            regions = [(None, raw_outputFolder)]
+            if self.rois:
+                regions = self.roi_regions(slide, raw_outputFolder)
+
+            # 依序將選擇的level都轉換
+            for (roi, roi_outputFolder), i in [(region, i) for region in regions for i in self.selected_levels(slide, region[1], output_file)]:
                 # 取得level資訊
                 #level_TileSize = int(self.tileSize // slide.level_downsamples[i])
-                level_TileSize = self.tileSize
+                level_TileSize = self.level_tile_size(slide, i)[0]
                 print(f'downsample 0:{slide.level_downsamples[i]}, tile = {level_TileSize}')
 
                 if os.path.exists(tmp_folder):
@@ -60,7 +157,7 @@ class Openslide2Dcm(Singleton):
                     os.mkdir(tmp_folder)
 
                     ### Check for duplicate files ###
-                    dcm_path = os.path.join(raw_outputFolder, str(i), output_file)
+                    dcm_path = os.path.join(roi_outputFolder, str(i), output_file)
                     try:
                         # Check if file exists and is a valid DICOM file
                         dcm_file = pydicom.dcmread(dcm_path)
@@ -79,13 +176,21 @@ class Openslide2Dcm(Singleton):
                 # 1. 圖片轉jpg
                 file_info.convert_status = "讀取原始檔"
                 #update_signal.emit(0)
-                self.split_tiff_layers_to_jpg_files_slice(slide, self.tmp_folder, file_info, print, i, level_TileSize)
+                tiles = self.split_tiff_layers_to_jpg_files_slice(slide, self.tmp_folder, file_info, print, i, level_TileSize, reader, roi)
 
                 # 2. jpg轉dcm
-                file_info.output_folder = f"{raw_outputFolder}/{i}/"
+                file_info.output_folder = f"{roi_outputFolder}/{i}/"
                 os.makedirs(file_info.output_folder, exist_ok=True)
-                imgs2dcm(self.tmp_folder, file_info, "bmp", print)
+                if roi is None:
+                    imgs2dcm(self.tmp_folder, file_info, "bmp", print, level=i, tiles=tiles, zarr_writer=zarr_writer, sink=self.dicom_sink, ring=self.tile_ring,
+                             level_size=self.level_size(slide, i), downsample=slide.level_downsamples[i])
+                else:
+                    imgs2dcm(self.tmp_folder, file_info, "bmp", print, level=i, tiles=tiles, sink=self.dicom_sink, ring=self.tile_ring,
+                             origin=roi_origin(roi, self.slide_mpp(slide, file_info)), instance_key=str(roi), level_size=self.level_size(slide, i, roi))
             pass
+
+            if zarr_writer is not None:
+                zarr_writer.close()
             
             if 'macro' in slide.associated_images:
                 macro_im = np.asarray(slide.associated_images['macro'])[:,:,:3]
@@ -97,8 +202,6 @@ class Openslide2Dcm(Singleton):
                 Image.fromarray(label_im).save(f"{raw_outputFolder}/label.jpeg")
             pass
 
-            slide.close()
-
             # 全數轉換完畢後刪除暫存檔
             shutil.rmtree(tmp_folder)
 
@@ -107,14 +210,251 @@ class Openslide2Dcm(Singleton):
             print(file_info.convert_status)
             if os.path.exists(tmp_folder):
                 shutil.rmtree(tmp_folder)
+        finally:
+            # 轉換失敗時也要結束reader的thread pool與各thread的OpenSlide handle
+            self.close_slide(slide, reader)
+
+
+    def convert_pyramid(self, file_info:imgfile_info, output_format):
+        """
+        將所有level(由大到小)寫成一個金字塔檔案:
+        tiff: {output_folder}/{檔名}.tiff (512圖塊的pyramidal BigTIFF)
+        zarr: {output_folder}/{檔名}.zarr (OME-Zarr，一個frame(tileSize)對應一個chunk)
+        """
+        slide, reader = None, None
+        try:
+            if not os.path.exists(file_info.input_file):
+                raise FileNotFoundError(f"File not found: {file_info.input_file}")
+
+            os.makedirs(file_info.output_folder, exist_ok=True)
+            image_name = os.path.splitext(file_info.output_filename)[0]
+            output_file = os.path.join(file_info.output_folder, f"{image_name}.{output_format}")
+            print(f"Processing file: {os.path.basename(file_info.input_file)}")
+
+            slide = OpenSlide(file_info.input_file)
+            reader = openslide_reader(file_info.input_file, self.read_threads, self.cache_size)
+            levels = []
+            for i in range(slide.level_count):
+                width, height = slide.level_dimensions[i]
+                tile_size = TIFF_TILE_SIZE if output_format == "tiff" else self.level_tile_size(slide, i)
+                levels.append(pyramid_level(i, width, height, tile_size, lambda level=i, size=tile_size: self.read_level_tiles(slide, level, size, reader),
+                                            slide.level_downsamples[i]))
+
+            file_info.convert_status = f"寫入{output_format}"
+            if output_format == "tiff":
+                write_tiff_pyramid(output_file, levels, max_workers=self.write_threads or None)
+            else:
+                zarr_writer = zarr_pyramid(output_file, image_name, self.write_threads or None)
+                for level in levels:
+                    zarr_writer.write_level(level)
+                zarr_writer.close()
+            file_info.convert_status = f"Completed ({output_file})"
+            print(file_info.convert_status)
+        except Exception as e:
+            file_info.convert_status = f"Error during conversion: {e}"
+            print(file_info.convert_status)
+        finally:
+            self.close_slide(slide, reader)
+
+    def close_slide(self, slide, reader):
+        """
+        關閉convert()/convert_pyramid()開啟的reader與slide (尚未開啟的為None)
+        """
+        if reader is not None:
+            reader.close()
+        if slide is not None:
+            slide.close()
+
+    def selected_levels(self, slide, output_folder, output_file):
+        """
+        依照levels選擇要轉換的level (由高到低)，missing時檢查 {output_folder}/{level}/{output_file}
+        """
+        return select_levels(self.levels, slide.level_count, range(1, slide.level_count),
+                             lambda level: os.path.join(output_folder, str(level), output_file))
+
+    def roi_regions(self, slide, output_folder):
+        """
+        將rois限制在slide範圍內
+        返回: [(roi, 該ROI的輸出資料夾)]
+        """
+        regions = []
+        width, height = slide.dimensions
+        for n, roi in enumerate(self.rois):
+            clipped = clip_roi(roi, width, height)
+            if clipped is None:
+                print(f"ROI {roi} is outside of the slide [{width}, {height}], skipped")
+                continue
+            regions.append((clipped, f"{output_folder}/roi_{n}"))
+        return regions
+
+    def slide_mpp(self, slide, file_info:imgfile_info):
+        """
+        第0層每個像素的大小(µm) [x, y]: 優先使用openslide.mpp-x/y，沒有時使用tag檔的Pixel Spacing(mm)
+        """
+        try:
+            return [float(slide.properties['openslide.mpp-x']), float(slide.properties['openslide.mpp-y'])]
+        except (KeyError, ValueError):
+            pass
+        if file_info.metadata_file:
+            spacing = parse_tag_file(file_info.metadata_file).get('Pixel Spacing', '')
+            values = [float(x) for x in spacing.replace('\\', ',').split(',') if x.strip()]
+            if len(values) == 2:
+                # Pixel Spacing為 [row(y), column(x)]
+                return [values[1] * 1000, values[0] * 1000]
+        print("Pixel size unknown, ROI origin set to (0, 0)")
+        return [0.0, 0.0]
 
+    def level_tile_size(self, slide, level):
+        """
+        取得某一層的frame大小 [width, height]。
+        auto_tile_size時依照該層的原生tile大小(openslide.level[i].tile-width/height)選擇read amplification最小的大小。
+        """
+        if not self.auto_tile_size:
+            return [self.tileSize, self.tileSize]
+
+        native_tile = None
+        tile_width = slide.properties.get(f'openslide.level[{level}].tile-width')
+        tile_height = slide.properties.get(f'openslide.level[{level}].tile-height')
+        if tile_width and tile_height:
+            native_tile = [int(tile_width), int(tile_height)]
+        width, height = slide.level_dimensions[level]
+        tile_size = choose_tile_size(width, height, native_tile, self.tileSize)
+        print(f'level {level}: native tile = {native_tile}, frame = {tile_size}')
+        return tile_size
+
+    def level_size(self, slide, level, roi=None):
+        """
+        該層的大小 [width, height]，有roi (第0層的x0, y0, x1, y1) 時為ROI在該層涵蓋的像素
+        """
+        if roi is None:
+            return list(slide.level_dimensions[level])
+        downsample = slide.level_downsamples[level]
+        return [int(-(-(roi[2] - roi[0]) // downsample)), int(-(-(roi[3] - roi[1]) // downsample))]
+
+    def level_frame_grid(self, slide, level, tile_size, roi=None):
+        """
+        依照該層的大小(level_dimensions)與縮放倍率(level_downsamples)切出frame格線。
+        有roi (第0層的x0, y0, x1, y1) 時格線從ROI左上角開始，只涵蓋ROI。
+        frame在該層的像素座標為 (col*tile_width, row*tile_height)，
+        換算成read_region需要的第0層座標時以四捨五入，避免浮點誤差讓frame偏移一個像素。
+        frame大小為原生tile的整數倍時，每次read_region都剛好對齊整數個來源tile。
+        返回: (rows, columns, [(row, col, 第0層位置)]) row-major順序，最後一列/行涵蓋到圖片邊緣
+        """
+        width, height = self.level_size(slide, level, roi)
+        downsample = slide.level_downsamples[level]
+        x_origin, y_origin = 0, 0
+        if roi is not None:
+            x_origin, y_origin = roi[0], roi[1]
+        columns = max(-(-width // tile_size[0]), 1)
+        rows = max(-(-height // tile_size[1]), 1)
+
+        tile_width = slide.properties.get(f'openslide.level[{level}].tile-width')
+        tile_height = slide.properties.get(f'openslide.level[{level}].tile-height')
+        if tile_width and tile_height and (tile_size[0] % int(tile_width) or tile_size[1] % int(tile_height)):
+            print(f'level {level}: frame {tile_size} is not a multiple of the native tile [{tile_width}, {tile_height}], reads straddle source tiles')
+
+        blocks = []
+        for row in range(rows):
+            for col in range(columns):
+                location = (x_origin + int(round(col * tile_size[0] * downsample)), y_origin + int(round(row * tile_size[1] * downsample)))
+                blocks.append((row, col, location))
+        return rows, columns, blocks
+
+    def read_level_tiles(self, slide, target_layer, tile_size, reader, rows=None, positions=None):
+        """
+        以reader平行讀出某一層的所有圖塊。
+        rows: (row_start, row_end)，只讀取這個範圍的frame列，None為整層
+        positions: (row, col) 的集合，只讀取這些frame (取樣用)
+        返回: 依row-major順序的 (row, col, RGB陣列) generator，透明部分以白色填充
+        """
+        _, _, blocks = self.level_frame_grid(slide, target_layer, tile_size)
+        if rows is not None:
+            blocks = [block for block in blocks if rows[0] <= block[0] < rows[1]]
+        if positions is not None:
+            blocks = [block for block in blocks if (block[0], block[1]) in positions]
+
+        def read_block(block):
+            j, i, location = block
+            region = reader.read_region(location, target_layer, tuple(tile_size))
+            return j, i, np.asarray(self.fill_transparent_with_white(region))
+
+        yield from reader.map(read_block, blocks)
+
+    def band_levels(self, file_info:imgfile_info):
+        """
+        convert()會轉換的各層及其frame格線，給row band分散轉換使用
+        返回: [(level, tile_size, rows, columns)]
+        """
+        slide = OpenSlide(file_info.input_file)
+        try:
+            layouts = []
+            for i in self.selected_levels(slide, file_info.output_folder, file_info.output_filename):
+                tile_size = self.level_tile_size(slide, i)
+                rows, columns, _ = self.level_frame_grid(slide, i, tile_size)
+                layouts.append((i, tile_size, rows, columns))
+            return layouts
+        finally:
+            slide.close()
+
+    def level_band_frames(self, file_info:imgfile_info, level, tile_size, row_start, row_end):
+        """
+        讀出某一層第row_start到row_end(不含)列的frame
+        返回: (row, col, RGB陣列) generator
+        """
+        slide = OpenSlide(file_info.input_file)
+        reader = openslide_reader(file_info.input_file, self.read_threads, self.cache_size)
+        try:
+            yield from self.read_level_tiles(slide, level, tile_size, reader, (row_start, row_end))
+        finally:
+            reader.close()
+            slide.close()
+
+    def prefetch_frames(self, file_info:imgfile_info, budget):
+        """
+        以自己的OpenSlide handle讀取最先轉換的level(選擇的level中最高的)最前面的frame，最多budget bytes的像素，
+        下一張slide開始轉換時這些資料已在page cache (slide_prefetcher在背景thread呼叫)
+        返回: 讀取的像素bytes
+        """
+        slide = OpenSlide(file_info.input_file)
+        try:
+            levels = self.selected_levels(slide, file_info.output_folder, file_info.output_filename)
+            if not levels:
+                return 0
+            level = levels[0]
+            tile_size = self.level_tile_size(slide, level)
+            _, _, blocks = self.level_frame_grid(slide, level, tile_size)
+            bytes_read = 0
+            for _, _, location in blocks:
+                if bytes_read >= budget:
+                    break
+                slide.read_region(location, level, tuple(tile_size))
+                bytes_read += tile_size[0] * tile_size[1] * 4
+            return bytes_read
+        finally:
+            slide.close()
+
+    def level_sample_frames(self, file_info:imgfile_info, level, tile_size, positions):
+        """
+        讀出某一層指定位置的frame (估算壓縮率用)
+        返回: (row, col, RGB陣列) generator
+        """
+        slide = OpenSlide(file_info.input_file)
+        reader = openslide_reader(file_info.input_file, self.read_threads, self.cache_size)
+        try:
+            yield from self.read_level_tiles(slide, level, tile_size, reader, positions=set(positions))
+        finally:
+            reader.close()
+            slide.close()
 
-    def split_tiff_layers_to_jpg_files_slice(self, slide, output_folder, file_info:imgfile_info, update_signal:Signal, target_layer=0, block_size=512):
+    def split_tiff_layers_to_jpg_files_slice(self, slide, output_folder, file_info:imgfile_info, update_signal:Signal, target_layer=0, block_size=512, reader=None, roi=None):
         """
         input_file: 輸入的TIFF檔案路徑。
         output_folder: 輸出JPG檔案的資料夾路徑。
         target_layer: 從TIFF檔案中提取的層索引。
-        num_blocks: 將圖像分割成的方塊數量。
+        block_size: frame邊長(該層的像素)，最好是該層原生tile的整數倍。
+        reader: openslide_reader，沒有提供時建立一個只用於這一層的reader
+        roi: (x0, y0, x1, y1) 第0層座標，只讀取涵蓋這個區域的圖塊，None為整層
+        返回: 每個區塊的tile_record list
         """
 
         # 建立輸出資料夾
@@ -131,55 +471,47 @@ class Openslide2Dcm(Singleton):
         # 獲取指定層的尺寸
         width, height = slide.level_dimensions[target_layer]
         print(f"全圖大小為:[{width}, {height}]")
-        
-        # 取得第0層的大小(位置用到)
-        fwidth, fheight = slide.level_dimensions[0]
-        print(f"第0層全圖大小為:[{fwidth}, {fheight}]")
-        
-        # 計算每個區塊的寬度和高度
-        block_count = [max(int(width // block_size),1), max(int(height // block_size),1)]
-        fblock_count =  [max(int(fwidth // self.tileSize),1), max(int(fheight // self.tileSize),1)]
-        fblock_size = [int(self.tileSize * (fblock_count[0] / block_count[0])), int(self.tileSize * (fblock_count[1] / block_count[1]))]
-
-        # 逐個區塊處理
-        loaded_image_count = 0
-        for j in range(block_count[1]):
-            for i in range(block_count[0]):        
-                loaded_image_count += 1
-                file_info.convert_status = f"讀取圖檔為bmp({loaded_image_count}/{block_count[0]*block_count[1]})"
-                # update_signal.emit(0)
 
-                # 計算當前區塊的位置和尺寸
-                x_position = i * fblock_size[0]
-                y_position = j * fblock_size[1]
-                block_dimensions = (block_size, block_size)
-                # 讀取對應於當前區塊的區域
-                region = np.array(slide.read_region((x_position, y_position), target_layer, block_dimensions))
-                
-                # 將區域轉換為RGBA格式
-                region_rgba = Image.fromarray(region, 'RGBA')
-                
-                # 如果輸出資料夾不存在，則創建之
-                os.makedirs(output_folder, exist_ok=True)
-                
-                # 定義輸出檔案路徑
-                output_file = os.path.join(output_folder, f"layer_{target_layer}_region_{j}_{i}.bmp")
-                
-                # 用白色填充透明部分
-                region_rgba = self.fill_transparent_with_white(region_rgba)
-                
-                # 將區塊保存為JPG檔案
-                region_rgba.save(output_file, "BMP")
-                print(f"已保存區塊({j}, {i})至{output_file}")
-
-                del region_rgba
-                gc.collect()
+        # 以該層自己的像素格線切割，位置再換算回第0層座標
+        block_dimensions = (block_size, block_size)
+        rows, columns, blocks = self.level_frame_grid(slide, target_layer, block_dimensions, roi)
+        print(f"切割為 {rows} x {columns} 個區塊")
 
-            pass
-        pass
+        own_reader = reader is None
+        if own_reader:
+            reader = openslide_reader(file_info.input_file, self.read_threads, self.cache_size)
+
+        def read_block(block):
+            j, i, location = block
+            # 讀取對應於當前區塊的區域 (RGBA)
+            region_rgba = reader.read_region(location, target_layer, block_dimensions)
+
+            # 定義輸出檔案路徑
+            output_file = os.path.join(output_folder, f"layer_{target_layer}_region_{j}_{i}.bmp")
+
+            # 用白色填充透明部分
+            region_rgb = self.fill_transparent_with_white(region_rgba)
+
+            # 將區塊保存為BMP檔案
+            region_rgb.save(output_file, "BMP")
+            return tile_record(target_layer, j, i, output_file)
+
+        # 各區塊在reader的thread內平行讀取及存檔，依序取回結果
+        tiles = []
+        try:
+            for loaded_image_count, tile in enumerate(reader.map(read_block, blocks), 1):
+                tiles.append(tile)
+                file_info.convert_status = f"讀取圖檔為bmp({loaded_image_count}/{len(blocks)})"
+                # update_signal.emit(0)
+                print(f"已保存區塊({tile.row}, {tile.col})至{tile.file_path}")
+        finally:
+            if own_reader:
+                reader.close()
+        gc.collect()
 
         # 關閉病理切片圖像
         #slide.close()
+        return tiles
 
     
     def fill_transparent_with_white(self, img):
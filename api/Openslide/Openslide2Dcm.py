@@ -55,7 +55,7 @@ class Openslide2Dcm(Singleton):
                 # 2. jpg轉dcm
                 file_info.output_folder = f"{raw_outputFolder}/{i}/"
                 os.makedirs(file_info.output_folder, exist_ok=True)
-                imgs2dcm(self.tmp_folder, file_info, "bmp", update_signal)
+                imgs2dcm(self.tmp_folder, file_info, "bmp", update_signal, level=i)
             pass
             
             if 'macro' in slide.associated_images:
@@ -0,0 +1,108 @@
+"""
+concurrency_budget
+
+One CPU budget for the whole conversion instead of every stage sizing its pool to cpu_count():
+the cores are divided between the slides converted at the same time on this machine, and each slide's
+share between its stages:
+    reader   OpenSlide reader threads (the PixelEngine keeps its own pool, which this share leaves room for)
+    encoder  JPEG 2000 encoder processes of the tile ring, or encoder threads of --split-bands
+    writer   threads writing the iSyntax patches and compressing TIFF/Zarr output
+When the frames are encoded in the converting process (no encoder processes or threads), the encoder
+share goes to the readers. Codec libraries that would start threads of their own inside every encoder
+(OpenJPEG) are limited to one.
+cpu_meter reports how many of the budgeted cores were actually busy.
+"""
+import os
+import time
+from multiprocessing import cpu_count
+
+# share of a slide's cores per stage, JPEG 2000 encoding is the most expensive one
+STAGE_SHARES = {"reader": 0.25, "encoder": 0.5, "writer": 0.25}
+# environment variables of libraries that start their own thread pools
+LIBRARY_THREAD_VARIABLES = ["OPJ_NUM_THREADS", "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+
+class stage_threads():
+
+    def __init__(self, reader, encoder, writer) -> None:
+        self.reader = reader
+        self.encoder = encoder
+        self.writer = writer
+        pass
+
+    def __str__(self):
+        return f"reader {self.reader}, encoder {self.encoder}, writer {self.writer}"
+
+
+class concurrency_budget():
+
+    def __init__(self, cores=0, concurrent_slides=1) -> None:
+        self.cores = cores if cores > 0 else cpu_count()
+        self.concurrent_slides = max(1, concurrent_slides)
+        pass
+
+    def slide_cores(self):
+        return max(1, self.cores // self.concurrent_slides)
+
+    def stages(self, encoder_in_process=False):
+        """
+        Threads (or processes) per stage for one slide, at least one each.
+        encoder_in_process: frames are encoded by the converting thread itself, the readers get the encoder share
+        """
+        cores = self.slide_cores()
+        shares = dict(STAGE_SHARES)
+        if encoder_in_process:
+            shares["reader"] += shares["encoder"]
+            shares["encoder"] = 0
+        return stage_threads(*(max(1, int(cores * shares[stage])) for stage in ("reader", "encoder", "writer")))
+
+    def configure_libraries(self):
+        """
+        One thread per encoder call in the codec libraries: the parallelism comes from the encoder stage.
+        Set before the encoder processes are started so they inherit it; variables already set are kept.
+        """
+        for name in LIBRARY_THREAD_VARIABLES:
+            os.environ.setdefault(name, "1")
+
+
+def cpu_seconds(pids=()):
+    """
+    CPU time (user + system) of this process and of the given child processes still running
+    (children are read from /proc, so only counted on Linux)
+    """
+    total = time.process_time()
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", "r", encoding="ascii") as file:
+                # fields after the command name, which may contain spaces
+                fields = file.read().rpartition(")")[2].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+class cpu_meter():
+    """
+    Effective CPU utilization between start() and report(): CPU seconds / (wall seconds x budgeted cores)
+    """
+
+    def __init__(self, cores, pids=()) -> None:
+        self.cores = cores
+        self.pids = list(pids)
+        self.start()
+        pass
+
+    def start(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = cpu_seconds(self.pids)
+
+    def report(self):
+        """
+        Returns:
+            (busy cores, utilization of the budget 0..1)
+        """
+        wall = max(time.perf_counter() - self.wall_start, 1e-9)
+        busy = (cpu_seconds(self.pids) - self.cpu_start) / wall
+        return busy, busy / self.cores
@@ -0,0 +1,271 @@
+"""
+conversion_daemon
+
+Long-lived conversion service: the PixelEngine backend and the OpenSlide library are initialized once,
+jobs are submitted over a local HTTP API and run on the daemon's worker threads.
+
+    POST /jobs                 {"source": ..., "output": ..., "mode": "folder", "api": "Openslide", "metadata": ..., "options": {...}}
+                               -> {"id": ...}
+    GET  /jobs                 -> status of every job
+    GET  /jobs/{id}            -> status of one job
+    GET  /jobs/{id}/events     -> newline-delimited JSON status updates, streamed until the job ends
+
+One worker thread per conversion API: the converters are singletons holding one PixelEngine input
+and one temp folder, so conversions of the same API run one after another while iSyntax and OpenSlide
+jobs run side by side. The PixelEngine backend is chosen once for the daemon (it cannot change after
+initialization), a job asking for a different isyntax_backend is rejected.
+"""
+import json
+import time
+import queue
+import threading
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from api.convert_api_type import convert_api_type
+from api.convert_mode_type import convert_mode_type
+from api.level_selection import parse_levels
+from wsi_converter import wsi_converter, MIN_TILE_SIZE
+
+ISYNTAX_BACKENDS = ['AUTO', 'SOFTWARE', 'GLES2', 'GLES3']
+OUTPUT_FORMATS = ['dicom', 'tiff', 'zarr', 'dicom+zarr']
+EVENT_INTERVAL = 1.0
+
+
+def option_integer(value, minimum):
+    """
+    JSON number or numeric string -> int >= minimum
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"must be an integer >= {minimum}")
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"must be an integer >= {minimum}")
+    if not number.is_integer() or number < minimum:
+        raise ValueError(f"must be an integer >= {minimum}")
+    return int(number)
+
+
+def option_tile_size(value):
+    if value == "auto":
+        return value
+    return str(option_integer(value, MIN_TILE_SIZE))
+
+
+def option_count(value):
+    return option_integer(value, 0)
+
+
+def option_flag(value):
+    if not isinstance(value, bool):
+        raise ValueError("must be true or false")
+    return value
+
+
+def option_choice(choices):
+    def coerce(value):
+        if value not in choices:
+            raise ValueError(f"must be one of {', '.join(choices)}")
+        return value
+    return coerce
+
+
+def option_levels(value):
+    if not isinstance(value, str):
+        raise ValueError("must be a string such as default, all, missing or 0,2,4-6")
+    parse_levels(value)
+    return value
+
+
+# wsi_converter settings a job may override, with the function validating and converting the JSON value
+JOB_OPTIONS = {
+    'tile_size': option_tile_size,
+    'isyntax_backend': option_choice(ISYNTAX_BACKENDS),
+    'output_format': option_choice(OUTPUT_FORMATS),
+    'deterministic_uids': option_flag,
+    'read_threads': option_count,
+    'cache_mb': option_count,
+    'levels': option_levels,
+}
+
+
+class conversion_job():
+
+    def __init__(self, job_id, request) -> None:
+        self.id = job_id
+        self.request = request
+        self.state = "queued"
+        self.message = ""
+        self.files = []
+        self.created = time.time()
+        self.finished = None
+        pass
+
+    def status(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "message": self.message,
+            "source": self.request.get("source", ""),
+            "files": [{"input": file_info.input_file, "status": file_info.convert_status} for file_info in self.files],
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class conversion_daemon():
+
+    def __init__(self, warm_up=True, isyntax_backend="AUTO") -> None:
+        self.isyntax_backend = isyntax_backend
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.queues = {api: queue.Queue() for api in convert_api_type}
+        for api, job_queue in self.queues.items():
+            threading.Thread(target=self.worker, args=(job_queue,), name=f"convert-{api.name}", daemon=True).start()
+        if warm_up:
+            self.warm_up()
+        pass
+
+    def warm_up(self):
+        """
+        Initialize the PixelEngine backend now instead of on the first job
+        """
+        converter = wsi_converter()
+        converter.convert_api = convert_api_type.iSyntax
+        converter.isyntax_backend = self.isyntax_backend
+        try:
+            converter.get_converter()
+        except Exception as e:
+            print(f"iSyntax backend not available: {e}")
+
+    def submit(self, request):
+        """
+        Validate a job request and queue it on the worker of its API
+        """
+        if not isinstance(request, dict):
+            raise ValueError("The job must be a JSON object")
+        converter = wsi_converter()
+        # file_list is a class attribute, every job needs its own list
+        converter.file_list = []
+        converter.source_path = request["source"]
+        converter.output_path = request["output"]
+        converter.metadata_path = request.get("metadata", "")
+        converter.convert_mode = convert_mode_type[request.get("mode", "single_file")]
+        converter.convert_api = convert_api_type[request.get("api", "iSyntax")]
+        # one slide per API worker converts at the same time
+        converter.concurrent_slides = len(convert_api_type)
+        converter.isyntax_backend = self.isyntax_backend
+        options = request.get("options", {})
+        if not isinstance(options, dict):
+            raise ValueError("options must be an object")
+        for key, value in options.items():
+            if key not in JOB_OPTIONS:
+                raise ValueError(f"Unknown option: {key}")
+            try:
+                value = JOB_OPTIONS[key](value)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Invalid option {key}={value!r}: {e}")
+            if key == "isyntax_backend" and value != self.isyntax_backend:
+                # the PixelEngine keeps the backend it was initialized with
+                raise ValueError(f"isyntax_backend is set for the whole daemon ({self.isyntax_backend}), restart it with --isyntax-backend {value}")
+            setattr(converter, key, value)
+
+        with self.lock:
+            job = conversion_job(str(next(self.ids)), request)
+            self.jobs[job.id] = job
+        valid = converter.check_valid()
+        if valid != "OK":
+            job.state = "failed"
+            job.message = valid
+            job.finished = time.time()
+            return job
+        job.files = list(converter.file_list)
+        self.queues[converter.convert_api].put((job, converter))
+        return job
+
+    def worker(self, job_queue):
+        while True:
+            job, converter = job_queue.get()
+            job.state = "running"
+            failed = 0
+            for file_info in job.files:
+                if not converter.convert_file(file_info):
+                    failed += 1
+            job.state = "failed" if failed else "completed"
+            job.message = f"{len(job.files) - failed}/{len(job.files)} file(s) converted"
+            job.finished = time.time()
+
+
+class daemon_request_handler(BaseHTTPRequestHandler):
+    daemon: conversion_daemon = None
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.daemon.submit(request)
+        except (KeyError, ValueError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(202, job.status())
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("/") if part]
+        if parts == ["jobs"]:
+            self.send_json(200, [job.status() for job in list(self.daemon.jobs.values())])
+            return
+        if len(parts) < 2 or parts[0] != "jobs" or parts[1] not in self.daemon.jobs:
+            self.send_json(404, {"error": "not found"})
+            return
+        job = self.daemon.jobs[parts[1]]
+        if len(parts) == 2:
+            self.send_json(200, job.status())
+        elif parts[2:] == ["events"]:
+            self.stream_events(job)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def stream_events(self, job):
+        """
+        Send the job status whenever it changes, one JSON object per line, until the job has ended
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        last = None
+        while True:
+            status = job.status()
+            if status != last:
+                self.wfile.write((json.dumps(status) + "\n").encode("utf-8"))
+                self.wfile.flush()
+                last = status
+            if job.finished is not None:
+                return
+            time.sleep(EVENT_INTERVAL)
+
+    def log_message(self, format, *args):
+        print(f"[daemon] {self.address_string()} {format % args}")
+
+
+def serve(host="127.0.0.1", port=8642, warm_up=True, isyntax_backend="AUTO"):
+    daemon_request_handler.daemon = conversion_daemon(warm_up, isyntax_backend)
+    server = ThreadingHTTPServer((host, port), daemon_request_handler)
+    server.daemon_threads = True
+    print(f"Conversion daemon listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
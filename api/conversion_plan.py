@@ -0,0 +1,150 @@
+"""
+conversion_plan
+
+Estimate a conversion before running it: frames, output size, peak RAM and time per slide.
+- frames: from the level headers only (OpenSlide level_dimensions, iSyntax dimension_ranges) and the frame size
+- output bytes: a few frames spread over the largest converted level are read and encoded,
+  their compressed / raw ratio is applied to every frame
+- peak RAM: imgs2dcm keeps the encoded frames of a level and builds the encapsulated Pixel Data from them
+  (about twice the encoded level), plus the frames in flight in the readers and the OpenSlide tile cache
+- time: frames x (1 / read rate + 1 / encode rate), rates in pixels per second from benchmark.json:
+  the running average of --benchmark-backends and earlier plans, updated with the sampled frames
+"""
+import time
+import json
+from multiprocessing import cpu_count
+
+import numpy as np
+
+from api.throughput_store import load_throughput, save_throughput, read_key, encode_key
+
+# sampled frames per slide: a 3 x 3 grid over the largest converted level
+SAMPLE_GRID = 3
+
+
+def sample_positions(rows, columns, grid=SAMPLE_GRID):
+    """
+    (row, col) positions spread evenly over a level
+    """
+    sample_rows = sorted({rows * (i + 1) // (grid + 1) for i in range(grid)})
+    sample_columns = sorted({columns * (i + 1) // (grid + 1) for i in range(grid)})
+    return [(row, col) for row in sample_rows for col in sample_columns]
+
+
+def measure_samples(frames, encoder):
+    """
+    Read and encode the sampled frames
+    Returns:
+        (compression ratio, read seconds per frame, encode seconds per frame), None without frames
+    """
+    raw_bytes, encoded_bytes, count, encode_seconds = 0, 0, 0, 0.0
+    start = time.perf_counter()
+    read_seconds = 0.0
+    for _, _, pixels in frames:
+        read_seconds += time.perf_counter() - start
+        pixels = np.ascontiguousarray(pixels)
+        encode_start = time.perf_counter()
+        encoded_bytes += len(encoder(pixels))
+        encode_seconds += time.perf_counter() - encode_start
+        raw_bytes += pixels.nbytes
+        count += 1
+        start = time.perf_counter()
+    if count == 0:
+        return None
+    return encoded_bytes / raw_bytes, read_seconds / count, encode_seconds / count
+
+
+class slide_plan():
+    """
+    Estimate for one slide, levels = [(level, tile_size, rows, columns)]
+    """
+
+    def __init__(self, input_file, levels) -> None:
+        self.input_file = input_file
+        self.levels = levels
+        self.frames = sum(rows * columns for _, _, rows, columns in levels)
+        self.raw_bytes = sum(rows * columns * tile[0] * tile[1] * 3 for _, tile, rows, columns in levels)
+        self.compression_ratio = None
+        self.output_bytes = None
+        self.peak_ram = None
+        self.seconds = None
+        self.error = ""
+        pass
+
+    def estimate(self, ratio, read_seconds, encode_seconds, frames_in_flight, cache_bytes):
+        self.compression_ratio = ratio
+        self.output_bytes = int(self.raw_bytes * ratio)
+        largest_level = max((rows * columns * tile[0] * tile[1] * 3 for _, tile, rows, columns in self.levels), default=0)
+        largest_frame = max((tile[0] * tile[1] * 3 for _, tile, _, _ in self.levels), default=0)
+        # encoded level + its encapsulated copy, raw (RGBA + RGB) frames in flight, shared tile cache
+        self.peak_ram = int(2 * largest_level * ratio + frames_in_flight * largest_frame * 7 / 3 + cache_bytes)
+        self.seconds = self.frames * (read_seconds + encode_seconds)
+
+    def to_dict(self):
+        return {
+            "input_file": self.input_file,
+            "levels": [{"level": level, "tile_size": list(tile), "rows": rows, "columns": columns, "frames": rows * columns}
+                       for level, tile, rows, columns in self.levels],
+            "frames": self.frames,
+            "raw_bytes": self.raw_bytes,
+            "compression_ratio": self.compression_ratio,
+            "output_bytes": self.output_bytes,
+            "peak_ram_bytes": self.peak_ram,
+            "seconds": self.seconds,
+            "error": self.error,
+        }
+
+
+def rates(api, backend, tile_size, measured):
+    """
+    Read / encode seconds per frame of tile_size: the sampled rates are added to the stored running averages,
+    which are then used (a slide whose samples could not be timed uses the stored averages alone)
+    """
+    pixels = tile_size[0] * tile_size[1]
+    _, read_seconds, encode_seconds = measured
+    if read_seconds > 0:
+        read_seconds = pixels / save_throughput(read_key(api, backend), pixels / read_seconds)
+    else:
+        read_rate = load_throughput(read_key(api, backend))
+        read_seconds = pixels / read_rate if read_rate else read_seconds
+    if encode_seconds > 0:
+        encode_seconds = pixels / save_throughput(encode_key("JPEG2000"), pixels / encode_seconds)
+    else:
+        encode_rate = load_throughput(encode_key("JPEG2000"))
+        encode_seconds = pixels / encode_rate if encode_rate else encode_seconds
+    return read_seconds, encode_seconds
+
+
+def size_text(value):
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if value < 1024 or unit == "TiB":
+            return f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def print_plan(plans):
+    print(f"{'file':<50} {'frames':>8} {'output':>11} {'peak RAM':>11} {'time':>10}")
+    for plan in plans:
+        name = plan.input_file[-50:]
+        if plan.error:
+            print(f"{name:<50} {plan.error}")
+            continue
+        print(f"{name:<50} {plan.frames:>8} {size_text(plan.output_bytes):>11} {size_text(plan.peak_ram):>11} {plan.seconds / 60:>8.1f} m")
+    done = [plan for plan in plans if not plan.error]
+    print("------------------------------------------------")
+    print(f"{len(done)} slide(s), {sum(plan.frames for plan in done)} frames, "
+          f"{size_text(sum(plan.output_bytes for plan in done))} output, "
+          f"peak RAM {size_text(max((plan.peak_ram for plan in done), default=0))}, "
+          f"{sum(plan.seconds for plan in done) / 3600:.2f} h in one process")
+
+
+def write_plan(path, plans):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump([plan.to_dict() for plan in plans], file, indent=4)
+
+
+def frames_in_flight(read_threads):
+    """
+    Raw frames held at once by the readers (read-ahead of the thread pools)
+    """
+    return max(read_threads, cpu_count()) * 2
@@ -0,0 +1,135 @@
+"""
+cstore_sink
+
+Send converted instances to DIMSE-only PACS with C-STORE (pynetdicom).
+One association per destination is opened on the first instance and kept for all levels and slides;
+the presentation contexts are negotiated once, for the transfer syntaxes the encoder produces.
+Each destination has its own sender thread, so sends overlap with the conversion of the next level.
+An aborted or rejected association is re-opened and the instance retried.
+"""
+import time
+import queue
+import threading
+
+from pydicom.uid import JPEG2000Lossless, ExplicitVRLittleEndian, VLWholeSlideMicroscopyImageStorage
+
+CSTORE_RETRIES = 3
+# Transfer syntaxes of the files this tool writes
+TRANSFER_SYNTAXES = [JPEG2000Lossless, ExplicitVRLittleEndian]
+SUCCESS_STATUS = 0x0000
+# Warning statuses (coercion, elements discarded) still store the instance
+WARNING_STATUS = {0x0001, 0xB000, 0xB006, 0xB007}
+
+
+class cstore_error(Exception):
+    pass
+
+
+class cstore_rejected(cstore_error):
+    pass
+
+
+def parse_destination(destination):
+    """
+    "AE_TITLE@host:port" -> (ae_title, host, port)
+    """
+    ae_title, _, address = destination.rpartition("@")
+    host, _, port = address.rpartition(":")
+    if not ae_title or not host or not port.isdigit():
+        raise ValueError(f"Destination must be AE_TITLE@host:port: {destination}")
+    return ae_title, host, int(port)
+
+
+class cstore_destination():
+    """
+    A persistent association to one SCP and the thread sending to it
+    """
+
+    def __init__(self, destination, calling_ae, retries) -> None:
+        # pynetdicom is only needed when C-STORE output is used
+        from pynetdicom import AE
+
+        self.destination = destination
+        self.ae_title, self.host, self.port = parse_destination(destination)
+        self.retries = retries
+        self.ae = AE(ae_title=calling_ae)
+        self.ae.add_requested_context(VLWholeSlideMicroscopyImageStorage, TRANSFER_SYNTAXES)
+        self.association = None
+        self.jobs = queue.Queue()
+        self.failed = []
+        self.thread = threading.Thread(target=self.send_jobs, name=f"cstore-{self.ae_title}", daemon=True)
+        self.thread.start()
+        pass
+
+    def associate(self):
+        if self.association is not None and self.association.is_established:
+            return self.association
+        self.association = self.ae.associate(self.host, self.port, ae_title=self.ae_title)
+        if not self.association.is_established:
+            raise cstore_error(f"Association with {self.destination} rejected or aborted")
+        print(f"Association with {self.destination} established")
+        return self.association
+
+    def send(self, path):
+        for attempt in range(self.retries + 1):
+            try:
+                status = self.associate().send_c_store(path)
+                code = getattr(status, "Status", None)
+                if code == SUCCESS_STATUS or code in WARNING_STATUS:
+                    return
+                if code is not None:
+                    # the SCP refused this instance, sending it again will not help
+                    raise cstore_rejected(f"C-STORE of {path} to {self.destination} failed with status 0x{code:04X}")
+                # no response: the association was aborted or timed out
+                error = cstore_error("no C-STORE response")
+            except cstore_rejected:
+                raise
+            except (OSError, RuntimeError, cstore_error) as e:
+                error = e
+            self.association = None
+            if attempt < self.retries:
+                delay = 2 ** attempt
+                print(f"C-STORE of {path} to {self.destination} failed ({error}), retrying in {delay}s")
+                time.sleep(delay)
+        raise cstore_error(f"C-STORE of {path} to {self.destination} failed after {self.retries + 1} attempts: {error}")
+
+    def send_jobs(self):
+        while True:
+            path = self.jobs.get()
+            if path is None:
+                break
+            try:
+                self.send(path)
+                print(f"Stored {path} on {self.destination}")
+            except Exception as e:
+                print(f"C-STORE failed: {e}")
+                self.failed.append((path, e))
+            finally:
+                self.jobs.task_done()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        if self.association is not None and self.association.is_established:
+            self.association.release()
+        return self.failed
+
+
+class cstore_sink():
+    """
+    submit() queues an instance for every destination, close() waits for the sends and releases the associations
+    """
+
+    def __init__(self, destinations, calling_ae="WSI2DCM", retries=CSTORE_RETRIES) -> None:
+        self.destinations = [cstore_destination(destination, calling_ae, retries) for destination in destinations]
+        pass
+
+    def submit(self, path):
+        for destination in self.destinations:
+            destination.jobs.put(path)
+
+    def close(self):
+        failed = []
+        for destination in self.destinations:
+            failed.extend(destination.close())
+        return failed
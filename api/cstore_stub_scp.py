@@ -0,0 +1,49 @@
+"""
+cstore_stub_scp
+
+Minimal local Storage SCP (pynetdicom) to try C-STORE output (--cstore) without a PACS.
+Stores every received instance as {output_folder}/{SOPInstanceUID}.dcm and logs each association.
+    python -m api.cstore_stub_scp -o received -p 11112 --ae STORESCP
+    python wsi2dcm.py ... --cstore STORESCP@127.0.0.1:11112
+"""
+import os
+import argparse
+
+from pydicom.uid import VLWholeSlideMicroscopyImageStorage
+from pynetdicom import AE, evt
+
+from api.cstore_sink import TRANSFER_SYNTAXES
+
+
+def serve(output_folder, port=11112, ae_title="STORESCP", block=True):
+    os.makedirs(output_folder, exist_ok=True)
+
+    def handle_store(event):
+        path = os.path.join(output_folder, f"{event.request.AffectedSOPInstanceUID}.dcm")
+        with open(path, "wb") as file:
+            # preamble, file meta and the dataset exactly as received, without decoding
+            file.write(event.encoded_dataset())
+        print(f"Stored {path}")
+        return 0x0000
+
+    def handle_open(event):
+        print(f"Association from {event.assoc.requestor.ae_title} {event.address}")
+
+    ae = AE(ae_title=ae_title)
+    ae.add_supported_context(VLWholeSlideMicroscopyImageStorage, TRANSFER_SYNTAXES)
+    handlers = [(evt.EVT_C_STORE, handle_store), (evt.EVT_CONN_OPEN, handle_open)]
+    print(f"Storage SCP {ae_title} listening on port {port}")
+    return ae.start_server(("127.0.0.1", port), block=block, evt_handlers=handlers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in C-STORE SCP")
+    parser.add_argument("-o", "--output", default="received", help="folder for received instances")
+    parser.add_argument("-p", "--port", type=int, default=11112)
+    parser.add_argument("--ae", default="STORESCP", help="AE title of the SCP")
+    args = parser.parse_args()
+    serve(args.output, args.port, args.ae)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+dicomweb_stub_server
+
+Minimal local stand-in for a DICOMweb archive, to try STOW-RS uploads (--stow-url) without a PACS.
+Accepts POST {prefix}/studies with multipart/related bodies over keep-alive HTTP/1.1 and stores every part
+as {output_folder}/{n}.dcm. --fail-every N answers every Nth request with 503 to exercise the retries.
+    python -m api.dicomweb_stub_server -o received -p 8080
+    python wsi2dcm.py ... --stow-url http://127.0.0.1:8080/dicom-web
+"""
+import os
+import json
+import argparse
+import itertools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def split_multipart(body, content_type):
+    """
+    Returns:
+        list of part payloads of a multipart body
+    """
+    boundary = None
+    for parameter in content_type.split(";")[1:]:
+        name, _, value = parameter.strip().partition("=")
+        if name.lower() == "boundary":
+            boundary = value.strip('"')
+    if not boundary:
+        raise ValueError("No multipart boundary")
+    parts = []
+    for chunk in body.split(b"--" + boundary.encode("ascii"))[1:]:
+        if chunk.startswith(b"--"):
+            break
+        _, _, payload = chunk.partition(b"\r\n\r\n")
+        parts.append(payload[:-2] if payload.endswith(b"\r\n") else payload)
+    return parts
+
+
+class stow_request_handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    output_folder = "received"
+    prefix = ""
+    fail_every = 0
+    counter = itertools.count(1)
+    requests = itertools.count(1)
+    lock = threading.Lock()
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/dicom+json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.lock:
+            request_number = next(self.requests)
+        if self.path.rstrip("/") != self.prefix.rstrip("/") + "/studies":
+            self.reply(404, {"error": "not found"})
+            return
+        if self.fail_every and request_number % self.fail_every == 0:
+            self.reply(503, {"error": "simulated failure"})
+            return
+        try:
+            parts = split_multipart(body, self.headers.get("Content-Type", ""))
+        except ValueError as e:
+            self.reply(400, {"error": str(e)})
+            return
+        stored = []
+        for part in parts:
+            with self.lock:
+                path = os.path.join(self.output_folder, f"{next(self.counter)}.dcm")
+            with open(path, "wb") as file:
+                file.write(part)
+            stored.append(path)
+        print(f"Stored {len(stored)} instance(s): {', '.join(stored)}")
+        self.reply(200, {"00081199": {"vr": "SQ", "Value": [{} for _ in stored]}})
+
+
+def serve(output_folder, host="127.0.0.1", port=8080, prefix="/dicom-web", fail_every=0):
+    os.makedirs(output_folder, exist_ok=True)
+    stow_request_handler.output_folder = output_folder
+    stow_request_handler.prefix = prefix
+    stow_request_handler.fail_every = fail_every
+    server = ThreadingHTTPServer((host, port), stow_request_handler)
+    server.daemon_threads = True
+    print(f"STOW-RS stand-in listening on http://{host}:{port}{prefix}")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in DICOMweb STOW-RS server")
+    parser.add_argument("-o", "--output", default="received", help="folder for received instances")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--prefix", default="/dicom-web", help="DICOMweb base path")
+    parser.add_argument("--fail-every", dest="fail_every", type=int, default=0, help="answer every Nth request with 503")
+    args = parser.parse_args()
+    server = serve(args.output, port=args.port, prefix=args.prefix, fail_every=args.fail_every)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+file_index
+
+One walk over a folder tree for file discovery: sub folders are listed in parallel with os.scandir
+(on NFS every listing is a round trip, so the walk is latency bound), and all extensions are matched
+on the in-memory list afterwards instead of walking the tree once per glob pattern.
+Like glob, names starting with "." are skipped.
+"""
+import os
+import bisect
+import fnmatch
+from concurrent import futures
+
+SCAN_WORKERS = 16
+
+
+def list_folder(folder):
+    """
+    Returns:
+        (file paths, sub folder paths) of one folder
+    """
+    files, folders = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir():
+                        folders.append(entry.path)
+                    else:
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, folders
+
+
+def scan_tree(root, max_workers=SCAN_WORKERS):
+    """
+    All file paths below root, sub folders listed in parallel
+    """
+    paths = []
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(list_folder, root)}
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for job in done:
+                files, folders = job.result()
+                paths.extend(files)
+                pending.update(executor.submit(list_folder, folder) for folder in folders)
+    return paths
+
+
+class file_index():
+    """
+    In-memory index of file paths, shared by the slide list and the metadata join
+    """
+
+    def __init__(self, paths) -> None:
+        self.paths = sorted(paths)
+        # all paths in one string, so substring lookups run as a single str.find scan
+        self.joined = "\n".join(self.paths)
+        self.starts = []
+        position = 0
+        for path in self.paths:
+            self.starts.append(position)
+            position += len(path) + 1
+        pass
+
+    @classmethod
+    def scan(cls, root, max_workers=SCAN_WORKERS):
+        return cls(scan_tree(root, max_workers))
+
+    def match(self, patterns):
+        """
+        Paths whose file name matches any of the glob patterns, e.g. ["*.tiff", "*.mrxs"]
+        """
+        return file_index([path for path in self.paths
+                           if any(fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in patterns)])
+
+    def containing(self, text):
+        """
+        Paths containing text, same as [path for path in paths if path.find(text) != -1]
+        """
+        if not text or "\n" in text:
+            return [path for path in self.paths if text in path]
+        found = []
+        position = self.joined.find(text)
+        while position != -1:
+            index = bisect.bisect_right(self.starts, position) - 1
+            found.append(self.paths[index])
+            # continue after the end of this path
+            position = self.joined.find(text, self.starts[index] + len(self.paths[index]) + 1)
+        return found
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
@@ -0,0 +1,186 @@
+"""
+folder_watcher
+
+Watch a landing folder for new slides. New or changed files are found through inotify (Linux),
+or by rescanning the tree with os.scandir where inotify is not available (Windows, network shares).
+A file is reported once its size and modification time have not changed for settle_seconds,
+so a slide is never picked up while the scanner is still writing it.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import fnmatch
+
+from api.file_index import scan_tree
+
+SETTLE_SECONDS = 30
+POLL_INTERVAL = 10
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0x00000800
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class inotify_source():
+    """
+    Recursive inotify watch, yields paths of created, written or moved-in files
+    """
+
+    def __init__(self, root) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        self.add_tree(root)
+        pass
+
+    def add_tree(self, root):
+        for folder, _, _ in os.walk(root):
+            self.add_folder(folder)
+
+    def add_folder(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {folder}")
+        self.folders[wd] = folder
+
+    def read(self, timeout):
+        """
+        Returns:
+            changed file paths (empty after timeout seconds without events), None when events were dropped
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd not in self.folders:
+                continue
+            path = os.path.join(self.folders[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # a new sub folder (or one moved in) may already contain files
+                if os.path.isdir(path):
+                    self.add_tree(path)
+                    paths.extend(os.path.join(folder, file) for folder, _, files in os.walk(path) for file in files)
+            else:
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def file_signature(path):
+    """
+    (size, mtime) of a file. MIRAX keeps the pixel data in a folder next to the .mrxs,
+    which is included so the slide is only ready once the whole folder is written.
+    """
+    stat = os.stat(path)
+    size, mtime = stat.st_size, stat.st_mtime
+    data_folder = os.path.splitext(path)[0]
+    if path.lower().endswith(".mrxs") and os.path.isdir(data_folder):
+        for entry in scan_tree(data_folder):
+            entry_stat = os.stat(entry)
+            size += entry_stat.st_size
+            mtime = max(mtime, entry_stat.st_mtime)
+    return size, mtime
+
+
+class folder_watcher():
+    """
+    watch() yields every matching file once it is stable, existing files first
+    """
+
+    def __init__(self, root, patterns, settle_seconds=SETTLE_SECONDS, poll_interval=POLL_INTERVAL, use_inotify=True) -> None:
+        self.root = root
+        self.patterns = [pattern.lower() for pattern in patterns]
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.pending = {}
+        self.reported = {}
+        self.source = None
+        if use_inotify:
+            try:
+                self.source = inotify_source(root)
+                print(f"Watching {root} with inotify")
+            except (OSError, AttributeError, TypeError) as e:
+                print(f"inotify not available ({e}), polling {root} every {poll_interval}s")
+        pass
+
+    def matches(self, path):
+        name = os.path.basename(path).lower()
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns)
+
+    def add(self, paths):
+        for path in paths:
+            if self.matches(path) and path not in self.pending:
+                self.pending[path] = None
+
+    def check_pending(self):
+        """
+        Returns:
+            paths whose signature has been unchanged for settle_seconds
+        """
+        ready = []
+        now = time.time()
+        for path, state in list(self.pending.items()):
+            try:
+                signature = file_signature(path)
+            except OSError:
+                # deleted or renamed before it settled
+                del self.pending[path]
+                continue
+            if self.reported.get(path) == signature:
+                del self.pending[path]
+            elif state is None or state[0] != signature:
+                self.pending[path] = (signature, now)
+            elif now - state[1] >= self.settle_seconds:
+                del self.pending[path]
+                self.reported[path] = signature
+                ready.append(path)
+        return ready
+
+    def watch(self):
+        self.add(scan_tree(self.root))
+        last_scan = time.time()
+        while True:
+            if self.source is not None:
+                paths = self.source.read(1.0)
+                if paths is None:
+                    print("inotify queue overflow, rescanning")
+                    paths = scan_tree(self.root)
+                self.add(paths)
+            else:
+                time.sleep(1.0)
+                if time.time() - last_scan >= self.poll_interval:
+                    self.add(scan_tree(self.root))
+                    last_scan = time.time()
+            yield from self.check_pending()
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
@@ -0,0 +1,172 @@
+"""
+frame_shards
+
+把一層的frame依照row band分給多個process/節點編碼，最後合併成一個DICOM instance。
+- 每個band寫成一個shard: {name}.frames 為依frame順序排列的encapsulated item (FFFE,E000 + 長度 + 資料)，
+  {name}.json 為本地的offset index，寫完才出現(rename)，代表shard已完整。
+- 合併時依照band順序直接複製shard的bytes，Extended Offset Table的offset加上前面shard的大小即可，不需要解碼或重新編碼。
+"""
+import os
+import json
+import struct
+import shutil
+from concurrent import futures
+from multiprocessing import cpu_count
+
+import numpy as np
+
+from api.uniform_frames import frame_cache
+
+ITEM_TAG = b'\xfe\xff\x00\xe0'
+SEQUENCE_DELIMITER = b'\xfe\xff\xdd\xe0\x00\x00\x00\x00'
+# (7FE0,0010) OB, 未定義長度，後面接空的Basic Offset Table item
+PIXEL_DATA_HEADER = b'\xe0\x7f\x10\x00OB\x00\x00\xff\xff\xff\xff' + ITEM_TAG + b'\x00\x00\x00\x00'
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def split_rows(rows, bands):
+    """
+    將 0..rows 的frame列分成最多bands個連續的 [row_start, row_end)
+    """
+    bands = max(1, min(bands, rows))
+    return [(rows * i // bands, rows * (i + 1) // bands) for i in range(bands)]
+
+
+class shard_writer():
+    """
+    一個band的shard，add()的順序可以任意，依frame順序寫出(未到的frame先暫存)
+    """
+
+    def __init__(self, path, row_start, row_end, columns) -> None:
+        self.path = path
+        self.row_start = row_start
+        self.row_end = row_end
+        self.columns = columns
+        self.frame_count = (row_end - row_start) * columns
+        self.next_frame = 0
+        self.waiting = {}
+        self.offsets = []
+        self.lengths = []
+        self.size = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(f"{path}.frames.tmp", "wb")
+        pass
+
+    def add(self, row, col, data):
+        self.waiting[(row - self.row_start) * self.columns + col] = data
+        while self.next_frame in self.waiting:
+            self.write_item(self.waiting.pop(self.next_frame))
+            self.next_frame += 1
+
+    def write_item(self, data):
+        if len(data) % 2:
+            data += b'\x00'
+        self.offsets.append(self.size)
+        self.lengths.append(len(data))
+        self.file.write(ITEM_TAG + struct.pack('<I', len(data)))
+        self.file.write(data)
+        self.size += 8 + len(data)
+
+    def close(self):
+        self.file.close()
+        if self.next_frame != self.frame_count:
+            raise ValueError(f"Shard {self.path} has {self.next_frame}/{self.frame_count} frames")
+        os.replace(f"{self.path}.frames.tmp", f"{self.path}.frames")
+        index = {
+            "row_start": self.row_start,
+            "row_end": self.row_end,
+            "columns": self.columns,
+            "size": self.size,
+            "offsets": self.offsets,
+            "lengths": self.lengths,
+        }
+        with open(f"{self.path}.json.tmp", "w", encoding="utf-8") as file:
+            json.dump(index, file)
+        os.replace(f"{self.path}.json.tmp", f"{self.path}.json")
+
+
+def encode_band(frames, writer, encoder, settings, max_workers=None, ring=None):
+    """
+    在thread pool內編碼一個band的frame並寫入shard，有ring (tile_ring) 時改由encoder process編碼
+
+    Args:
+        frames: (row, col, RGB陣列) 的iterable
+        writer: shard_writer
+        encoder: encoder(pixels) -> bytes
+        settings: 編碼設定 (背景frame快取的key)
+    """
+    if ring is not None:
+        for row, col, data in ring.encode(frames, settings):
+            writer.add(row, col, data)
+        writer.close()
+        return
+
+    max_workers = max_workers or cpu_count()
+
+    def encode(row, col, pixels):
+        return row, col, frame_cache.encode(np.ascontiguousarray(pixels), settings, encoder)
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for row, col, pixels in frames:
+            pending.add(executor.submit(encode, row, col, pixels))
+            if len(pending) >= max_workers * 4:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    writer.add(*job.result())
+        for job in futures.as_completed(pending):
+            writer.add(*job.result())
+    writer.close()
+
+
+def read_shard_index(path):
+    with open(f"{path}.json", "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def merge_shards(shard_paths, ds, output_file, rows):
+    """
+    依序串接shard成為一個DICOM檔案
+
+    Args:
+        shard_paths: 各band的shard路徑 (不含副檔名)
+        ds: 不含Pixel Data的dataset (header)，NumberOfFrames與Extended Offset Table由此設定
+        output_file: 輸出的DICOM檔案
+        rows: 該層frame的列數，用來確認band涵蓋整層
+    """
+    indexes = sorted(((read_shard_index(path), path) for path in shard_paths), key=lambda item: item[0]["row_start"])
+    expected_row = 0
+    for index, path in indexes:
+        if index["row_start"] != expected_row:
+            raise ValueError(f"Missing frame rows {expected_row}..{index['row_start']} before {path}")
+        expected_row = index["row_end"]
+    if expected_row != rows:
+        raise ValueError(f"Missing frame rows {expected_row}..{rows}")
+
+    # 各shard的本地offset加上前面shard的總大小
+    offsets, lengths, base = [], [], 0
+    for index, _ in indexes:
+        offsets.extend(base + offset for offset in index["offsets"])
+        lengths.extend(index["lengths"])
+        base += index["size"]
+
+    ds.NumberOfFrames = len(offsets)
+    ds.ExtendedOffsetTable = struct.pack(f'<{len(offsets)}Q', *offsets)
+    ds.ExtendedOffsetTableLengths = struct.pack(f'<{len(lengths)}Q', *lengths)
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    ds.save_as(f"{output_file}.tmp", write_like_original=False)
+
+    with open(f"{output_file}.tmp", "ab") as target:
+        target.write(PIXEL_DATA_HEADER)
+        for _, path in indexes:
+            with open(f"{path}.frames", "rb") as source:
+                shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        target.write(SEQUENCE_DELIMITER)
+    os.replace(f"{output_file}.tmp", output_file)
+
+
+def remove_shards(shard_paths):
+    for path in shard_paths:
+        for suffix in (".frames", ".json"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
@@ -26,6 +26,8 @@ class iSyntax2Dcm(Singleton):
 
     # sdk的pixel engine，只能初始化一次並且需重複使用。
     pixel_engine:PixelEngine = None
+    # sdk要使用哪個圖形api解出png圖片: SOFTWARE, GLES2, GLES3 或 AUTO(有GL時用GPU，否則SOFTWARE)
+    render_backend = "AUTO"
     tile_size = [1024,1024]
     tmp_folder = ""
     def __init__(self):
@@ -35,10 +37,7 @@ class iSyntax2Dcm(Singleton):
             # 初始化sdk
             backends = Backends()
 
-            # sdk要使用哪個圖形api解出png圖片
-            #render_backend, render_context = backends.initialize_backend("SOFTWARE")
-            render_backend, render_context = backends.initialize_backend("GLES2")
-            #render_backend, render_context = backends.initialize_backend("GLES3")
+            render_backend, render_context = backends.initialize_backend(self.render_backend)
 
             self.pixel_engine = PixelEngine(render_backend, render_context)
 
@@ -90,7 +89,7 @@ class iSyntax2Dcm(Singleton):
                     #update_signal.emit(0)
                     file_info.output_folder = f"{raw_outputFolder}/{i}/"
                     os.makedirs(file_info.output_folder, exist_ok=True)
-                    imgs2dcm(tmp_folder, file_info, "png", update_signal)
+                    imgs2dcm(tmp_folder, file_info, "png", update_signal, level=i)
                     file_info.convert_status = f"已完成({output_file}_{i})"
                     #update_signal.emit(0)
                 pass
@@ -0,0 +1,114 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Render backend benchmark
+Times how many regions per second each available PixelEngine backend delivers
+for the same iSyntax file, level and tile size.
+To execute this program pass the path of the iSyntax image file as command line argument.
+Eg:
+    python -m api.iSyntax.sdk.backend_benchmark "<PATH_OF_ISYNTAX_FILE>" -l 1 -n 200
+Dependencies:
+    Pip modules: numpy
+"""
+
+from __future__ import absolute_import
+import time
+import argparse
+import traceback
+import numpy as np
+from pixelengine import PixelEngine
+from api.iSyntax.sdk.backends import Backends
+from api.iSyntax.sdk.region_tracker import RegionTracker
+
+
+def benchmark_backend(backends, backend_name, input_file, level, tile_size, max_regions):
+    """
+    Time region extraction with one backend
+    :param backends: Backends object
+    :param backend_name: SOFTWARE, GLES2 or GLES3
+    :param input_file: iSyntax file
+    :param level: Level to read
+    :param tile_size: Output patch size [width, height] in pixels of the level
+    :param max_regions: Number of regions to request
+    :return: (number of regions, seconds)
+    """
+    render_backend, render_context = backends.initialize_backend(backend_name)
+    pixel_engine = PixelEngine(render_backend, render_context)
+    pe_input = pixel_engine["in"]
+    pe_input.open(input_file)
+    try:
+        view = pe_input["WSI"].source_view
+        x_range, y_range = view.dimension_ranges(level)[0], view.dimension_ranges(level)[1]
+        step_x, step_y = x_range[1], y_range[1]
+        width, height = tile_size[0] * step_x, tile_size[1] * step_y
+
+        patches = []
+        for y_start in range(y_range[0], y_range[2], height):
+            for x_start in range(x_range[0], x_range[2], width):
+                patches.append([x_start, x_start + width - step_x,
+                                y_start, y_start + height - step_y, level])
+                if len(patches) >= max_regions:
+                    break
+            if len(patches) >= max_regions:
+                break
+
+        start = time.perf_counter()
+        regions = view.request_regions(patches, view.data_envelopes(level), True, [254, 254, 254])
+        tracker = RegionTracker(regions)
+        pixels = np.empty(tile_size[0] * tile_size[1] * 3, dtype=np.uint8)
+        while len(tracker) > 0:
+            for region in pixel_engine.wait_any():
+                if tracker.complete(region):
+                    region.get(pixels)
+        return len(patches), time.perf_counter() - start
+    finally:
+        pe_input.close()
+
+
+def benchmark_backends(input_file, level=1, tile_size=(1024, 1024), max_regions=200, names=None, backends=None):
+    """
+    Time region extraction for every available backend
+    :param input_file: iSyntax file
+    :param level: Level to read
+    :param tile_size: Output patch size in pixels of the level
+    :param max_regions: Number of regions to request per backend
+    :param names: Backend names to try, defaults to all importable backends
+    :param backends: Backends to reuse across files, a new one when not given
+    :return: {backend name: regions per second}, failed backends are left out
+    """
+    backends = backends or Backends()
+    results = {}
+    for name in names or backends.names():
+        try:
+            count, seconds = benchmark_backend(backends, name, input_file, level,
+                                               list(tile_size), max_regions)
+        except Exception:  # pylint: disable=broad-except
+            print("Backend {} failed:".format(name))
+            traceback.print_exc()
+            continue
+        results[name] = count / seconds if seconds > 0 else float("inf")
+        print("{:<10} {:>6} regions in {:>8.2f} s  {:>8.2f} regions/s".format(
+            name, count, seconds, results[name]))
+    return results
+
+
+def main():
+    """
+    Main
+    :return: Prints regions/second per backend
+    """
+    parser = argparse.ArgumentParser(description="Benchmark PixelEngine render backends")
+    parser.add_argument("input", help="iSyntax file")
+    parser.add_argument("-l", "--level", type=int, default=1, help="level to read")
+    parser.add_argument("-t", "--tile_size", type=int, default=1024, help="patch size in pixels")
+    parser.add_argument("-n", "--regions", type=int, default=200, help="regions per backend")
+    parser.add_argument("-b", "--backend", nargs="*", choices=["SOFTWARE", "GLES2", "GLES3"],
+                        help="backends to benchmark, default all available")
+    args = parser.parse_args()
+    benchmark_backends(args.input, args.level, (args.tile_size, args.tile_size),
+                       args.regions, args.backend)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,7 +29,9 @@
 Backend Selection file
 """
 from __future__ import absolute_import
+import os
 import sys
+import glob
 
 
 # pylint: disable = too-few-public-methods
@@ -70,10 +72,9 @@ class Backends:
         valid_backends = []
         for backend in self.backends:
             try:
-                if backend.context not in sys.modules:
-                    context_lib = __import__(backend.context)
-                if backend.backend not in sys.modules:
-                    backend_lib = __import__(backend.backend)
+                # modules imported by an earlier Backends() are taken from sys.modules
+                context_lib = sys.modules.get(backend.context) or __import__(backend.context)
+                backend_lib = sys.modules.get(backend.backend) or __import__(backend.backend)
             except ImportError:
                 pass
             else:
@@ -83,10 +84,58 @@ class Backends:
 
         self.backends = valid_backends
 
+    # Order in which AUTO tries the available backends, the GPU ones first
+    AUTO_ORDER = ['GLES2', 'GLES3', 'SOFTWARE']
+
+    def names(self):
+        """
+        Names of the backends whose libraries could be imported
+        """
+        return [x.name for x in self.backends]
+
     def initialize_backend(self, backend):
         """
         Method to initialize backend
+        :param backend: SOFTWARE, GLES2, GLES3 or AUTO
         """
+        if backend == 'AUTO':
+            _, render_backend, render_context = self.initialize_auto_backend()
+            return render_backend, render_context
         render_backend = [x.backend for x in self.backends if x.name == backend][0]()
         render_context = [x.context for x in self.backends if x.name == backend][0]()
         return render_backend, render_context
+
+    def initialize_auto_backend(self):
+        """
+        Initialize the first usable backend of AUTO_ORDER.
+        GL backends are skipped without trying them when no GL device is reachable,
+        and a GL backend whose context cannot be created falls back to the next one.
+        :return: name, render_backend, render_context
+        """
+        gl_available = gl_device_available()
+        for name in self.AUTO_ORDER:
+            if name not in self.names():
+                continue
+            if name != 'SOFTWARE' and not gl_available:
+                continue
+            try:
+                render_backend, render_context = self.initialize_backend(name)
+            except Exception as e:  # pylint: disable=broad-except
+                print("Render backend {} unavailable: {}".format(name, e))
+                continue
+            print("Using render backend {}".format(name))
+            return name, render_backend, render_context
+        raise RuntimeError("No usable render backend found")
+
+
+def gl_device_available():
+    """
+    Cheap check whether an EGL context has a chance to be created.
+    On Linux this needs a display server or a DRM render node, on other platforms we just try.
+    :return: True or False
+    """
+    if not sys.platform.startswith('linux'):
+        return True
+    if os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'):
+        return True
+    return len(glob.glob('/dev/dri/renderD*')) > 0
@@ -40,6 +40,8 @@ import traceback
 from concurrent import futures
 from multiprocessing import cpu_count
 from api.imgfile_info import imgfile_info
+from api.iSyntax.sdk.region_tracker import RegionTracker, BoundedJobs
+from api.tile_record import tile_record
 import numpy as np
 from PIL import Image
 from PySide6.QtCore import Signal
@@ -59,7 +61,7 @@ def write_image(pixels, patch_width, patch_height, file_name, image_name):
         # Replace RGB with RGBA for aplha channel
         image = Image.frombuffer('RGB', (int(patch_width), int(patch_height)), pixels, 'raw',
                                  'RGB', 0, 1)
-        image.save("." + os.path.sep + image_name + os.path.sep + str(file_name))
+        image.save(os.path.join(".", image_name, str(file_name)))
         #print("Patch(es) Successfully Generated")
     except RuntimeError:
         traceback.print_exc()
@@ -91,7 +93,7 @@ def get_patch_properties(region, view, isyntax_file_name):
     return patch_width, patch_height, file_name
 
 
-def extract_pixel_data(view, regions, pixel_engine, image_name, isyntax_file_name, file_info:imgfile_info, update_signal:Signal):
+def extract_pixel_data(view, regions, pixel_engine, image_name, isyntax_file_name, file_info:imgfile_info, update_signal:Signal, grid=None, max_workers=None):
     """
     Extracting patches from source view
     :param view: source view object
@@ -99,17 +101,24 @@ def extract_pixel_data(view, regions, pixel_engine, image_name, isyntax_file_nam
     :param pixel_engine: Object of pixel engine
     :param image_name: Output Image name
     :param isyntax_file_name: iSyntax Image Name
-    :return: None
+    :param grid: Optional tile_grid of the requested patches. When given, every patch is
+                 indexed once as (level, row, col) from region.range and named by that index
+    :param max_workers: Threads writing the patches, cpu_count() when not given
+    :return: tile_record list (empty without grid)
     """
+    tiles = []
     try:
 
         # Employing worker threads to demonstrate parallel processing can be employed
         # as and when the patches are returned by the PixelEngine
-        jobs = ()
-        remaining_regions = len(regions)
+        # Outstanding regions are tracked by region.range so that consuming a region is O(1),
+        # and the number of in-flight write jobs (and pixel buffers) is bounded
+        tracker = RegionTracker(regions)
+        max_workers = max_workers or cpu_count()
 
-        with futures.ThreadPoolExecutor(max_workers=cpu_count()) as executor:
-            while remaining_regions > 0:
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            jobs = BoundedJobs(executor, max_workers * 4)
+            while len(tracker) > 0:
                 #print("Requesting regions batch")
                 # This call returns the list of available patches
                 # The SDK employs parallelism to prepare these patches (get Pixel data)
@@ -120,25 +129,30 @@ def extract_pixel_data(view, regions, pixel_engine, image_name, isyntax_file_nam
                 # wait_any() call. In case of multiple files the wait_any(regions) is suggested
                 regions_ready = pixel_engine.wait_any()
                 #print("Regions returned = " + str(len(regions_ready)))
-                remaining_regions -= len(regions_ready)
                 for region in regions_ready:
+                    # mark the patch as consumed to ensure we aren't duplicating read
+                    # of  patches and the loop does terminate when all the patches are consumed.
+                    if not tracker.complete(region):
+                        continue
                     patch_width, patch_height, file_name = get_patch_properties(region, view,
                                                                                 isyntax_file_name)
+                    if grid is not None:
+                        level, row, col = grid.index(region.range)
+                        file_name = "{}_{}.png".format(row, col)
+                        tiles.append(tile_record(level, row, col, os.path.join(image_name, file_name)))
                     # Calculate patch image size for writting to disk
                     # 3 is samples per pixels for RGB
                     # 4 is samples per pixels for RGBA
                     pixel_buffer_size = patch_width * patch_height * 3
                     pixels = np.empty(int(pixel_buffer_size), dtype=np.uint8)
                     region.get(pixels)
-                    # remove the patch from the region list to ensure we aren't duplicating read
-                    # of  patches and the loop does terminate when all the patches are consumed.
-                    regions.remove(region)
                     # Submitting to Job Thread for writing patches to disk
                     # print(f"{isyntax_file_name}|Generate Image File:{file_name}")
-                    file_info.convert_status = f"讀取圖片(剩下{len(regions)}張)"
+                    file_info.convert_status = f"讀取圖片(剩下{len(tracker)}張)"
                     # update_signal.emit(0)
-                    jobs = jobs + (executor.submit(write_image, pixels, patch_width, patch_height,
-                                                   file_name, image_name),)
-        futures.wait(jobs, return_when=futures.ALL_COMPLETED)
+                    jobs.submit(write_image, pixels, patch_width, patch_height,
+                                file_name, image_name)
+            jobs.wait()
     except RuntimeError:
         traceback.print_exc()
+    return tiles
@@ -163,13 +163,16 @@ def tiff_tile_processor(pixel_engine, level, patches,
     # requesting the patches incrementally, one by one or in small batches.
     regions = view.request_regions(patches, data_envelopes, True, [255, 0, 0],
                                    pixel_engine.BufferType(0))
+    # Map every requested range to its spatial identity once, so each returned region
+    # is located with a dict lookup instead of a regions.index() scan
+    patch_ids = {tuple(patch): patch_id for patch, patch_id in zip(patches, patch_identifier)}
     remaining_regions = len(regions)
     while remaining_regions > 0:
         regions_ready = pixel_engine.wait_any()
         remaining_regions -= len(regions_ready)
         for region in regions_ready:
-            # Find the index of obtained Region in Original PatchList
-            patch_id = patch_identifier[regions.index(region)]
+            # Find the spatial identity of obtained Region in Original PatchList
+            patch_id = patch_ids.pop(tuple(region.range))
             x_spatial = patch_id[0]
             y_spatial = patch_id[1]
             patch = np.empty(int(patch_data_size)).astype(np.uint8)
@@ -179,8 +182,6 @@ def tiff_tile_processor(pixel_engine, level, patches,
             y_value = y_spatial * TIFF_TILE_HEIGHT
             write_tiff_tile(tiff_file_handle, [x_value, y_value], level, sparse,
                             patch.ctypes.data, patch_data_size, bb_list, region)
-            regions.remove(region)
-            patch_identifier.remove(patch_id)
 
 
 def calculate_tiff_dimensions(view, start_level):
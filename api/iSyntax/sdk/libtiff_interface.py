@@ -35,6 +35,7 @@ from __future__ import absolute_import
 from __future__ import division
 import sys
 import ctypes
+import ctypes.util
 import subprocess
 
 
@@ -44,9 +45,12 @@ def load_libtiff_library():
     """
     # Specify the name and path for the libtiff (.dll/.so) accordingly.
     # Change this path according to your Operating System(OS)
-    lib_tiff = ''
+    lib_tiff = None
     if "win" in sys.platform:
         lib_tiff = ctypes.cdll.LoadLibrary(r'libtiff-5.dll')
+    elif ctypes.util.find_library('tiff'):
+        # Any libtiff on the loader path (e.g. Debian/Ubuntu without lsb_release, containers)
+        lib_tiff = ctypes.cdll.LoadLibrary(ctypes.util.find_library('tiff'))
     elif "CentOS" in subprocess.check_output(["lsb_release", "-is"]).decode("utf-8"):
         lib_tiff = ctypes.cdll.LoadLibrary('/usr/lib64/libtiff.so.5')
     elif "Ubuntu" in subprocess.check_output(["lsb_release", "-is"]).decode("utf-8"):
@@ -197,6 +201,16 @@ class TIFF(ctypes.c_void_p):
         return LIBTIFF.TIFFWriteEncodedTile(self, self.compute_tile(offset[0], offset[1],
                                                                     level, 0), data, data_size)
 
+    def write_raw_tile(self, offset, data):
+        """
+        Write an already compressed tile (e.g. a JPEG stream) without passing it through libtiff's codec
+        :param offset: [x, y] pixel position of the tile in the current directory
+        :param data: Compressed tile bytes
+        :return: Number of bytes written, -1 on error
+        """
+        return LIBTIFF.TIFFWriteRawTile(self, self.compute_tile(offset[0], offset[1], 0, 0),
+                                        data, len(data))
+
     def set_attribute(self, key, value):
         """
         Set Tiff file attributes
@@ -216,16 +230,31 @@ class TIFF(ctypes.c_void_p):
         :return: None
         """
         level_scale_factor = 2 ** level
+        self.set_level_attributes(int(tiff_dim[0] / level_scale_factor),
+                                  int(tiff_dim[1] / level_scale_factor),
+                                  level > start_level)
+
+    def set_level_attributes(self, width, height, reduced,
+                             tile_size=(TIFF_TILE_WIDTH, TIFF_TILE_HEIGHT)):
+        """
+        Setting the attributes of one pyramid directory with explicit dimensions,
+        so that pyramids whose levels are not exactly 2x apart can be written too
+        :param width: Image width of this directory
+        :param height: Image height of this directory
+        :param reduced: True for every directory but the full resolution one
+        :param tile_size: [width, height] of a tile, multiples of 16
+        :return: None
+        """
         # For subdirectories corresponding to the multi-resolution pyramid, set the following
         # Tag for all levels but the initial level
-        if level > start_level:
+        if reduced:
             self.set_attribute(TIFFTAG_SUBFILETYPE, FILETYPE_REDUCEDIMAGE)
 
         # Setting TIFF file attributes
-        self.set_attribute(TIFFTAG_IMAGEWIDTH, int(tiff_dim[0] / level_scale_factor))
-        self.set_attribute(TIFFTAG_IMAGELENGTH, int(tiff_dim[1] / level_scale_factor))
-        self.set_attribute(TIFFTAG_TILEWIDTH, TIFF_TILE_WIDTH)
-        self.set_attribute(TIFFTAG_TILELENGTH, TIFF_TILE_HEIGHT)
+        self.set_attribute(TIFFTAG_IMAGEWIDTH, int(width))
+        self.set_attribute(TIFFTAG_IMAGELENGTH, int(height))
+        self.set_attribute(TIFFTAG_TILEWIDTH, int(tile_size[0]))
+        self.set_attribute(TIFFTAG_TILELENGTH, int(tile_size[1]))
         self.set_attribute(TIFFTAG_BITSPERSAMPLE, BITSPERSAMPLE)
         self.set_attribute(TIFFTAG_SAMPLESPERPIXEL, SAMPLESPERPIXEL)
         self.set_attribute(TIFFTAG_PLANARCONFIG, PLANARCONFIG)
@@ -253,6 +282,11 @@ LIBTIFF.TIFFWriteTile.argtypes = [TIFF, ctypes.c_void_p, ctypes.c_uint32, ctypes
                                   ctypes.c_uint32, ctypes.c_uint16]
 LIBTIFF.TIFFWriteEncodedTile.restype = ctypes.c_int32
 LIBTIFF.TIFFWriteEncodedTile.argtypes = [TIFF, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_int32]
+LIBTIFF.TIFFWriteRawTile.restype = ctypes.c_ssize_t
+LIBTIFF.TIFFWriteRawTile.argtypes = [TIFF, ctypes.c_uint32, ctypes.c_char_p, ctypes.c_ssize_t]
+LIBTIFF.TIFFComputeTile.restype = ctypes.c_uint32
+LIBTIFF.TIFFComputeTile.argtypes = [TIFF, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32,
+                                    ctypes.c_uint16]
 
 LIBTIFF.TIFFClose.restype = None
 LIBTIFF.TIFFClose.argtypes = [TIFF]
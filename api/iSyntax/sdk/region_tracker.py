@@ -0,0 +1,187 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Region bookkeeping for extract_pixel_data.
+Keeps the outstanding regions of one level in a dict keyed by region.range,
+so marking a region as done is O(1) instead of a list.remove() scan.
+Run this file directly for a microbenchmark against the list based bookkeeping:
+    python region_tracker.py [-n 25000 50000 100000 200000]
+Dependencies:
+    None
+"""
+
+from __future__ import absolute_import
+import time
+import argparse
+from concurrent import futures
+
+
+class RegionTracker:
+    """
+    Tracks the regions of one request_regions() call until they are consumed
+    """
+
+    def __init__(self, regions):
+        """
+        Constructor
+        :param regions: Requested Regions
+        """
+        self._pending = {region_key(region): region for region in regions}
+
+    def __len__(self):
+        """
+        Number of regions not consumed yet
+        """
+        return len(self._pending)
+
+    def complete(self, region):
+        """
+        Mark a region as consumed
+        :param region: Region returned by wait_any()
+        :return: True the first time a region is completed, False for duplicates
+        """
+        return self._pending.pop(region_key(region), None) is not None
+
+
+class BoundedJobs:
+    """
+    List of in-flight futures that never grows beyond max_jobs.
+    Submitting blocks until a slot is free, which also bounds the pixel buffers in memory.
+    """
+
+    def __init__(self, executor, max_jobs):
+        """
+        Constructor
+        :param executor: Executor the jobs are submitted to
+        :param max_jobs: Maximum number of futures kept in flight
+        """
+        self._executor = executor
+        self._max_jobs = max(1, int(max_jobs))
+        self._jobs = []
+
+    def submit(self, func, *args):
+        """
+        Submit a job, waiting for a free slot first
+        :return: Future of the job
+        """
+        if len(self._jobs) >= self._max_jobs:
+            _, not_done = futures.wait(self._jobs, return_when=futures.FIRST_COMPLETED)
+            self._jobs = list(not_done)
+        job = self._executor.submit(func, *args)
+        self._jobs.append(job)
+        return job
+
+    def wait(self):
+        """
+        Wait for all remaining jobs
+        :return: None
+        """
+        futures.wait(self._jobs, return_when=futures.ALL_COMPLETED)
+        self._jobs = []
+
+
+def region_key(region):
+    """
+    Hashable key of a region
+    :param region: Region or anything with a range attribute
+    :return: (x_start, x_end, y_start, y_end, level)
+    """
+    return tuple(region.range)
+
+
+class _FakeRegion:
+    """
+    Stand-in for a PixelEngine region, only carries the range
+    """
+    __slots__ = ("range",)
+
+    def __init__(self, view_range):
+        self.range = view_range
+
+
+def _fake_regions(count, tile_size=1024):
+    """
+    Create count regions laid out on a square-ish grid
+    """
+    columns = max(1, int(count ** 0.5))
+    regions = []
+    for index in range(count):
+        x_start = (index % columns) * tile_size
+        y_start = (index // columns) * tile_size
+        regions.append(_FakeRegion([x_start, x_start + tile_size - 1,
+                                    y_start, y_start + tile_size - 1, 0]))
+    return regions
+
+
+def _ready_batches(regions, batch_size=64):
+    """
+    Simulate wait_any(), which returns regions in batches and out of order
+    """
+    order = regions[::-1]
+    for start in range(0, len(order), batch_size):
+        yield order[start:start + batch_size]
+
+
+def _noop():
+    return None
+
+
+def benchmark_list(count):
+    """
+    Old bookkeeping: regions.remove() and rebuilding the jobs tuple
+    """
+    regions = _fake_regions(count)
+    batches = list(_ready_batches(regions))
+    jobs = ()
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        start = time.perf_counter()
+        for batch in batches:
+            for region in batch:
+                regions.remove(region)
+                jobs = jobs + (executor.submit(_noop),)
+        futures.wait(jobs, return_when=futures.ALL_COMPLETED)
+        return time.perf_counter() - start
+
+
+def benchmark_tracker(count, max_jobs=16):
+    """
+    New bookkeeping: RegionTracker and BoundedJobs
+    """
+    regions = _fake_regions(count)
+    batches = list(_ready_batches(regions))
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        start = time.perf_counter()
+        tracker = RegionTracker(regions)
+        jobs = BoundedJobs(executor, max_jobs)
+        for batch in batches:
+            for region in batch:
+                tracker.complete(region)
+                jobs.submit(_noop)
+        jobs.wait()
+        return time.perf_counter() - start
+
+
+def main():
+    """
+    Main
+    :return: Prints time per region for both bookkeeping strategies
+    """
+    parser = argparse.ArgumentParser(description="Region bookkeeping microbenchmark")
+    parser.add_argument("-n", "--counts", nargs="+", type=int,
+                        default=[25000, 50000, 100000, 200000], help="number of regions")
+    parser.add_argument("--skip-list", action="store_true",
+                        help="only run the tracker (the list version is quadratic)")
+    args = parser.parse_args()
+
+    print("{:>10} {:>12} {:>14} {:>12} {:>14}".format(
+        "regions", "list (s)", "list (us/reg)", "tracker (s)", "tracker (us/reg)"))
+    for count in args.counts:
+        list_time = float("nan") if args.skip_list else benchmark_list(count)
+        tracker_time = benchmark_tracker(count)
+        print("{:>10} {:>12.3f} {:>14.2f} {:>12.3f} {:>14.2f}".format(
+            count, list_time, list_time / count * 1e6, tracker_time, tracker_time / count * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,12 @@ class imgfile_info():
     convert_status:str = "尚未開始"
     output_folder:str = ""
     output_filename:str = ""
+    # UID的種子: 空字串時每次轉換隨機產生；使用source_fingerprint()時重新轉換會得到相同的UID
+    uid_seed:str = ""
+    # True時SOPInstanceUID也由種子決定 (--deterministic-uids)，否則每個instance隨機產生
+    deterministic_uids:bool = False
+    # 多個worker分工時為lease的lost (threading.Event)，設定後停止轉換，不寫出這一層的DICOM檔
+    stop_event = None
 
     def __init__(self, i_file, m_file, o_folder, o_filename) -> None:
         self.input_file = i_file
@@ -4,7 +4,10 @@ import re
 import gc
 import copy
 import string
+import hashlib
 from api.imgfile_info import imgfile_info
+from api.tile_record import tile_record, order_tiles
+from api.uniform_frames import frame_cache
 import numpy as np
 from openpyxl import load_workbook
 
@@ -56,22 +59,71 @@ def parse_tag_file(tag_file):
                     tags[tag_name] = tag_value
     return tags
 
-def generate_random_string(length=8):
+def generate_random_string(length=8, rng=random):
     characters = string.ascii_uppercase + string.digits
-    random_string = ''.join(random.choice(characters) for _ in range(length))
+    random_string = ''.join(rng.choice(characters) for _ in range(length))
     return random_string
 
-def dataset_from_tag_file(tag_file, level=-1):
+# 影響Pixel Data內容的編碼設定，會加入SOPInstanceUID的計算 (設定不同就是不同的instance)
+ENCODER_SETTINGS = "PIL JPEG2000 lossless"
+# 計算來源檔案指紋時讀取的頭尾大小
+FINGERPRINT_CHUNK_SIZE = 1024 * 1024
+
+def source_fingerprint(input_file):
+    """
+    由來源檔案內容產生指紋，作為固定UID的種子。
+    只讀取檔案大小與頭尾各FINGERPRINT_CHUNK_SIZE，數GB的檔案也能很快完成；不使用路徑及修改時間，複製或搬移檔案後仍相同。
+
+    Args:
+        input_file: 原始WSI檔案
+    Returns:
+        fingerprint: sha256 hex字串
+    """
+    size = os.path.getsize(input_file)
+    sha = hashlib.sha256()
+    sha.update(str(size).encode())
+    with open(input_file, 'rb') as file:
+        sha.update(file.read(FINGERPRINT_CHUNK_SIZE))
+        if size > FINGERPRINT_CHUNK_SIZE:
+            file.seek(max(FINGERPRINT_CHUNK_SIZE, size - FINGERPRINT_CHUNK_SIZE))
+            sha.update(file.read(FINGERPRINT_CHUNK_SIZE))
+    return sha.hexdigest()
+
+def dataset_from_tag_file(tag_file, level=-1, uid_seed="", study_uid="", series_uid="", instance_key="", deterministic=False, frame_size=None):
     """
         解析tag文字檔並產生dataset。
         
         Args:
             tag_file: tag檔案的路徑
+            level: 這個instance的level
+            uid_seed: 有提供時Study/Series UID只由種子決定(同一個slide的所有level在同一個series)，PatientID等預設值也固定
+            deterministic: True時SOPInstanceUID也由種子、level、frame大小與編碼設定決定，重新轉換會得到相同的檔案；
+                           False時每個instance的SOPInstanceUID隨機產生
+            study_uid, series_uid: 有提供時取代產生的預設UID (例如重新發行時沿用原本的study/series)，tag檔有指定時仍以tag檔為準
+            instance_key: 區分同一level的多個instance (例如各個ROI)，有種子時也加入SOPInstanceUID的計算
+            frame_size: (Columns, Rows)，不同tile大小的轉換結果是不同的instance
         Returns:
             ds: dataset
     """
 
-    instance_uid = generate_uid()
+    # 沒有種子時每個uid及預設值都是隨機的
+    if uid_seed:
+        rng = random.Random(uid_seed)
+        default_study_uid = generate_uid(entropy_srcs=[uid_seed, "study"])
+        default_series_uid = generate_uid(entropy_srcs=[uid_seed, "series"])
+        if deterministic:
+            instance_uid = generate_uid(entropy_srcs=[uid_seed, "instance", str(level), ENCODER_SETTINGS, JPEG2000Lossless]
+                                        + ([f"{frame_size[0]}x{frame_size[1]}"] if frame_size else [])
+                                        + ([instance_key] if instance_key else []))
+        else:
+            instance_uid = generate_uid()
+    else:
+        rng = random
+        default_study_uid = generate_uid()
+        default_series_uid = generate_uid()
+        instance_uid = generate_uid()
+    study_uid = study_uid or default_study_uid
+    series_uid = series_uid or default_series_uid
 
     # 創建一個空的DICOM Dataset
     file_meta = FileMetaDataset()
@@ -93,12 +145,12 @@ def dataset_from_tag_file(tag_file, level=-1):
     ds.is_implicit_VR = False
 
     # 為了避免讀取不到資料，先將必要欄位填上預設隨機產生的值。
-    ds.StudyInstanceUID = generate_uid() 
-    ds.SeriesInstanceUID = generate_uid()
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
     ds.SOPClassUID = VLWholeSlideMicroscopyImageStorage # VL Whole Slide Microscopy Image Storage (WSI)
     ds.SOPInstanceUID =  file_meta.MediaStorageSOPInstanceUID
-    ds.PatientID =  f'Patient{generate_random_string(8)}'
-    ds.AccessionNumber = generate_random_string(8)
+    ds.PatientID =  f'Patient{generate_random_string(8, rng)}'
+    ds.AccessionNumber = generate_random_string(8, rng)
     ds.Modality = 'SM'
     ds.PatientName = 'Anonymous'
     ds.PatientSex = 'M'
@@ -169,90 +221,130 @@ def dataset_from_tag_file(tag_file, level=-1):
 
     return ds
 
-def imgs2dcm(input_folder, file_info:imgfile_info, file_ext, update_signal:Signal, level=-1):
+def tile_records_from_folder(input_folder, file_ext):
+    """
+        從資料夾內依照命名規則的圖檔產生tile_record list (只在沒有提供tiles時使用)。
+        命名規則: layer_{level}_region_{y_index}_{x_index}.{file_ext}
+    """
+    tiles = []
+    for file in os.listdir(input_folder):
+        if file.endswith(file_ext):
+            parts = file[:-4].split('_')
+            tiles.append(tile_record(level=-1, row=int(parts[-2]), col=int(parts[-1]), file_path=os.path.join(input_folder, file)))
+    return tiles
+
+def encode_jpeg2000(pixels):
+    """
+    將一個RGB frame壓縮成JPEG2000 lossless
+    """
+    image_str_buf = BytesIO()
+    Image.fromarray(pixels).save(image_str_buf, format="JPEG2000", progressive=False) # 儲存為JPEG (JPEG2000 PIL 儲存有問題)
+    return image_str_buf.getvalue()
+
+
+def check_stop(file_info:imgfile_info):
     """
-        將一堆png依照命名規則的圖檔，加上文字檔的tag，生成multiframe DICOM WSI。
-        命名規則: layer_{level}_region_{x_index}_{y_index}.png
+    lease遺失時(其他worker已經接手這個slide)停止轉換
+    """
+    if file_info.stop_event is not None and file_info.stop_event.is_set():
+        raise RuntimeError(f"Lease lost, conversion stopped: {file_info.input_file}")
+
+
+def imgs2dcm(input_folder, file_info:imgfile_info, file_ext, update_signal:Signal, level=-1, tiles=None, zarr_writer=None, sink=None, origin=None, instance_key="", ring=None, level_size=None, downsample=None):
+    """
+        將一堆圖塊，加上文字檔的tag，生成multiframe DICOM WSI。
+        有提供tiles時直接使用每個tile_record的(row, col)排列frame；
+        否則讀取input_folder內依照命名規則的圖檔: layer_{level}_region_{y_index}_{x_index}.png
         Args:
             input_folder: 輸入圖檔的文件夾
             output_file: 輸出的DICOM文件路徑
             tag_file: 標籤檔案的路徑
             file_ext: 圖檔的副檔名 (png or jpg)
+            tiles: tile_record list
+            zarr_writer: zarr_pyramid，有提供時同一次讀取的frame也寫入OME-Zarr的第level層
+            sink: stow_sink等，有提供時DICOM寫完後立即submit(路徑)上傳，與下一層的轉換同時進行
+            origin: (x, y) 圖塊左上角在slide座標系的位置(mm)，只轉換ROI時設定TotalPixelMatrixOriginSequence，None為(0, 0)
+            instance_key: 傳給dataset_from_tag_file，區分同一level的多個ROI instance
+            ring: tile_ring，有提供時frame交給encoder process編碼，讀取下一張圖檔與編碼同時進行
+            level_size: (width, height) 該層(只轉換ROI時為ROI在該層)實際的大小，給TotalPixelMatrixColumns/Rows與OME-Zarr的array大小；
+                        None時為frame補滿後的大小
+            downsample: 該層相對於第0層的縮放倍率，寫入OME-Zarr的scale
     """
-    # print(f"{file_info.output_folder[:1]}/{file_info.output_filename}|Generating Tags")
-    # 從tag_file取得tag資料並產生dataset
-    ds = dataset_from_tag_file(file_info.metadata_file)
-
     # print(f"{file_info.output_folder[:1]}/{file_info.output_filename}|Reading Image Files")
-    # 提取所有圖像檔案的y和x坐標值
-    y_values, x_values, img_files = [], [], []
+    if tiles is None:
+        tiles = tile_records_from_folder(input_folder, file_ext)
 
-    for file in os.listdir(input_folder):
-        if file.endswith(file_ext):
-            img_files.append(file)
-            parts = file[:-4].split('_')
-            y = parts[-2]
-            x = parts[-1]
-            y_values.append(int(y))
-            x_values.append(int(x))
-    pass
-
-    # 計算最大的y和x值
-    max_y = max(y_values)
-    max_x = max(x_values)
-
-    # 對圖像文件進行排序，確保按照正確的順序排列
-    img_files.sort(key=lambda f: [int(d) for d in f[:-4].split('_')[-2:]])
+    # 依照(row, col)把圖塊放到正確的frame位置
+    frames, grid_rows, grid_columns = order_tiles(tiles)
+    img_files = [frame.file_path for frame in frames]
 
     # 讀取第一張圖像獲取其大小
-    first_image_path = os.path.join(input_folder, img_files[0])
-    first_image = Image.open(first_image_path)
+    first_image = Image.open(img_files[0])
     target_size = first_image.size
 
     # 定義縮放比例
     scale_factor = 1  # 根據需要進行調整
     target_size = tuple([int(scale_factor*x) for x in target_size])
 
+    # print(f"{file_info.output_folder[:1]}/{file_info.output_filename}|Generating Tags")
+    # 從tag_file取得tag資料並產生dataset
+    # 同一個檔案的所有level共用同一個種子，沒有指定時在第一次產生時隨機決定
+    if not file_info.uid_seed:
+        file_info.uid_seed = generate_uid()
+    ds = dataset_from_tag_file(file_info.metadata_file, level, file_info.uid_seed, instance_key=instance_key,
+                               deterministic=file_info.deterministic_uids, frame_size=target_size)
+    if origin is not None:
+        ds.TotalPixelMatrixOriginSequence[0].XOffsetInSlideCoordinateSystem = round(origin[0], 6)
+        ds.TotalPixelMatrixOriginSequence[0].YOffsetInSlideCoordinateSystem = round(origin[1], 6)
+
     # 計算調整後的TotalPixelMatrixRows和TotalPixelMatrixColumns
-    total_rows = (max_y + 1) * target_size[1]
-    total_columns = (max_x + 1) * target_size[0]
-
-    # 創建一個空的Pixel Data列表
-    pixel_data_list = []
-
-    # 遍歷排好序的圖像文件
-    for i, jpg_file in enumerate(img_files):
-        # 顯示當前處理的圖像文件
-        file_info.convert_status = f"將圖片資料儲存到dcm({i+1}/{len(img_files)})"
-        #update_signal.emit(0)
-        # print(f"{file_info.output_folder[:1]}/{file_info.output_filename}|Processing Image [{i+1}/{len(img_files)}]|[{jpg_file}]")
-
-        # 讀取原始圖像
-        loaded_image = Image.open(os.path.join(input_folder, jpg_file))
-        loaded_image = loaded_image.convert("RGB")
-
-        image_str_buf = BytesIO()
-
-        #"""
-        # # # 將圖像轉換為字節數據
-        loaded_image.save(image_str_buf, format="JPEG2000", progressive=False) # 儲存為JPEG (JPEG2000 PIL 儲存有問題)
-        pixel_data = image_str_buf.getvalue()
-
-        # 添加到Pixel Data列表中
-        pixel_data_list.append(pixel_data)
-        #"""
-        """
-        # # # 將圖像轉換為字節數據
-        loaded_image.save(image_str_buf, format="BMP", progressive=False) # 儲存為JPEG (JPEG2000 PIL 儲存有問題)
-        pixel_data = image_str_buf.getvalue()
-
-        # 添加到Pixel Data列表中
-        pixel_data_list.append(pixel_data)
-        """
-
-        del loaded_image
-        gc.collect()
-    pass
+    total_rows = grid_rows * target_size[1]
+    total_columns = grid_columns * target_size[0]
+    # 邊緣的frame補滿到frame大小，補上的部分不算在TotalPixelMatrix內
+    if level_size is not None:
+        total_columns, total_rows = min(int(level_size[0]), total_columns), min(int(level_size[1]), total_rows)
+
+    # 同時輸出OME-Zarr時，這一層的frame直接寫成chunk，不需要再讀一次圖檔
+    zarr_level = None
+    if zarr_writer is not None:
+        zarr_level = zarr_writer.level_writer(level, total_columns, total_rows, target_size, downsample)
+
+    def read_frames():
+        # 遍歷排好序的圖像文件
+        for i, jpg_file in enumerate(img_files):
+            check_stop(file_info)
+            # 顯示當前處理的圖像文件
+            file_info.convert_status = f"將圖片資料儲存到dcm({i+1}/{len(img_files)})"
+            #update_signal.emit(0)
+
+            # 讀取原始圖像
+            loaded_image = Image.open(jpg_file)
+            loaded_image = loaded_image.convert("RGB")
+            pixels = np.asarray(loaded_image)
+            if zarr_level is not None:
+                zarr_level.submit(frames[i].row, frames[i].col, pixels)
+            yield frames[i].row, frames[i].col, pixels
+
+            del loaded_image, pixels
+
+    # frame_cache的計數是全部level累計的，記下這一層開始時的值
+    hits_before, misses_before = frame_cache.hits, frame_cache.misses
+
+    # # # 將圖像轉換為字節數據
+    # 單一顏色的背景frame只編碼一次，之後重複使用相同的bytes
+    if ring is not None:
+        encoded = ring.encode(read_frames(), ENCODER_SETTINGS)
+    else:
+        encoded = ((row, col, frame_cache.encode(pixels, ENCODER_SETTINGS, encode_jpeg2000)) for row, col, pixels in read_frames())
+
+    # 創建Pixel Data列表
+    pixel_data_list = [pixel_data for _, _, pixel_data in encoded]
+    # 每一層只回收一次，逐frame呼叫gc.collect()會拖慢讀取
+    gc.collect()
+    print(f"Uniform background frames reused: {frame_cache.hits - hits_before}, uniform frames encoded: {frame_cache.misses - misses_before}")
+
+    if zarr_level is not None:
+        zarr_level.close()
 
     ### 設置DICOM數據集的相關屬性, Frames, Rows, Columns 數值 ###
     ds.NumberOfFrames = len(img_files)
@@ -278,6 +370,9 @@ def imgs2dcm(input_folder, file_info:imgfile_info, file_ext, update_signal:Signa
     ds.ExtendedOffsetTableLengths = out[2]
 
     # 儲存DICOM檔案
+    check_stop(file_info)
     ds.save_as(f"{file_info.output_folder}/{file_info.output_filename}", write_like_original=False)
+    if sink is not None:
+        sink.submit(f"{file_info.output_folder}/{file_info.output_filename}")
     print(f"{file_info.output_folder[:1]}/{file_info.output_filename}|Finished")
     print(file_info.output_folder)
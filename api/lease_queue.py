@@ -0,0 +1,235 @@
+"""
+lease_queue
+
+多台機器共用同一個NAS時，以共享資料夾內的lease檔協調誰轉換哪一個slide，不需要中央服務。
+- 取得: 以 O_CREAT | O_EXCL 建立 {key}.lease，只有一個worker會成功 (NFS v3以上與SMB皆為原子操作)
+- 心跳: 持有者定期更新lease檔的修改時間
+- 過期: 修改時間超過lease_timeout的lease視為停止的worker，先rename搬開(只有一個worker成功)，
+        確認搬開的確實是判定過期的那個lease後再重新取得；搬到別人剛取得的新lease時放回去並讓出
+- 遺失: 心跳發現lease已不是自己的(被判定過期並由其他worker接手)時設定lost，
+        轉換在寫出結果前停止，也不寫完成標記
+- 完成: 建立 {key}.done (失敗時為 {key}.failed) 後刪除lease
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+
+LEASE_TIMEOUT = 300
+HEARTBEAT_INTERVAL = 30
+POLL_INTERVAL = 30
+
+
+def worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class lease_lost(Exception):
+    pass
+
+
+def read_lease(path):
+    """
+    lease檔的內容 (持有者與token)，讀不到時為空字串
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return file.read()
+    except OSError:
+        return ""
+
+
+class lease():
+    """
+    一個已取得的lease，持有期間在背景thread更新心跳
+    """
+
+    def __init__(self, queue, key, name, content) -> None:
+        self.queue = queue
+        self.key = key
+        self.name = name
+        self.path = queue.path(key, "lease")
+        # lease檔的內容含有這次取得的token，內容不同代表lease已經換人
+        self.content = content
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+        pass
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.queue.heartbeat_interval):
+            try:
+                if read_lease(self.path) != self.content:
+                    raise FileNotFoundError(self.path)
+                os.utime(self.path)
+            except OSError:
+                # lease被其他worker判定過期並接手，停止轉換，不寫出結果與完成標記
+                print(f"Lease lost: {self.name}")
+                self.lost.set()
+                return
+
+    def guard(self, items):
+        """
+        依序回傳items，lease遺失時丟出lease_lost
+        """
+        for item in items:
+            if self.lost.is_set():
+                raise lease_lost(f"Lease lost: {self.name}")
+            yield item
+
+    def finish(self, status, message=""):
+        """
+        status: "done" 或 "failed"
+        """
+        self.stopped.set()
+        self.thread.join()
+        if self.lost.is_set():
+            # 接手的worker會寫完成標記，lease檔也是它的
+            print(f"Lease of {self.name} was lost, {status} not recorded")
+            return
+        self.queue.write_marker(self.key, status, {"name": self.name, "worker": self.queue.worker, "message": message, "time": time.time()})
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class lease_queue():
+    """
+    以共享資料夾queue_folder內的檔案記錄每個slide的狀態
+    """
+
+    def __init__(self, queue_folder, lease_timeout=LEASE_TIMEOUT, heartbeat_interval=HEARTBEAT_INTERVAL) -> None:
+        self.queue_folder = queue_folder
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = min(heartbeat_interval, max(1, lease_timeout / 3))
+        self.worker = worker_id()
+        os.makedirs(queue_folder, exist_ok=True)
+        pass
+
+    @staticmethod
+    def key(name):
+        """
+        name: slide的識別名稱(相對於來源資料夾的路徑)，各節點掛載NAS的位置不同時仍一致
+        """
+        return hashlib.sha1(name.replace("\\", "/").encode("utf-8")).hexdigest()
+
+    def path(self, key, suffix):
+        return os.path.join(self.queue_folder, f"{key}.{suffix}")
+
+    def write_marker(self, key, status, info):
+        # 先寫暫存檔再rename，其他worker不會讀到寫一半的檔案
+        tmp_path = self.path(key, f"{status}.{self.worker}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(info, file)
+        os.replace(tmp_path, self.path(key, status))
+
+    def shared_value(self, name, value):
+        """
+        所有worker共用的值: 第一個寫入的worker決定，其他worker讀取同一個值 (例如同一個slide的UID種子)
+        """
+        path = self.path(self.key(name), "value")
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # 建立者可能還沒寫完
+            for _ in range(50):
+                with open(path, "r", encoding="utf-8") as file:
+                    stored = file.read()
+                if stored:
+                    return stored
+                time.sleep(0.1)
+            raise TimeoutError(f"Empty shared value: {path}")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write(value)
+        return value
+
+    def finished(self, key):
+        return os.path.exists(self.path(key, "done")) or os.path.exists(self.path(key, "failed"))
+
+    def try_acquire(self, name):
+        """
+        Returns:
+            取得時回傳lease，已完成或由其他worker持有時回傳None
+        """
+        key = self.key(name)
+        if self.finished(key):
+            return None
+
+        lease_path = self.path(key, "lease")
+        try:
+            observed = os.stat(lease_path)
+            age = time.time() - observed.st_mtime
+            if age < self.lease_timeout:
+                return None
+            observed_content = read_lease(lease_path)
+            # 過期: 搬開lease，rename失敗代表其他worker已經接手
+            expired_path = self.path(key, f"expired.{self.worker}")
+            os.rename(lease_path, expired_path)
+            moved = os.stat(expired_path)
+            if moved.st_mtime != observed.st_mtime or read_lease(expired_path) != observed_content:
+                # stat之後其他worker已經搬開過期的lease並重新取得，搬到的是它的新lease
+                self.restore(expired_path, lease_path)
+                return None
+            os.remove(expired_path)
+            print(f"Lease expired after {age:.0f}s, re-queued: {name}")
+        except FileNotFoundError:
+            pass
+
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        content = json.dumps({"name": name, "worker": self.worker, "token": uuid.uuid4().hex, "time": time.time()})
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write(content)
+
+        # 取得lease前剛好被其他worker完成
+        if self.finished(key):
+            os.remove(lease_path)
+            return None
+        return lease(self, key, name, content)
+
+    def restore(self, moved_path, lease_path):
+        """
+        把誤搬的lease放回原位，原位已有新的lease時(持有者已經換人)直接丟棄
+        """
+        try:
+            os.link(moved_path, lease_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # 不支援hard link的檔案系統
+            if not os.path.exists(lease_path):
+                os.rename(moved_path, lease_path)
+                return
+        os.remove(moved_path)
+
+    def claim(self, names, poll_interval=POLL_INTERVAL):
+        """
+        依序取得names內尚未完成的項目，直到全部完成(或失敗)為止。
+        其他worker持有的項目會等到完成或lease過期後重新排入。
+
+        Yields:
+            (name, lease)，呼叫端處理完後需呼叫 lease.finish()
+        """
+        remaining = list(names)
+        while remaining:
+            waiting = []
+            for name in remaining:
+                if self.finished(self.key(name)):
+                    continue
+                acquired = self.try_acquire(name)
+                if acquired is None:
+                    if not self.finished(self.key(name)):
+                        waiting.append(name)
+                    continue
+                yield name, acquired
+            remaining = waiting
+            if remaining:
+                print(f"{len(remaining)} item(s) leased by other workers, waiting")
+                time.sleep(poll_interval)
@@ -0,0 +1,78 @@
+"""
+level_selection
+
+選擇要轉換的level (--levels):
+    default   原本的行為 (iSyntax: level 1，OpenSlide: level 1 ~ N-1)
+    all       所有level (0 ~ N-1)
+    missing   所有level中，輸出資料夾還沒有完整DICOM檔的level (例如在既有的轉換補上第0層)
+    0,2,4-6   指定的level
+轉換順序與原本相同，由小(高level)到大。
+"""
+import os
+
+import pydicom
+
+# 封裝的Pixel Data最後是Sequence Delimitation Item，寫到一半中斷的檔案沒有這8個bytes
+SEQUENCE_DELIMITER = b"\xfe\xff\xdd\xe0\x00\x00\x00\x00"
+
+
+def parse_levels(text):
+    """
+    --levels的值 -> "default"、"all"、"missing" 或 level的set
+    """
+    text = (text or "default").strip().lower()
+    if text in ("default", "all", "missing"):
+        return text
+    levels = set()
+    try:
+        for part in text.split(","):
+            part = part.strip()
+            if "-" in part:
+                first, last = part.split("-", 1)
+                levels.update(range(int(first), int(last) + 1))
+            elif part:
+                levels.add(int(part))
+    except ValueError:
+        levels = set()
+    if not levels or min(levels) < 0:
+        raise ValueError(f"--levels must be default, all, missing or a list of levels such as 0,2,4-6: {text}")
+    return levels
+
+
+def level_output_complete(dcm_path):
+    """
+    dcm_path是否為寫完的DICOM檔: header可以讀取，且檔案以Pixel Data的結尾結束。
+    只讀header與最後8個bytes，不讀取整個Pixel Data。
+    """
+    try:
+        pydicom.dcmread(dcm_path, stop_before_pixels=True)
+        with open(dcm_path, "rb") as file:
+            file.seek(-len(SEQUENCE_DELIMITER), os.SEEK_END)
+            return file.read() == SEQUENCE_DELIMITER
+    except Exception:
+        return False
+
+
+def select_levels(selection, level_count, default_levels, output_path):
+    """
+    Args:
+        selection: parse_levels的結果
+        level_count: slide的level數量
+        default_levels: default時轉換的level
+        output_path: level -> 該level的DICOM輸出路徑，missing時檢查用
+    Returns:
+        要轉換的level list，由高level到低level
+    """
+    if selection == "default":
+        levels = set(default_levels)
+    elif selection == "all":
+        levels = set(range(level_count))
+    elif selection == "missing":
+        levels = {level for level in range(level_count) if not level_output_complete(output_path(level))}
+        print(f"Missing level(s): {sorted(levels) if levels else 'none'}")
+    else:
+        unknown = sorted(level for level in selection if level >= level_count)
+        if unknown:
+            print(f"Level(s) {unknown} not in the slide ({level_count} levels), skipped")
+        levels = {level for level in selection if level < level_count}
+    return sorted(levels, reverse=True)
@@ -0,0 +1,21 @@
+class pyramid_level():
+    """
+    金字塔(pyramid)的一層: 該層大小、圖塊大小以及產生圖塊的函式，供tiff/zarr等輸出格式共用。
+    tiles() 需回傳 (row, col, pixels) 的iterator，pixels為 tile_size 大小的 RGB uint8 陣列(邊緣需補滿)。
+    """
+
+    level:int = 0
+    width:int = 0
+    height:int = 0
+    tile_size:list = [512, 512]
+    # 相對於第0層的縮放倍率，None時由各層大小推算
+    downsample = None
+
+    def __init__(self, level, width, height, tile_size, tiles, downsample=None) -> None:
+        self.level = level
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.tiles = tiles
+        self.downsample = downsample
+        pass
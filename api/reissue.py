@@ -0,0 +1,143 @@
+"""
+reissue
+
+LIS更正病人/檢查資料時，不需要重新轉換整個slide:
+讀取既有DICOM的header(不讀Pixel Data)，以tag檔產生新的header，
+再把原檔案的encapsulated Pixel Data(含Basic/Extended Offset Table)整段以bytes複製到新的instance，完全不解碼。
+"""
+import os
+import re
+import shutil
+
+import pydicom
+from pydicom.datadict import keyword_dict
+from pydicom.uid import generate_uid
+
+from api.imgs2dcm import parse_tag_file, dataset_from_tag_file
+
+# encapsulated Pixel Data的元素開頭 (Explicit VR Little Endian): (7FE0,0010) OB, 未定義長度
+PIXEL_DATA_HEADER = b'\xe0\x7f\x10\x00OB\x00\x00\xff\xff\xff\xff'
+# 搜尋Pixel Data元素開頭時每次讀取的大小
+SEARCH_CHUNK_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# 從原檔案沿用的影像相關屬性 (由Pixel Data決定，不應由tag檔改變)
+IMAGE_ATTRIBUTES = [
+    'ImageType', 'Rows', 'Columns', 'NumberOfFrames',
+    'TotalPixelMatrixRows', 'TotalPixelMatrixColumns', 'TotalPixelMatrixOriginSequence',
+    'ImagedVolumeWidth', 'ImagedVolumeHeight',
+    'SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration',
+    'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation',
+    'ExtendedOffsetTable', 'ExtendedOffsetTableLengths',
+]
+
+# tag檔名稱與DICOM keyword不是去掉空白就能對應的欄位
+TAG_KEYWORDS = {
+    'Study Last Modified Date': 'AttributeModificationDateTime',
+}
+
+
+def tag_keyword(name):
+    """
+    tag檔的欄位名稱 -> DICOM keyword，例如 'Patient ID' -> 'PatientID'，無法對應時回傳None
+    """
+    keyword = TAG_KEYWORDS.get(name, str(name).replace("'s", "").replace(" ", ""))
+    return keyword if keyword in keyword_dict else None
+
+
+def apply_tag_updates(ds, tags):
+    """
+    只更新tags內有的欄位，其他欄位保持原樣 (metadata更新檔)
+    """
+    for name, value in tags.items():
+        keyword = tag_keyword(name)
+        if keyword is None:
+            print(f"Unknown tag ignored: {name}")
+            continue
+        if keyword == 'PixelSpacing':
+            value = [float(x) for x in re.split(r'[,\\]', str(value))]
+        setattr(ds, keyword, value)
+    return ds
+
+
+def read_header(input_file):
+    """
+    讀取DICOM header (不讀Pixel Data) 以及Pixel Data元素在檔案內的位置
+    Returns:
+        (ds, pixel_data_offset)
+    """
+    with open(input_file, 'rb') as file:
+        ds = pydicom.dcmread(file, stop_before_pixels=True)
+        position = file.tell()
+        # dcmread停在Pixel Data元素之前，找不到時往後搜尋元素開頭
+        while True:
+            file.seek(position)
+            chunk = file.read(SEARCH_CHUNK_SIZE + len(PIXEL_DATA_HEADER))
+            found = chunk.find(PIXEL_DATA_HEADER)
+            if found >= 0:
+                return ds, position + found
+            if len(chunk) <= len(PIXEL_DATA_HEADER):
+                raise ValueError(f"No encapsulated Pixel Data in {input_file}")
+            position += SEARCH_CHUNK_SIZE
+
+
+def reissue_dicom(input_file, output_file, tag_file="", update_file=""):
+    """
+    以新的header重新發行一個DICOM instance，Pixel Data以bytes複製。
+
+    Args:
+        input_file: 既有的DICOM檔案 (encapsulated transfer syntax)
+        output_file: 輸出的DICOM檔案路徑
+        tag_file: 完整的tag檔，以dataset_from_tag_file產生新的header (沿用原本的Study/Series UID，除非tag檔有指定)
+        update_file: metadata更新檔，只更新其中有的欄位，其他沿用原檔案
+    Returns:
+        新的SOPInstanceUID
+    """
+    if os.path.abspath(input_file) == os.path.abspath(output_file):
+        raise ValueError(f"Output must differ from the input file: {input_file}")
+    old_ds, pixel_data_offset = read_header(input_file)
+
+    if tag_file:
+        ds = dataset_from_tag_file(tag_file, study_uid=old_ds.StudyInstanceUID, series_uid=old_ds.SeriesInstanceUID)
+        for keyword in IMAGE_ATTRIBUTES:
+            if keyword in old_ds:
+                setattr(ds, keyword, old_ds[keyword].value)
+        ds.file_meta.TransferSyntaxUID = old_ds.file_meta.TransferSyntaxUID
+    else:
+        ds = old_ds
+    if update_file:
+        apply_tag_updates(ds, parse_tag_file(update_file))
+
+    # 內容不同的新instance
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    ds.save_as(output_file, write_like_original=False)
+
+    # 將Pixel Data元素(到檔案結尾)整段接在新header後面
+    with open(input_file, 'rb') as source, open(output_file, 'ab') as target:
+        source.seek(pixel_data_offset)
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+    return ds.SOPInstanceUID
+
+
+def reissue_folder(source_path, output_path, tag_file="", update_file=""):
+    """
+    重新發行source_path (檔案或資料夾) 內所有的.dcm，輸出保留相對路徑
+    """
+    if os.path.isfile(source_path):
+        files = [(source_path, os.path.basename(source_path))]
+    else:
+        files = []
+        for root, _, names in os.walk(source_path):
+            for name in names:
+                if name.lower().endswith('.dcm'):
+                    path = os.path.join(root, name)
+                    files.append((path, os.path.relpath(path, source_path)))
+
+    for input_file, relative_path in files:
+        output_file = os.path.join(output_path, relative_path)
+        instance_uid = reissue_dicom(input_file, output_file, tag_file, update_file)
+        print(f"Reissued {input_file} -> {output_file} ({instance_uid})")
+    return len(files)
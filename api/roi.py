@@ -0,0 +1,95 @@
+"""
+roi
+
+只轉換slide的部分區域(ROI)。ROI以第0層像素座標的外接矩形 (x0, y0, x1, y1) 表示，x1/y1不包含在內。
+--roi 可以是 "x0,y0,x1,y1"，或GeoJSON檔案 (例如QuPath匯出的標註，座標為第0層像素)，
+每個feature的外接矩形為一個ROI。
+"""
+import json
+
+
+def parse_roi_box(text):
+    """
+    "x0,y0,x1,y1" -> (x0, y0, x1, y1)
+    """
+    values = [int(float(value)) for value in text.split(",")]
+    if len(values) != 4:
+        raise ValueError(f"ROI must be x0,y0,x1,y1: {text}")
+    x0, y0, x1, y1 = values
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"ROI is empty: {text}")
+    return x0, y0, x1, y1
+
+
+def coordinates_bounds(coordinates):
+    """
+    GeoJSON coordinates (任意巢狀) 的外接矩形
+    """
+    points = []
+    stack = [coordinates]
+    while stack:
+        item = stack.pop()
+        if len(item) >= 2 and all(isinstance(value, (int, float)) for value in item[:2]):
+            points.append(item[:2])
+        else:
+            stack.extend(item)
+    if not points:
+        return None
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return int(min(xs)), int(min(ys)), int(-(-max(xs) // 1)), int(-(-max(ys) // 1))
+
+
+def read_geojson_rois(path):
+    """
+    返回: GeoJSON檔案中每個feature (或geometry) 的外接矩形list
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    if isinstance(data, list):
+        features = data
+    elif data.get("type") == "FeatureCollection":
+        features = data.get("features", [])
+    else:
+        features = [data]
+
+    rois = []
+    for feature in features:
+        geometry = feature.get("geometry", feature) if feature.get("type") == "Feature" else feature
+        geometries = geometry.get("geometries", [geometry]) if geometry else []
+        for item in geometries:
+            bounds = coordinates_bounds(item.get("coordinates", []))
+            if bounds is not None and bounds[2] > bounds[0] and bounds[3] > bounds[1]:
+                rois.append(bounds)
+    if not rois:
+        raise ValueError(f"No ROI found in {path}")
+    return rois
+
+
+def parse_rois(text):
+    """
+    --roi的值 -> [(x0, y0, x1, y1)]，空字串為整張slide ([])
+    """
+    if not text:
+        return []
+    if text.lower().endswith((".geojson", ".json")):
+        return read_geojson_rois(text)
+    return [parse_roi_box(text)]
+
+
+def clip_roi(roi, width, height):
+    """
+    將ROI限制在第0層的圖片範圍內，完全在圖片外時返回None
+    """
+    x0, y0, x1, y1 = max(roi[0], 0), max(roi[1], 0), min(roi[2], width), min(roi[3], height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+
+def roi_origin(roi, mpp):
+    """
+    ROI左上角在slide座標系的位置 (mm)，給TotalPixelMatrixOriginSequence使用
+    mpp: 第0層每個像素的大小 (µm) [x, y]
+    """
+    return roi[0] * mpp[0] / 1000, roi[1] * mpp[1] / 1000
@@ -0,0 +1,22 @@
+class sink_group():
+    """
+    Hands every written instance to several sinks (e.g. STOW-RS and C-STORE at once)
+    """
+
+    def __init__(self, sinks) -> None:
+        self.sinks = list(sinks)
+        pass
+
+    def submit(self, path):
+        for sink in self.sinks:
+            sink.submit(path)
+
+    def close(self):
+        """
+        Returns:
+            list of (path, error) of every sink's failed transfers
+        """
+        failed = []
+        for sink in self.sinks:
+            failed.extend(sink.close())
+        return failed
@@ -0,0 +1,188 @@
+"""
+slide_inventory
+
+Header-only properties of many slides in one table, so planning and scheduling can query them
+without reopening the slides: dimensions, levels, MPP, vendor, associated images and (iSyntax)
+data envelope counts. Slides are opened in parallel; OpenSlide handles are per slide, iSyntax slides
+are opened on one named PixelEngine input per worker thread.
+The table is written to SQLite (default) or Parquet (.parquet output, needs pyarrow).
+"""
+import os
+import json
+import sqlite3
+import threading
+from concurrent import futures
+
+INVENTORY_WORKERS = 16
+ISYNTAX_EXTENSIONS = {".isyntax"}
+
+# column name, SQLite type
+COLUMNS = [
+    ("input_file", "TEXT PRIMARY KEY"),
+    ("api", "TEXT"),
+    ("file_size", "INTEGER"),
+    ("modified", "REAL"),
+    ("width", "INTEGER"),
+    ("height", "INTEGER"),
+    ("level_count", "INTEGER"),
+    # JSON list of [width, height, downsample] per level
+    ("levels", "TEXT"),
+    ("mpp_x", "REAL"),
+    ("mpp_y", "REAL"),
+    ("objective_power", "REAL"),
+    ("vendor", "TEXT"),
+    ("model", "TEXT"),
+    # JSON list of associated image names (label, macro, thumbnail...)
+    ("associated_images", "TEXT"),
+    ("data_envelopes", "INTEGER"),
+    ("error", "TEXT"),
+]
+
+
+def empty_record(input_file, api):
+    record = {name: None for name, _ in COLUMNS}
+    record["input_file"] = input_file
+    record["api"] = api
+    record["error"] = ""
+    try:
+        stat = os.stat(input_file)
+        record["file_size"] = stat.st_size
+        record["modified"] = stat.st_mtime
+    except OSError:
+        pass
+    return record
+
+
+def float_property(properties, name):
+    try:
+        return float(properties[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def openslide_record(input_file, open_slide):
+    """
+    open_slide: the OpenSlide class (imported by Openslide2Dcm with the configured DLL path)
+    """
+    record = empty_record(input_file, "Openslide")
+    slide = open_slide(input_file)
+    try:
+        properties = slide.properties
+        record["width"], record["height"] = slide.dimensions
+        record["level_count"] = slide.level_count
+        record["levels"] = json.dumps([[width, height, downsample] for (width, height), downsample
+                                       in zip(slide.level_dimensions, slide.level_downsamples)])
+        record["mpp_x"] = float_property(properties, "openslide.mpp-x")
+        record["mpp_y"] = float_property(properties, "openslide.mpp-y")
+        record["objective_power"] = float_property(properties, "openslide.objective-power")
+        record["vendor"] = properties.get("openslide.vendor")
+        record["associated_images"] = json.dumps(sorted(slide.associated_images.keys()))
+    finally:
+        slide.close()
+    return record
+
+
+def isyntax_record(input_file, pe_input):
+    """
+    pe_input: a PixelEngine input not used by another thread
+    """
+    record = empty_record(input_file, "iSyntax")
+    pe_input.open(input_file)
+    try:
+        view = pe_input["WSI"].source_view
+        levels = []
+        for level in range(view.num_derived_levels + 1):
+            # dimension_ranges: [start, step, end] in level 0 pixels, end inclusive
+            x_range, y_range = view.dimension_ranges(level)[:2]
+            levels.append([(x_range[2] - x_range[0]) // x_range[1] + 1, (y_range[2] - y_range[0]) // y_range[1] + 1, 2 ** level])
+        record["width"], record["height"] = levels[0][0], levels[0][1]
+        record["level_count"] = len(levels)
+        record["levels"] = json.dumps(levels)
+        # scale is in micrometer per level 0 pixel
+        record["mpp_x"], record["mpp_y"] = float(view.scale[0]), float(view.scale[1])
+        record["vendor"] = str(pe_input.manufacturer)
+        record["model"] = str(pe_input.model_name)
+        record["associated_images"] = json.dumps(sorted(pe_input[image].image_type for image in range(pe_input.num_images)
+                                                        if pe_input[image].image_type != "WSI"))
+        record["data_envelopes"] = len(view.data_envelopes(0).as_extreme_vertices_model())
+    finally:
+        pe_input.close()
+    return record
+
+
+class slide_inventory():
+    """
+    collect() reads the properties of input files in parallel, write() stores them as one table
+    """
+
+    def __init__(self, open_slide=None, pixel_engine=None, max_workers=INVENTORY_WORKERS) -> None:
+        self.open_slide = open_slide
+        self.pixel_engine = pixel_engine
+        self.max_workers = max_workers
+        self.local = threading.local()
+        self.inputs = 0
+        self.lock = threading.Lock()
+        pass
+
+    def pe_input(self):
+        # one named input per thread, the converters only use "in"
+        if not hasattr(self.local, "pe_input"):
+            with self.lock:
+                self.inputs += 1
+                name = f"inventory{self.inputs}"
+            self.local.pe_input = self.pixel_engine[name]
+        return self.local.pe_input
+
+    def record(self, input_file):
+        is_isyntax = os.path.splitext(input_file)[1].lower() in ISYNTAX_EXTENSIONS
+        try:
+            if is_isyntax:
+                return isyntax_record(input_file, self.pe_input())
+            return openslide_record(input_file, self.open_slide)
+        except Exception as e:
+            record = empty_record(input_file, "iSyntax" if is_isyntax else "Openslide")
+            record["error"] = str(e)
+            return record
+
+    def collect(self, input_files):
+        records = []
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inventory") as executor:
+            for count, record in enumerate(executor.map(self.record, input_files), 1):
+                records.append(record)
+                if record["error"]:
+                    print(f"{record['input_file']}: {record['error']}")
+                if count % 100 == 0:
+                    print(f"{count}/{len(input_files)} slide(s) read")
+        return records
+
+
+def write_sqlite(path, records, table="slides"):
+    """
+    Insert or replace the records, so an inventory can be refreshed in place
+    """
+    connection = sqlite3.connect(path)
+    try:
+        columns = ", ".join(f"{name} {column_type}" for name, column_type in COLUMNS)
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+        names = [name for name, _ in COLUMNS]
+        connection.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                               [[record[name] for name in names] for record in records])
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def write_parquet(path, records):
+    # pyarrow is only needed for Parquet output
+    import pyarrow
+    import pyarrow.parquet
+
+    table = pyarrow.table({name: [record[name] for record in records] for name, _ in COLUMNS})
+    pyarrow.parquet.write_table(table, path)
+
+
+def write_inventory(path, records):
+    if path.lower().endswith(".parquet"):
+        write_parquet(path, records)
+    else:
+        write_sqlite(path, records)
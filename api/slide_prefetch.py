@@ -0,0 +1,128 @@
+"""
+slide_prefetch
+
+Overlap the latency-bound start of the next slide with the encoding of the current one:
+while slide N converts, a background thread reads slide N+1 (its metadata file, the fingerprint used
+for deterministic UIDs and the first frames of the level converted first) so that starting it finds
+them in the page cache. The converter supplies the frame reader: OpenSlide opens the slide with its own
+handle and reads the first frames of the highest selected level, which in TIFF/SVS files usually sit at
+the end of the file. Without one (iSyntax: the PixelEngine input is busy with the current slide) the
+leading bytes of the files, where the headers are, are read instead.
+The bytes read ahead are capped by the memory budget, and by half of the memory currently available.
+"""
+import os
+from concurrent import futures
+
+from api.imgs2dcm import source_fingerprint
+
+PREFETCH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def available_memory():
+    """
+    MemAvailable in bytes (Linux), None where unknown
+    """
+    try:
+        with open("/proc/meminfo", "r", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def slide_files(input_file):
+    """
+    Files holding the slide, MIRAX keeps its data in a folder next to the .mrxs
+    """
+    files = [input_file]
+    data_folder = os.path.splitext(input_file)[0]
+    if input_file.lower().endswith(".mrxs") and os.path.isdir(data_folder):
+        files.extend(os.path.join(data_folder, name) for name in sorted(os.listdir(data_folder)))
+    return files
+
+
+def read_ahead(paths, budget):
+    """
+    Read up to budget bytes of paths, each file from its start, into a reused buffer
+    Returns:
+        bytes read
+    """
+    buffer = bytearray(PREFETCH_CHUNK_SIZE)
+    total = 0
+    for path in paths:
+        if total >= budget:
+            break
+        try:
+            with open(path, "rb", buffering=0) as file:
+                while total < budget:
+                    count = file.readinto(memoryview(buffer)[:min(PREFETCH_CHUNK_SIZE, budget - total)])
+                    if not count:
+                        break
+                    total += count
+        except OSError:
+            continue
+    return total
+
+
+class prefetched_slide():
+    fingerprint: str = ""
+    bytes_read: int = 0
+
+    def __init__(self, fingerprint, bytes_read) -> None:
+        self.fingerprint = fingerprint
+        self.bytes_read = bytes_read
+        pass
+
+
+class slide_prefetcher():
+    """
+    submit() starts reading a slide ahead on one background thread, take() returns what was prefetched.
+    read_frames(file_info, budget) -> bytes read: reads the first frames the conversion will need,
+    None to read the leading bytes of the slide files instead
+    """
+
+    def __init__(self, memory_budget, read_frames=None) -> None:
+        self.memory_budget = memory_budget
+        self.read_frames = read_frames
+        self.executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.jobs = {}
+        pass
+
+    def budget(self):
+        available = available_memory()
+        return self.memory_budget if available is None else min(self.memory_budget, available // 2)
+
+    def submit(self, file_info, fingerprint=False):
+        if file_info.input_file not in self.jobs:
+            self.jobs[file_info.input_file] = self.executor.submit(self.prefetch, file_info, fingerprint)
+
+    def prefetch(self, file_info, fingerprint):
+        uid_seed = source_fingerprint(file_info.input_file) if fingerprint else ""
+        budget = self.budget()
+        bytes_read = read_ahead([file_info.metadata_file], budget) if file_info.metadata_file else 0
+        if self.read_frames is not None:
+            bytes_read += self.read_frames(file_info, budget - bytes_read)
+        else:
+            bytes_read += read_ahead(slide_files(file_info.input_file), budget - bytes_read)
+        return prefetched_slide(uid_seed, bytes_read)
+
+    def take(self, file_info):
+        """
+        Returns:
+            prefetched_slide, None if the slide was not submitted or prefetching failed
+        """
+        job = self.jobs.pop(file_info.input_file, None)
+        if job is None:
+            return None
+        try:
+            return job.result()
+        except Exception as e:
+            print(f"Prefetch of {file_info.input_file} failed: {e}")
+            return None
+
+    def close(self):
+        for job in self.jobs.values():
+            job.cancel()
+        self.executor.shutdown(wait=True)
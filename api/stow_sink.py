@@ -0,0 +1,158 @@
+"""
+stow_sink
+
+Upload converted instances to a DICOMweb archive with STOW-RS (POST {url}/studies, multipart/related; type="application/dicom").
+Each instance is submitted as soon as it has been written, while it is still in the page cache, and uploaded
+in the background while the next level is converted. Uploads run on max_connections threads, each reusing
+a keep-alive connection from the pool. The body is streamed from the file, so multi-GB instances are never
+held in memory. Connection errors, 429 and 5xx responses are retried with exponential backoff.
+"""
+import os
+import time
+import uuid
+import queue
+import http.client
+from urllib.parse import urlsplit
+from concurrent import futures
+
+STOW_CONNECTIONS = 4
+STOW_RETRIES = 3
+STOW_TIMEOUT = 300
+CHUNK_SIZE = 1024 * 1024
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class stow_error(Exception):
+    pass
+
+
+class connection_pool():
+    """
+    Keep-alive HTTP(S) connections to one host, at most one per upload thread
+    """
+
+    def __init__(self, url, timeout=STOW_TIMEOUT) -> None:
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        pass
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def put(self, connection):
+        self.idle.put(connection)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+def multipart_parts(path, boundary):
+    """
+    (length, body generator) of a multipart/related request holding one DICOM file
+    """
+    head = f"--{boundary}\r\nContent-Type: application/dicom\r\n\r\n".encode("ascii")
+    tail = f"\r\n--{boundary}--\r\n".encode("ascii")
+
+    def body():
+        yield head
+        with open(path, "rb") as file:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        yield tail
+
+    return len(head) + os.path.getsize(path) + len(tail), body()
+
+
+class stow_sink():
+    """
+    submit() queues an instance file for upload, close() waits for all uploads
+    """
+
+    def __init__(self, url, max_connections=STOW_CONNECTIONS, retries=STOW_RETRIES, headers=None, timeout=STOW_TIMEOUT) -> None:
+        self.url = url.rstrip("/")
+        self.path = urlsplit(self.url).path + "/studies"
+        self.retries = retries
+        self.headers = dict(headers or {})
+        self.pool = connection_pool(self.url, timeout)
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="stow")
+        self.jobs = {}
+        pass
+
+    def submit(self, path):
+        self.jobs[self.executor.submit(self.upload, path)] = path
+
+    def upload(self, path):
+        """
+        Returns:
+            the archive's response body (the STOW-RS response dataset)
+        """
+        for attempt in range(self.retries + 1):
+            connection = self.pool.get()
+            try:
+                boundary = uuid.uuid4().hex
+                length, body = multipart_parts(path, boundary)
+                headers = {
+                    "Content-Type": f'multipart/related; type="application/dicom"; boundary={boundary}',
+                    "Content-Length": str(length),
+                    "Accept": "application/dicom+json",
+                    "Connection": "keep-alive",
+                }
+                headers.update(self.headers)
+                connection.request("POST", self.path, body=body, headers=headers)
+                response = connection.getresponse()
+                # the whole response must be read before the connection can be reused
+                data = response.read()
+                if response.will_close:
+                    connection.close()
+                else:
+                    self.pool.put(connection)
+                if response.status in (200, 202):
+                    if response.status == 202:
+                        print(f"STOW-RS warning for {path}: {data[:500]!r}")
+                    return data
+                if response.status not in RETRY_STATUS:
+                    raise stow_error(f"STOW-RS rejected {path}: HTTP {response.status} {data[:500]!r}")
+                error = stow_error(f"HTTP {response.status}")
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                error = e
+            if attempt < self.retries:
+                delay = 2 ** attempt
+                print(f"STOW-RS upload of {path} failed ({error}), retrying in {delay}s")
+                time.sleep(delay)
+        raise stow_error(f"STOW-RS upload of {path} failed after {self.retries + 1} attempts: {error}")
+
+    def wait(self):
+        """
+        Wait for the uploads submitted so far
+        Returns:
+            list of (path, error) of failed uploads
+        """
+        failed = []
+        for job in futures.as_completed(list(self.jobs)):
+            path = self.jobs.pop(job)
+            try:
+                job.result()
+                print(f"Uploaded {path}")
+            except Exception as e:
+                print(f"Upload failed: {e}")
+                failed.append((path, e))
+        return failed
+
+    def close(self):
+        failed = self.wait()
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+        return failed
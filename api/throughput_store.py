@@ -0,0 +1,67 @@
+"""
+throughput_store
+
+Measured throughputs kept between runs in benchmark.json (next to config.json), so that --plan can
+estimate conversion time without measuring again. Rates are pixels per second, so a measurement made
+with one frame size serves every other:
+    "read/{api}/{backend}"  pixels read per second (iSyntax: the render backend actually used, never AUTO)
+    "encode/{codec}"        pixels encoded per second (one thread)
+Each entry is the running average of the last measurements, with the time it was last updated:
+    {"pixels_per_second": ..., "samples": ..., "updated": ...}
+"""
+import os
+import json
+import time
+import threading
+
+BENCHMARK_FILE = "benchmark.json"
+# measurements averaged per entry, older ones fade out so the rate follows hardware and library changes
+AVERAGED_SAMPLES = 10
+lock = threading.Lock()
+
+
+def read_key(api, backend):
+    return f"read/{api}/{backend}"
+
+
+def encode_key(codec):
+    return f"encode/{codec}"
+
+
+def read_values(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def load_throughput(key, path=BENCHMARK_FILE):
+    """
+    Returns:
+        stored pixels per second, None if never measured
+    """
+    with lock:
+        entry = read_values(path).get(key)
+    return entry.get("pixels_per_second") if isinstance(entry, dict) else None
+
+
+def save_throughput(key, pixels_per_second, path=BENCHMARK_FILE):
+    """
+    Add a measurement to the running average of key
+    Returns:
+        the new average
+    """
+    with lock:
+        values = read_values(path)
+        entry = values.get(key)
+        if isinstance(entry, dict) and entry.get("pixels_per_second"):
+            samples = min(entry.get("samples", 1), AVERAGED_SAMPLES - 1)
+            pixels_per_second = (entry["pixels_per_second"] * samples + pixels_per_second) / (samples + 1)
+            samples += 1
+        else:
+            samples = 1
+        values[key] = {"pixels_per_second": pixels_per_second, "samples": samples, "updated": time.time()}
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(values, file, indent=4, sort_keys=True)
+        os.replace(f"{path}.tmp", path)
+        return pixels_per_second
@@ -0,0 +1,72 @@
+"""
+tiff_output
+
+將OpenSlide或iSyntax讀出的圖塊寫成金字塔(pyramidal)的tiled BigTIFF，作為DICOM以外的中繼保存格式。
+沿用 api/iSyntax/sdk/libtiff_interface.py 的libtiff寫入器，
+圖塊先在thread pool內平行壓縮成JPEG，再以TIFFWriteRawTile直接寫入，不經過libtiff的編碼器。
+"""
+import os
+from io import BytesIO
+from concurrent import futures
+from multiprocessing import cpu_count
+
+import numpy as np
+from PIL import Image
+
+
+# TIFF的圖塊大小需為16的倍數
+TIFF_TILE_SIZE = [512, 512]
+JPEG_QUALITY = 80
+
+
+def encode_jpeg_tile(row, col, pixels, quality=JPEG_QUALITY):
+    """
+    將一個圖塊壓縮成JPEG (YCbCr 4:2:0，與TIFF的YCbCrSubsampling 2,2一致)。
+    PIL在壓縮時會釋放GIL，因此可以用thread平行處理。
+    """
+    image_str_buf = BytesIO()
+    Image.fromarray(np.asarray(pixels, dtype=np.uint8), 'RGB').save(image_str_buf, format="JPEG", quality=quality, subsampling=2)
+    return row, col, image_str_buf.getvalue()
+
+
+def write_tiff_pyramid(output_file, levels, quality=JPEG_QUALITY, bigtiff=True, max_workers=None):
+    """
+    依序寫入每一層(由大到小)，每一層為一個TIFF directory。
+
+    Args:
+        output_file: 輸出的tiff路徑
+        levels: pyramid_level list，第一個為最大解析度，tile_size需為16的倍數
+        quality: JPEG品質
+        bigtiff: 是否寫成BigTIFF (超過4GB的檔案需要)
+        max_workers: 壓縮用的thread數量
+    """
+    # libtiff_interface 在import時才載入libtiff，只有選擇tiff輸出時才需要
+    from api.iSyntax.sdk.libtiff_interface import TIFF
+
+    max_workers = max_workers or cpu_count()
+    tiff_handle = TIFF.open(os.fsencode(output_file), mode=b'w8' if bigtiff else b'w')
+    try:
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for index, level in enumerate(levels):
+                tile_size = level.tile_size
+                tiff_handle.set_level_attributes(level.width, level.height, index > 0, tile_size)
+
+                def write_done(done_jobs):
+                    for job in done_jobs:
+                        row, col, data = job.result()
+                        if tiff_handle.write_raw_tile([col * tile_size[0], row * tile_size[1]], data) < 0:
+                            raise RuntimeError(f"Error in writing TIFF tile ({row}, {col})")
+
+                # 最多同時保留 max_workers*4 個未完成的壓縮工作，限制記憶體用量
+                pending = set()
+                for row, col, pixels in level.tiles():
+                    pending.add(executor.submit(encode_jpeg_tile, row, col, pixels, quality))
+                    if len(pending) >= max_workers * 4:
+                        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                        write_done(done)
+                write_done(futures.as_completed(pending))
+
+                tiff_handle.write_directory()
+                print(f"TIFF level {index} written: [{level.width}, {level.height}]")
+    finally:
+        tiff_handle.close()
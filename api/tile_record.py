@@ -0,0 +1,71 @@
+class tile_record():
+    """
+    一張切割後的圖塊(frame)，記錄它在該level的位置(level, row, col)以及暫存檔路徑。
+    位置只在產生圖塊時計算一次，之後排序/組成DICOM frame都直接使用，不再從檔名解析。
+    """
+
+    level:int = 0
+    row:int = 0
+    col:int = 0
+    file_path:str = ""
+
+    def __init__(self, level, row, col, file_path) -> None:
+        self.level = level
+        self.row = row
+        self.col = col
+        self.file_path = file_path
+        pass
+
+
+class tile_grid():
+    """
+    一個level的切割格線，座標與大小皆為第0層(level 0)的座標系，
+    用來把region.range = [x_start, x_end, y_start, y_end, level] 換算成 (level, row, col)。
+    寬高分開記錄，非正方形的圖塊也能正確換算。
+    """
+
+    x_start:int = 0
+    y_start:int = 0
+    tile_width:int = 0
+    tile_height:int = 0
+
+    def __init__(self, x_start, y_start, tile_width, tile_height) -> None:
+        self.x_start = x_start
+        self.y_start = y_start
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        pass
+
+    def index(self, view_range):
+        """
+        Args:
+            view_range: [x_start, x_end, y_start, y_end, level]
+        Returns:
+            (level, row, col)
+        """
+        x_start, _, y_start, _, level = view_range
+        return level, (y_start - self.y_start) // self.tile_height, (x_start - self.x_start) // self.tile_width
+
+
+def order_tiles(tiles):
+    """
+    依照(row, col)把圖塊放進frame陣列(row-major)，回傳排序好的圖塊與格線大小。
+
+    Args:
+        tiles: tile_record list
+    Returns:
+        frames: 依frame順序排列的tile_record list
+        rows: 列數
+        columns: 行數
+    """
+    rows = max(tile.row for tile in tiles) + 1
+    columns = max(tile.col for tile in tiles) + 1
+
+    frames = [None] * (rows * columns)
+    for tile in tiles:
+        frames[tile.row * columns + tile.col] = tile
+
+    missing = [i for i, frame in enumerate(frames) if frame is None]
+    if missing:
+        raise ValueError(f"Missing {len(missing)} tile(s), first at (row, col) = {divmod(missing[0], columns)}")
+    return frames, rows, columns
@@ -0,0 +1,168 @@
+"""
+tile_ring
+
+以多個process編碼frame，避開GIL。讀取端把解碼後的frame寫進一塊共用記憶體(multiprocessing.shared_memory)
+的固定slot，encoder process直接在slot上編碼(不複製)，process之間只傳遞slot編號與編碼後的bytes，
+不會像ProcessPoolExecutor一樣pickle每個3 MB的frame。
+slot用完時讀取端等待編碼結果釋放slot；frame比slot大時(例如換到frame較大的level)重新配置共用記憶體。
+encoder process以spawn啟動，不會繼承PixelEngine/OpenSlide的狀態，encoder必須是模組層級的函式。
+"""
+import queue
+import multiprocessing
+from multiprocessing import shared_memory, cpu_count
+
+import numpy as np
+
+from api.uniform_frames import frame_cache
+
+# 每個encoder process平均可以排隊的slot數
+SLOTS_PER_PROCESS = 2
+RESULT_TIMEOUT = 5
+
+
+def encode_slots(encoder, jobs, results):
+    """
+    encoder process: 從jobs取得 (共用記憶體名稱, slot, slot大小, frame shape, 編號)，編碼後送回 (編號, slot, bytes, 錯誤)
+    """
+    memory = None
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            name, slot, slot_bytes, shape, index = job
+            if memory is None or memory.name != name:
+                if memory is not None:
+                    memory.close()
+                memory = shared_memory.SharedMemory(name=name)
+            pixels = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf, offset=slot * slot_bytes)
+            try:
+                results.put((index, slot, encoder(pixels), None))
+            except Exception as e:
+                results.put((index, slot, None, f"{type(e).__name__}: {e}"))
+            del pixels
+    finally:
+        if memory is not None:
+            memory.close()
+
+
+class tile_ring():
+    """
+    encode(frames, settings)依序回傳編碼結果，close()結束encoder process並釋放共用記憶體。
+    同一個ring可以用於多個level及slide，但同一時間只能有一個encode()。
+    """
+
+    def __init__(self, encoder, processes=0, slots=0) -> None:
+        self.encoder = encoder
+        self.processes = processes or cpu_count()
+        self.slot_count = slots or self.processes * SLOTS_PER_PROCESS
+        context = multiprocessing.get_context("spawn")
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.workers = [context.Process(target=encode_slots, args=(encoder, self.jobs, self.results), daemon=True, name=f"encoder-{n}")
+                        for n in range(self.processes)]
+        for worker in self.workers:
+            worker.start()
+        self.memory = None
+        self.slot_bytes = 0
+        self.free = []
+        self.in_flight = 0
+        pass
+
+    def allocate(self, slot_bytes):
+        """
+        配置slot_count個slot_bytes大小的slot，呼叫時不能有編碼中的frame
+        """
+        self.release_memory()
+        self.memory = shared_memory.SharedMemory(create=True, size=slot_bytes * self.slot_count)
+        self.slot_bytes = slot_bytes
+        self.free = list(range(self.slot_count))
+        print(f"Tile ring: {self.slot_count} slot(s) of {slot_bytes} bytes for {self.processes} encoder process(es)")
+
+    def release_memory(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+    def result(self):
+        """
+        等待一個編碼結果並釋放它的slot
+        """
+        while True:
+            try:
+                index, slot, data, error = self.results.get(timeout=RESULT_TIMEOUT)
+                break
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("An encoder process exited")
+        self.free.append(slot)
+        self.in_flight -= 1
+        return index, data, error
+
+    def submit(self, index, pixels, collect):
+        """
+        把frame寫進一個空的slot並交給encoder process，沒有空slot時以collect()取回結果
+        """
+        if pixels.nbytes > self.slot_bytes:
+            while self.in_flight:
+                collect()
+            self.allocate(pixels.nbytes)
+        while not self.free:
+            collect()
+        slot = self.free.pop()
+        np.ndarray(pixels.shape, dtype=np.uint8, buffer=self.memory.buf, offset=slot * self.slot_bytes)[...] = pixels
+        self.jobs.put((self.memory.name, slot, self.slot_bytes, pixels.shape, index))
+        self.in_flight += 1
+
+    def encode(self, frames, settings):
+        """
+        Args:
+            frames: (row, col, RGB陣列) 的iterable
+            settings: 編碼設定 (背景frame快取的key)
+        Returns:
+            依輸入順序的 (row, col, 編碼後的bytes) generator；單一顏色的背景frame由frame_cache處理，不送到encoder process
+        """
+        ready = {}
+        pending = {}
+
+        def collect():
+            index, data, error = self.result()
+            row, col, key = pending.pop(index)
+            if error is not None:
+                raise RuntimeError(f"Encoding frame ({row}, {col}) failed: {error}")
+            if key is not None:
+                frame_cache.store(key, data)
+            ready[index] = (row, col, data)
+
+        next_index = 0
+        try:
+            for index, (row, col, pixels) in enumerate(frames):
+                pixels = np.ascontiguousarray(pixels)
+                key, data = frame_cache.lookup(pixels, settings)
+                if data is not None:
+                    ready[index] = (row, col, data)
+                elif pixels.dtype != np.uint8:
+                    ready[index] = (row, col, self.encoder(pixels))
+                else:
+                    pending[index] = (row, col, key)
+                    self.submit(index, pixels, collect)
+                while next_index in ready:
+                    yield ready.pop(next_index)
+                    next_index += 1
+            while self.in_flight:
+                collect()
+                while next_index in ready:
+                    yield ready.pop(next_index)
+                    next_index += 1
+        finally:
+            # 中斷時丟棄還在編碼的frame，下一次encode()從空的ring開始
+            while self.in_flight:
+                self.result()
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.release_memory()
@@ -0,0 +1,92 @@
+"""
+tile_size
+
+依照來源檔案每一層原生的圖塊(tile)大小，自動選擇輸出DICOM frame的大小。
+read amplification = 讀取一層時需要解碼的來源像素 / 該層的像素，
+frame大小不是來源tile的整數倍時，每個frame會跨到多個來源tile，同一個tile會被解碼好幾次。
+"""
+
+# 預設(也是viewer偏好)的frame大小
+PREFERRED_TILE_SIZE = 1024
+# 自動選擇時的候選範圍 (DICOM viewer常用的大小落在這個範圍)
+MIN_TILE_SIZE = 256
+MAX_TILE_SIZE = 2048
+
+
+def decoded_tiles(length, frame, tile):
+    """
+    沿著一個軸，把長度length以frame切割時，所有frame合計需要解碼的來源tile數量。
+    frame從0開始對齊，最後一個frame超出圖片的部分不需要解碼。
+    """
+    last_tile = (length - 1) // tile
+    total = 0
+    for start in range(0, length, frame):
+        end = min(start + frame, length) - 1
+        total += min(end // tile, last_tile) - start // tile + 1
+    return total
+
+
+def read_amplification(width, height, frame, tile):
+    """
+    Args:
+        width, height: 該層大小
+        frame: [frame_width, frame_height]
+        tile: [tile_width, tile_height] 來源的原生tile大小
+    Returns:
+        解碼的來源像素 / 該層像素 (1.0為最佳，每個來源tile只解碼一次)
+    """
+    decoded = decoded_tiles(width, frame[0], tile[0]) * decoded_tiles(height, frame[1], tile[1]) * tile[0] * tile[1]
+    return decoded / (width * height)
+
+
+def padding_ratio(width, height, frame):
+    """
+    最後一列/行的frame需補滿，輸出(需編碼)的像素 / 該層像素
+    """
+    columns = -(-width // frame[0])
+    rows = -(-height // frame[1])
+    return (columns * frame[0] * rows * frame[1]) / (width * height)
+
+
+def candidate_sizes(native_tile, preferred=PREFERRED_TILE_SIZE):
+    """
+    候選的frame邊長: 原生tile的整數倍，以及常見的2的次方大小
+    """
+    sizes = {preferred}
+    size = MIN_TILE_SIZE
+    while size <= MAX_TILE_SIZE:
+        sizes.add(size)
+        size *= 2
+    if native_tile and native_tile > 0:
+        multiple = native_tile
+        while multiple <= MAX_TILE_SIZE:
+            if multiple >= MIN_TILE_SIZE:
+                sizes.add(multiple)
+            multiple += native_tile
+    return sorted(sizes)
+
+
+def choose_tile_size(width, height, native_tile, preferred=PREFERRED_TILE_SIZE):
+    """
+    選擇一層的frame大小: read amplification最小者，相同時最接近preferred，再相同時補邊較少者。
+
+    Args:
+        width, height: 該層大小
+        native_tile: [tile_width, tile_height] 來源的原生tile大小，未知時為None
+        preferred: 偏好的frame大小
+    Returns:
+        [frame_width, frame_height]
+    """
+    if not native_tile or width <= 0 or height <= 0:
+        return [preferred, preferred]
+
+    # frame保持正方形，候選為兩個軸的原生tile倍數
+    best = None
+    for size in sorted(set(candidate_sizes(native_tile[0], preferred)) | set(candidate_sizes(native_tile[1], preferred))):
+        frame = [size, size]
+        score = (round(read_amplification(width, height, frame, native_tile), 4),
+                 abs(size - preferred),
+                 round(padding_ratio(width, height, frame), 4))
+        if best is None or score < best[0]:
+            best = (score, frame)
+    return best[1]
@@ -0,0 +1,95 @@
+"""
+uniform_frames
+
+大部分的frame是純背景: iSyntax的填充色 [254, 254, 254]，或 fill_transparent_with_white 之後的白色。
+編碼前先以numpy判斷frame是否為單一顏色，相同(顏色, 大小, 編碼設定)的frame只編碼一次，之後直接重複使用編碼結果。
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# 先檢查的稀疏取樣間隔，大部分有組織的frame在這一步就判斷為非單一顏色
+SAMPLE_STRIDE = 61
+MAX_CACHED_FRAMES = 64
+
+
+def uniform_color(pixels):
+    """
+    Args:
+        pixels: (height, width, channels) 的uint8陣列
+    Returns:
+        單一顏色時回傳顏色tuple，否則回傳None
+    """
+    pixels = np.asarray(pixels)
+    if pixels.ndim != 3 or pixels.size == 0:
+        return None
+    color = pixels[0, 0]
+    # 先比對稀疏取樣的像素，不一致時不需要掃描整張frame
+    flat = pixels.reshape(-1, pixels.shape[2])
+    if not (flat[::SAMPLE_STRIDE] == color).all():
+        return None
+    if not (flat == color).all():
+        return None
+    return tuple(int(value) for value in color)
+
+
+class uniform_frame_cache():
+    """
+    (顏色, 大小, 編碼設定) -> 編碼後的bytes，最多保留max_entries筆(LRU)。
+    同一個程序內的所有slide與level共用，相同的背景frame共用同一個bytes物件。
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_FRAMES) -> None:
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        pass
+
+    def lookup(self, pixels, settings):
+        """
+        Returns:
+            (key, bytes): 單一顏色且已編碼過時bytes為快取的結果；
+            單一顏色但尚未編碼時bytes為None，編碼後以store(key, bytes)存入；不是單一顏色時key為None
+        """
+        color = uniform_color(pixels)
+        if color is None:
+            return None, None
+
+        key = (color, tuple(np.asarray(pixels).shape), settings)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        return key, data
+
+    def store(self, key, data):
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = data
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def encode(self, pixels, settings, encoder):
+        """
+        Args:
+            pixels: (height, width, channels) 的uint8陣列
+            settings: 編碼設定 (codec, 參數等)，作為key的一部分
+            encoder: encoder(pixels) -> bytes
+        Returns:
+            編碼後的bytes
+        """
+        key, data = self.lookup(pixels, settings)
+        if data is not None:
+            return data
+        data = encoder(pixels)
+        if key is not None:
+            self.store(key, data)
+        return data
+
+
+# 預設共用的快取
+frame_cache = uniform_frame_cache()
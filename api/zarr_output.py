@@ -0,0 +1,165 @@
+"""
+zarr_output
+
+將金字塔的每一層寫成OME-Zarr (NGFF 0.4, Zarr v2 directory store)，一個frame對應一個chunk。
+axes為 (c, y, x)，chunk大小為 (3, tile_height, tile_width)，以zlib壓縮(numcodecs的"zlib"，zarr/ome-zarr讀取時不需額外設定)。
+array的shape為該層實際的大小；Zarr v2的邊緣chunk仍存成完整的chunk大小，超出圖片範圍的部分填入fill_value。
+各層相對於第0層的縮放倍率(downsample)存在該層的.zattrs，multiscales的scale由它產生。
+chunk的壓縮與寫檔在thread pool內同時進行，zlib壓縮時會釋放GIL。
+不依賴zarr套件，只寫出規格定義的 .zgroup / .zattrs / .zarray 與chunk檔案。
+"""
+import os
+import json
+import zlib
+from concurrent import futures
+from multiprocessing import cpu_count
+
+import numpy as np
+
+ZLIB_LEVEL = 1
+
+
+class zarr_level_writer():
+    """
+    一層(一個zarr array)的寫入器，submit() 把一個frame交給thread pool壓縮並寫成chunk檔。
+    """
+
+    def __init__(self, pyramid, path, width, height, tile_size, downsample=None) -> None:
+        self.pyramid = pyramid
+        self.path = path
+        self.width = int(width)
+        self.height = int(height)
+        self.tile_size = tile_size
+        self.pending = set()
+        self.created_rows = set()
+
+        os.makedirs(path, exist_ok=True)
+        zarray = {
+            "zarr_format": 2,
+            "shape": [3, int(height), int(width)],
+            "chunks": [3, int(tile_size[1]), int(tile_size[0])],
+            "dtype": "|u1",
+            "compressor": {"id": "zlib", "level": pyramid.compression_level},
+            "fill_value": 0,
+            "order": "C",
+            "filters": None,
+            "dimension_separator": "/",
+        }
+        with open(os.path.join(path, ".zarray"), "w", encoding="utf-8") as file:
+            json.dump(zarray, file, indent=4)
+        if downsample is not None:
+            with open(os.path.join(path, ".zattrs"), "w", encoding="utf-8") as file:
+                json.dump({"downsample": float(downsample)}, file, indent=4)
+
+    def submit(self, row, col, pixels):
+        """
+        pixels: (tile_height, tile_width, 3) 的RGB陣列，邊緣的frame需補滿，超出圖片範圍的部分寫入時清除
+        """
+        # chunk key為 "0/{row}/{col}"，資料夾先在主執行緒建立
+        if row not in self.created_rows:
+            os.makedirs(os.path.join(self.path, "0", str(row)), exist_ok=True)
+            self.created_rows.add(row)
+
+        # 限制未完成的工作數量，避免frame全部堆在記憶體
+        if len(self.pending) >= self.pyramid.max_workers * 4:
+            done, self.pending = futures.wait(self.pending, return_when=futures.FIRST_COMPLETED)
+            for job in done:
+                job.result()
+        self.pending.add(self.pyramid.executor.submit(self.write_chunk, row, col, pixels))
+
+    def write_chunk(self, row, col, pixels):
+        # (y, x, c) -> (c, y, x)
+        chunk = np.ascontiguousarray(np.asarray(pixels, dtype=np.uint8).transpose(2, 0, 1))
+        # 邊緣chunk只保留圖片範圍內的像素，其餘為fill_value
+        valid_height = self.height - row * int(self.tile_size[1])
+        valid_width = self.width - col * int(self.tile_size[0])
+        if valid_height < chunk.shape[1] or valid_width < chunk.shape[2]:
+            chunk[:, max(valid_height, 0):, :] = 0
+            chunk[:, :, max(valid_width, 0):] = 0
+        data = zlib.compress(chunk.tobytes(), self.pyramid.compression_level)
+        with open(os.path.join(self.path, "0", str(row), str(col)), "wb") as file:
+            file.write(data)
+
+    def close(self):
+        for job in futures.as_completed(self.pending):
+            job.result()
+        self.pending = set()
+
+
+class zarr_pyramid():
+    """
+    一個slide的OME-Zarr輸出: {output_path}/{level}/ 為各層的array，
+    close() 時依照資料夾內所有已寫出的層產生multiscales metadata。
+    """
+
+    def __init__(self, output_path, name="", max_workers=None, compression_level=ZLIB_LEVEL) -> None:
+        self.output_path = output_path
+        self.name = name
+        self.max_workers = max_workers or cpu_count()
+        self.compression_level = compression_level
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+        os.makedirs(output_path, exist_ok=True)
+        with open(os.path.join(output_path, ".zgroup"), "w", encoding="utf-8") as file:
+            json.dump({"zarr_format": 2}, file)
+
+    def level_writer(self, level, width, height, tile_size, downsample=None):
+        """
+        width, height: 該層實際的大小 (不是frame補滿後的大小)
+        downsample: 相對於第0層的縮放倍率
+        """
+        return zarr_level_writer(self, os.path.join(self.output_path, str(level)), width, height, tile_size, downsample)
+
+    def write_level(self, level):
+        """
+        寫入一個pyramid_level
+        """
+        writer = self.level_writer(level.level, level.width, level.height, level.tile_size, level.downsample)
+        for row, col, pixels in level.tiles():
+            writer.submit(row, col, pixels)
+        writer.close()
+        print(f"Zarr level {level.level} written: [{level.width}, {level.height}]")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+        # 以資料夾內已存在的層產生metadata (重複執行只補寫部分層時也完整)
+        shapes = {}
+        downsamples = {}
+        for entry in os.listdir(self.output_path):
+            zarray_path = os.path.join(self.output_path, entry, ".zarray")
+            if os.path.isfile(zarray_path):
+                with open(zarray_path, "r", encoding="utf-8") as file:
+                    shapes[entry] = json.load(file)["shape"]
+                zattrs_path = os.path.join(self.output_path, entry, ".zattrs")
+                if os.path.isfile(zattrs_path):
+                    with open(zattrs_path, "r", encoding="utf-8") as file:
+                        downsamples[entry] = json.load(file).get("downsample")
+        if not shapes:
+            return
+
+        # 由大到小排列，scale為相對於第0層的縮放倍率；沒有記錄downsample的層以相對於最大層的大小比例估計
+        paths = sorted(shapes, key=lambda p: shapes[p][2], reverse=True)
+        base_height, base_width = shapes[paths[0]][1], shapes[paths[0]][2]
+        datasets = []
+        for path in paths:
+            if downsamples.get(path):
+                scale = [1.0, downsamples[path], downsamples[path]]
+            else:
+                scale = [1.0, base_height / shapes[path][1], base_width / shapes[path][2]]
+            datasets.append({"path": path, "coordinateTransformations": [{"type": "scale", "scale": scale}]})
+
+        zattrs = {
+            "multiscales": [{
+                "version": "0.4",
+                "name": self.name,
+                "axes": [
+                    {"name": "c", "type": "channel"},
+                    {"name": "y", "type": "space"},
+                    {"name": "x", "type": "space"},
+                ],
+                "datasets": datasets,
+            }]
+        }
+        with open(os.path.join(self.output_path, ".zattrs"), "w", encoding="utf-8") as file:
+            json.dump(zattrs, file, indent=4)
@@ -1,7 +1,7 @@
-import re
 import os
 import pydicom
 import shutil
+import numpy as np
 import traceback
 
 from pixelengine import PixelEngine
@@ -10,14 +10,40 @@ from api.imgs2dcm import imgs2dcm
 from api.imgfile_info import imgfile_info
 from api.iSyntax.sdk.backends import Backends
 from api.iSyntax.sdk.extract_pixel_data import extract_pixel_data
-from api.iSyntax.sdk.patch_extraction import tiles_extraction_calculations, create_patch_list, create_folder
+from api.iSyntax.sdk.patch_extraction import tiles_extraction_calculations, create_patch_list
+from api.tile_record import tile_grid
+from api.pyramid_level import pyramid_level
+from api.tiff_output import write_tiff_pyramid, TIFF_TILE_SIZE
+from api.zarr_output import zarr_pyramid
+from api.tile_size import choose_tile_size
+from api.iSyntax.sdk.region_tracker import RegionTracker
+from api.roi import clip_roi, roi_origin
+from api.level_selection import select_levels
 
 
 
 class iSyntax2Dcm(Singleton):
     pixel_engine: PixelEngine = None
+    # SOFTWARE, GLES2, GLES3 or AUTO (GPU if a GL context can be created, SOFTWARE otherwise)
+    render_backend = "AUTO"
     tile_size = [1024, 1024]
+    # True: choose the frame size per level from the native block size (preferring tile_size), False: always tile_size
+    auto_tile_size = True
     tmp_folder = "./temp/"
+    # Also write an OME-Zarr ({output_folder}/{name}.zarr) while converting to DICOM
+    zarr_output = False
+    # Every written DICOM instance is handed to this sink (e.g. stow_sink) for upload, None to keep files only
+    dicom_sink = None
+    # Frames are encoded by the encoder processes of this tile_ring when set
+    tile_ring = None
+    # Threads writing patches and compressing TIFF/Zarr output, 0 for cpu_count()
+    write_threads = 0
+    # Render backend the PixelEngine was initialized with (what AUTO resolved to)
+    backend_name = ""
+    # Convert only these regions [(x0, y0, x1, y1)] in level 0 pixels, each into {output_folder}/roi_{n}/; empty for the whole slide
+    rois = []
+    # Levels to convert (result of api.level_selection.parse_levels), "default" converts level 1
+    levels = "default"
 
     def __init__(self):
         super().__init__()
@@ -25,7 +51,11 @@ class iSyntax2Dcm(Singleton):
         if self.pixel_engine is None:
             print("Initializing PixelEngine...")  # Debug information
             backends = Backends()
-            render_backend, render_context = backends.initialize_backend("GLES2") #SOFTWARE
+            if self.render_backend == "AUTO":
+                self.backend_name, render_backend, render_context = backends.initialize_auto_backend()
+            else:
+                self.backend_name = self.render_backend
+                render_backend, render_context = backends.initialize_backend(self.render_backend)
             self.pixel_engine = PixelEngine(render_backend, render_context)
         else:
             print("PixelEngine already initialized.")  # Debug information
@@ -55,19 +85,28 @@ class iSyntax2Dcm(Singleton):
             print(file_info.convert_status)
 
             if image_type == "WSI":
-                raw_size = [view.dimension_ranges(0)[1][2], view.dimension_ranges(0)[0][2]]
+                zarr_writer = zarr_pyramid(os.path.join(raw_outputFolder, f"{image_name}.zarr"), image_name, self.write_threads or None) if self.zarr_output else None
+                raw_size = [view.dimension_ranges(0)[0][2], view.dimension_ranges(0)[1][2]]
+                # The whole slide, or one set of instances per ROI
+                regions = [(None, raw_outputFolder)]
+                if self.rois:
+                    regions = self.roi_regions(raw_size, raw_outputFolder)
                 # for i in range(view.num_derived_levels, view.num_derived_levels-1, -1):
-                for i in range(1, 0, -1):
+                for (roi, roi_outputFolder), i in [(region, i) for region in regions for i in self.selected_levels(view, region[1], output_file)]:
                     x_dimension_range = dict(zip(['first', 'increment', 'last'], (view.dimension_ranges(i)[0])))
                     y_dimension_range = dict(zip(['first', 'increment', 'last'], (view.dimension_ranges(i)[1])))
-                    dimensions = [0, 0, raw_size[0], raw_size[1], self.tile_size[0] * x_dimension_range['increment'], self.tile_size[1] * y_dimension_range['increment']]
+                    level_tile_size = self.level_tile_size(pe_input, view, i)
+                    extent = [0, 0, raw_size[0], raw_size[1]]
+                    if roi is not None:
+                        extent = self.level_roi_extent(roi, x_dimension_range, y_dimension_range)
+                    dimensions = extent + [level_tile_size[0] * x_dimension_range['increment'], level_tile_size[1] * y_dimension_range['increment']]
 
                     if os.path.exists(tmp_folder):
                         shutil.rmtree(tmp_folder)
                     os.mkdir(tmp_folder)
 
                     ### Check for duplicate files ###
-                    dcm_path = os.path.join(raw_outputFolder, str(i), output_file)
+                    dcm_path = os.path.join(roi_outputFolder, str(i), output_file)
                     try:
                         # Check if file exists and is a valid DICOM file
                         dcm_file = pydicom.dcmread(dcm_path)
@@ -84,17 +123,28 @@ class iSyntax2Dcm(Singleton):
 
                     file_info.convert_status = f"Converting image file to PNG"
                     # print(file_info.convert_status)
-                    image_folder_name = self.tiles_extraction(str(dimensions).replace("[", "").replace("]", ""), i, image_name, view, self.pixel_engine, False, file_info)
-                    self.rename_patches(image_folder_name)
+                    tiles = self.tiles_extraction(str(dimensions).replace("[", "").replace("]", ""), i, image_name, view, self.pixel_engine, False, file_info)
 
                     file_info.convert_status = f"Converting PNG image files to DICOM"
                     # print(file_info.convert_status)
-                    file_info.output_folder = f"{raw_outputFolder}/{i}/"
+                    file_info.output_folder = f"{roi_outputFolder}/{i}/"
                     os.makedirs(file_info.output_folder, exist_ok=True)
-                    imgs2dcm(tmp_folder, file_info, "png", print)
+                    if roi is None:
+                        imgs2dcm(tmp_folder, file_info, "png", print, level=i, tiles=tiles, zarr_writer=zarr_writer, sink=self.dicom_sink, ring=self.tile_ring,
+                                 level_size=self.level_dimensions(view, i), downsample=x_dimension_range['increment'])
+                    else:
+                        # the level grid starts at the ROI corner snapped to the pixels of this level
+                        origin = roi_origin(extent, [view.scale[0], view.scale[1]])
+                        # pixels of this level covered by the ROI
+                        roi_size = [-(-(extent[2] - extent[0]) // x_dimension_range['increment']), -(-(extent[3] - extent[1]) // y_dimension_range['increment'])]
+                        imgs2dcm(tmp_folder, file_info, "png", print, level=i, tiles=tiles, sink=self.dicom_sink, ring=self.tile_ring, origin=origin, instance_key=str(roi),
+                                 level_size=roi_size)
                     file_info.convert_status = f"Completed ({output_file}_{i})"
                     # print(file_info.convert_status)
 
+                if zarr_writer is not None:
+                    zarr_writer.close()
+
                 for index in range(pe_input.num_images):
                     image_type = pe_input[index].image_type
                     if image_type != "WSI":
@@ -111,21 +161,198 @@ class iSyntax2Dcm(Singleton):
             if os.path.exists(tmp_folder):
                 shutil.rmtree(tmp_folder)
 
-    def rename_patches(self, folder_name):
-        file_name_list = os.listdir(folder_name)
-        file_replace_list = []
+    def convert_pyramid(self, file_info: imgfile_info, output_format):
+        """
+        Write every level (largest first) of the WSI into one pyramid file:
+        tiff: {output_folder}/{name}.tiff, pyramidal BigTIFF with 512 tiles
+        zarr: {output_folder}/{name}.zarr, OME-Zarr with one chunk per tile_size frame
+        """
+        pe_input = self.pixel_engine["in"]
+        try:
+            if not os.path.exists(file_info.input_file):
+                raise FileNotFoundError(f"File not found: {file_info.input_file}")
 
-        for i in range(len(file_name_list)):
-            old_name_data = re.split(r'[._]', file_name_list[i])
-            x_index = int(int(old_name_data[-5]) / self.tile_size[0]) if old_name_data[-5] != '0' else 0
-            y_index = int(int(old_name_data[-6]) / self.tile_size[0]) if old_name_data[-6] != '0' else 0
-            new_file_name = f"layer_{old_name_data[-2]}_region_{x_index}_{y_index}.png"
-            file_replace_list.append([file_name_list[i], new_file_name])
+            os.makedirs(file_info.output_folder, exist_ok=True)
+            image_name = os.path.splitext(file_info.output_filename)[0]
+            output_file = os.path.join(file_info.output_folder, f"{image_name}.{output_format}")
+            print(f"Processing file: {os.path.basename(file_info.input_file)}")
 
-        for i in range(len(file_replace_list)):
-            os.rename(os.path.join(folder_name, file_replace_list[i][0]), os.path.join(self.tmp_folder, file_replace_list[i][1]))
+            pe_input.open(file_info.input_file)
+            view = pe_input["WSI"].source_view
+            levels = []
+            for i in range(view.num_derived_levels + 1):
+                width, height = self.level_dimensions(view, i)
+                tile_size = TIFF_TILE_SIZE if output_format == "tiff" else self.level_tile_size(pe_input, view, i)
+                levels.append(pyramid_level(i, width, height, tile_size, lambda level=i, size=tile_size: self.read_level_tiles(view, level, size),
+                                            view.dimension_ranges(i)[0][1]))
+
+            file_info.convert_status = f"Writing {output_format}"
+            if output_format == "tiff":
+                write_tiff_pyramid(output_file, levels, max_workers=self.write_threads or None)
+            else:
+                zarr_writer = zarr_pyramid(output_file, image_name, self.write_threads or None)
+                for level in levels:
+                    zarr_writer.write_level(level)
+                zarr_writer.close()
+            file_info.convert_status = f"Completed ({output_file})"
+            print(file_info.convert_status)
+        except Exception as e:
+            file_info.convert_status = f"Error during conversion: {e}"
+            print(file_info.convert_status)
+        finally:
+            pe_input.close()
+
+    def selected_levels(self, view, output_folder, output_file):
+        """
+        Levels to convert, highest first; "missing" checks {output_folder}/{level}/{output_file}
+        """
+        return select_levels(self.levels, view.num_derived_levels + 1, [1],
+                             lambda level: os.path.join(output_folder, str(level), output_file))
+
+    def roi_regions(self, raw_size, output_folder):
+        """
+        rois clipped to the slide
+        :return: [(roi, output folder of the roi)]
+        """
+        regions = []
+        for n, roi in enumerate(self.rois):
+            clipped = clip_roi(roi, raw_size[0], raw_size[1])
+            if clipped is None:
+                print(f"ROI {roi} is outside of the slide {raw_size}, skipped")
+                continue
+            regions.append((clipped, f"{output_folder}/roi_{n}"))
+        return regions
+
+    def level_roi_extent(self, roi, x_dimension_range, y_dimension_range):
+        """
+        [x_start, y_start, x_end, y_end] of a roi in level 0 units, the start snapped down to a pixel of the level
+        """
+        x_start = x_dimension_range['first'] + (roi[0] - x_dimension_range['first']) // x_dimension_range['increment'] * x_dimension_range['increment']
+        y_start = y_dimension_range['first'] + (roi[1] - y_dimension_range['first']) // y_dimension_range['increment'] * y_dimension_range['increment']
+        return [x_start, y_start, roi[2], roi[3]]
+
+    def level_dimensions(self, view, level):
+        """
+        [width, height] in pixels of a level
+        """
+        x_range, y_range = view.dimension_ranges(level)[0], view.dimension_ranges(level)[1]
+        return [(x_range[2] - x_range[0]) // x_range[1] + 1, (y_range[2] - y_range[0]) // y_range[1] + 1]
+
+    def native_tile_size(self, pe_input):
+        """
+        [width, height] of the iSyntax blocks (the same pixel size on every level), None if unknown
+        """
+        try:
+            block_size = pe_input["WSI"].block_size()
+            sizes = []
+            for dim in list(block_size)[:2]:
+                # either a plain size or a [first, increment, last] range
+                if isinstance(dim, (list, tuple)):
+                    sizes.append((dim[2] - dim[0]) // dim[1] + 1)
+                else:
+                    sizes.append(int(dim))
+            return sizes if len(sizes) == 2 and min(sizes) > 0 else None
+        except Exception:
+            return None
 
-        shutil.rmtree(folder_name)
+    def level_tile_size(self, pe_input, view, level):
+        """
+        Frame size [width, height] of a level. With auto_tile_size the size with the lowest
+        read amplification against the native block size is chosen, preferring tile_size.
+        """
+        if not self.auto_tile_size:
+            return list(self.tile_size)
+        width, height = self.level_dimensions(view, level)
+        native_tile = self.native_tile_size(pe_input)
+        tile_size = choose_tile_size(width, height, native_tile, self.tile_size[0])
+        print(f"Level {level}: native block = {native_tile}, frame = {tile_size}")
+        return tile_size
+
+    def level_grid(self, view, level, tile_size):
+        """
+        Frame grid of a level in level 0 units
+        :return: (x_start, y_start, tile_width, tile_height, rows, columns)
+        """
+        x_start, step_x = view.dimension_ranges(level)[0][0], view.dimension_ranges(level)[0][1]
+        y_start, step_y = view.dimension_ranges(level)[1][0], view.dimension_ranges(level)[1][1]
+        x_end, y_end = view.dimension_ranges(level)[0][2], view.dimension_ranges(level)[1][2]
+        tile_width, tile_height = tile_size[0] * step_x, tile_size[1] * step_y
+        num_x_tiles = (x_end - x_start) // tile_width + 1
+        num_y_tiles = (y_end - y_start) // tile_height + 1
+        return x_start, y_start, tile_width, tile_height, num_y_tiles, num_x_tiles
+
+    def read_level_tiles(self, view, level, tile_size, rows=None, positions=None):
+        """
+        Request all tiles of a level and yield them as they are returned by the PixelEngine
+        :param rows: (row_start, row_end) to request only that band of frame rows, None for the whole level
+        :param positions: (row, col) list to request only those frames (sampling)
+        :return: generator of (row, col, RGB array), tiles beyond the image are background filled
+        """
+        x_start, y_start, tile_width, tile_height, num_y_tiles, num_x_tiles = self.level_grid(view, level, tile_size)
+        row_start, row_end = rows if rows is not None else (0, num_y_tiles)
+
+        grid = tile_grid(x_start, y_start, tile_width, tile_height)
+        if positions is not None:
+            # same view ranges as create_patch_list, the range is inclusive
+            patches = [[x_start + col * tile_width, x_start + (col + 1) * tile_width - (2 ** level),
+                        y_start + row * tile_height, y_start + (row + 1) * tile_height - (2 ** level), level]
+                       for row, col in positions]
+        else:
+            patches = create_patch_list(row_end - row_start, num_x_tiles, [tile_width, tile_height], [x_start, y_start + row_start * tile_height], level)
+        regions = view.request_regions(patches, view.data_envelopes(level), True, [254, 254, 254])
+        tracker = RegionTracker(regions)
+        while len(tracker) > 0:
+            for region in self.pixel_engine.wait_any():
+                if not tracker.complete(region):
+                    continue
+                _, row, col = grid.index(region.range)
+                pixels = np.empty(tile_size[0] * tile_size[1] * 3, dtype=np.uint8)
+                region.get(pixels)
+                yield row, col, pixels.reshape(tile_size[1], tile_size[0], 3)
+
+    def band_levels(self, file_info: imgfile_info):
+        """
+        Levels converted by convert() with their frame grid, for row band conversion
+        :return: [(level, tile_size, rows, columns)]
+        """
+        pe_input = self.pixel_engine["in"]
+        pe_input.open(file_info.input_file)
+        try:
+            view = pe_input["WSI"].source_view
+            layouts = []
+            for i in self.selected_levels(view, file_info.output_folder, file_info.output_filename):
+                tile_size = self.level_tile_size(pe_input, view, i)
+                _, _, _, _, rows, columns = self.level_grid(view, i, tile_size)
+                layouts.append((i, tile_size, rows, columns))
+            return layouts
+        finally:
+            pe_input.close()
+
+    def level_band_frames(self, file_info: imgfile_info, level, tile_size, row_start, row_end):
+        """
+        Frames of rows row_start..row_end (exclusive) of a level
+        :return: generator of (row, col, RGB array)
+        """
+        pe_input = self.pixel_engine["in"]
+        pe_input.open(file_info.input_file)
+        try:
+            view = pe_input["WSI"].source_view
+            yield from self.read_level_tiles(view, level, tile_size, (row_start, row_end))
+        finally:
+            pe_input.close()
+
+    def level_sample_frames(self, file_info: imgfile_info, level, tile_size, positions):
+        """
+        Frames at the given (row, col) positions of a level, to estimate the compression ratio
+        :return: generator of (row, col, RGB array)
+        """
+        pe_input = self.pixel_engine["in"]
+        pe_input.open(file_info.input_file)
+        try:
+            view = pe_input["WSI"].source_view
+            yield from self.read_level_tiles(view, level, tile_size, positions=list(positions))
+        finally:
+            pe_input.close()
 
     def tiles_extraction(self, dimensions, level, image_name, view, pixel_engine, async_yes_no, file_info: imgfile_info):
         x_start, x_end, y_start, y_end, tile_width, tile_height = tiles_extraction_calculations(dimensions, level)
@@ -139,13 +366,12 @@ class iSyntax2Dcm(Singleton):
 
         try:
             patches = create_patch_list(num_y_tiles, num_x_tiles, [tile_width, tile_height], [x_start, y_start], level)
-            isyntax_file_name = image_name
-            image_name = f"{image_name}_{len(patches)}"
-            create_folder(image_name)
+            # (level, row, col) of every patch is derived from region.range on this grid,
+            # the PNGs are written straight into tmp_folder without coordinates to parse back
+            grid = tile_grid(x_start, y_start, tile_width, tile_height)
 
             data_envelopes = view.data_envelopes(level)
             regions = view.request_regions(patches, data_envelopes, async_yes_no, [254, 254, 254])
-            extract_pixel_data(view, regions, pixel_engine, image_name, isyntax_file_name, file_info, print)
-            return image_name
+            return extract_pixel_data(view, regions, pixel_engine, self.tmp_folder, image_name, file_info, print, grid, self.write_threads or None)
         except RuntimeError:
             traceback.print_exc()
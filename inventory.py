@@ -0,0 +1,42 @@
+import os
+import argparse
+
+from api.file_index import file_index
+from api.convert_api_type import convert_api_type
+from api.slide_inventory import slide_inventory, write_inventory, INVENTORY_WORKERS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read the properties of every slide below a folder into one SQLite or Parquet table")
+    parser.add_argument("-s", "--source", required=True, help='Slide file, or a folder searched recursively for iSyntax and OpenSlide files')
+    parser.add_argument("-o", "--output", required=True, help='Inventory file: .parquet writes Parquet (needs pyarrow), anything else SQLite (table "slides")')
+    parser.add_argument("-w", "--workers", type=int, default=INVENTORY_WORKERS, help=f'Slides opened in parallel (default {INVENTORY_WORKERS})')
+    parser.add_argument("--isyntax-backend", dest="isyntax_backend", default='SOFTWARE', help='PixelEngine render backend; no pixels are rendered, so SOFTWARE (default) is enough')
+
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        input_files = sorted(file_index.scan(args.source).match(convert_api_type.iSyntax.ext_name + convert_api_type.Openslide.ext_name))
+    else:
+        input_files = [args.source]
+
+    # the SDKs are only loaded for the formats found
+    open_slide, pixel_engine = None, None
+    if any(path.lower().endswith(".isyntax") for path in input_files):
+        from iSyntax2Dcm import iSyntax2Dcm
+        iSyntax2Dcm.render_backend = args.isyntax_backend
+        pixel_engine = iSyntax2Dcm()._instance.pixel_engine
+    if any(not path.lower().endswith(".isyntax") for path in input_files):
+        from Openslide2Dcm import OpenSlide as open_slide
+
+    inventory = slide_inventory(open_slide, pixel_engine, args.workers)
+    records = inventory.collect(input_files)
+    write_inventory(args.output, records)
+    failed = sum(1 for record in records if record["error"])
+    print(f"{len(records)} slide(s) written to {args.output}, {failed} failed")
+
+"""
+python inventory.py -s "source_path" -o "inventory.sqlite"
+python inventory.py -s "//nas/wsi" -o "inventory.parquet" -w 32
+sqlite3 inventory.sqlite "SELECT vendor, COUNT(*), SUM(width * height) FROM slides GROUP BY vendor"
+"""
@@ -0,0 +1,22 @@
+import argparse
+
+from api.reissue import reissue_folder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reissue converted DICOM WSI with a new header, copying the encoded Pixel Data without decoding")
+    parser.add_argument("-s", "--source", required=True, help='Converted DICOM file, or a folder searched recursively for .dcm files')
+    parser.add_argument("-o", "--output", required=True, help='Output path for the reissued files (relative paths under a source folder are kept)')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-m", "--metadata", help='Full tag file: the header is rebuilt with dataset_from_tag_file, keeping the original Study/Series UIDs unless the file gives them')
+    group.add_argument("-u", "--update", help='Metadata update file: only the tags it lists are replaced, everything else is kept')
+
+    args = parser.parse_args()
+
+    count = reissue_folder(args.source, args.output, args.metadata or "", args.update or "")
+    print(f"{count} file(s) reissued")
+
+"""
+python reissue.py -s "output_path/slide" -o "reissued_path/slide" -m "metadata_path/slide.txt"
+python reissue.py -s "output_path/slide/1/slide.dcm" -o "reissued_path/slide/1" -u "corrections.txt"
+"""
@@ -2,7 +2,8 @@ import argparse
 
 from api.convert_api_type import convert_api_type
 from api.convert_mode_type import convert_mode_type
-from wsi_converter import wsi_converter
+from api.level_selection import parse_levels
+from wsi_converter import wsi_converter, MIN_TILE_SIZE
 
 
 if __name__ == "__main__":
@@ -12,6 +13,29 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--metadata", help='Path to metadata files if required')
     parser.add_argument("-mode", "--convert_mode", choices=['single_file', 'folder', 'metadata'], required=True, help='Conversion mode')
     parser.add_argument("-api", "--convert_api", choices=['iSyntax', 'Openslide'], required=True, help='Conversion API')
+    parser.add_argument("--isyntax-backend", dest="isyntax_backend", choices=['AUTO', 'SOFTWARE', 'GLES2', 'GLES3'], default='AUTO', help='PixelEngine render backend, AUTO falls back to SOFTWARE without a GL context')
+    parser.add_argument("--output-format", dest="output_format", choices=['dicom', 'tiff', 'zarr', 'dicom+zarr'], default='dicom', help='dicom: one DICOM WSI per level, tiff: one pyramidal JPEG-compressed BigTIFF per slide, zarr: one OME-Zarr per slide, dicom+zarr: DICOM plus OME-Zarr of the converted levels in one pass')
+    parser.add_argument("--tile-size", dest="tile_size", default='auto', help='Frame size in pixels, or auto (default) to pick per level the size with the least read amplification against the source tiles')
+    parser.add_argument("--deterministic-uids", dest="deterministic_uids", action='store_true', help='Derive Study/Series/SOP Instance UIDs from the source file content, level and encoder settings so re-runs are identical')
+    parser.add_argument("--read-threads", dest="read_threads", type=int, default=0, help='OpenSlide: number of threads reading tiles, each with its own slide handle (default min(8, CPU count), or the reader share of --cpu-budget when a budget is set)')
+    parser.add_argument("--cache-mb", dest="cache_mb", type=int, default=256, help='OpenSlide: size in MiB of the tile cache shared by the reader threads (0 disables the shared cache)')
+    parser.add_argument("--worker-folder", dest="worker_folder", default='', help='Shared folder for lease files; every worker started with the same source/output/worker folder claims different slides')
+    parser.add_argument("--lease-timeout", dest="lease_timeout", type=int, default=300, help='Seconds without heartbeat after which a leased slide is re-queued (default 300)')
+    parser.add_argument("--split-bands", dest="split_bands", type=int, default=0, help='With --worker-folder: split each DICOM level into N row bands encoded by different workers and merged into one instance')
+    parser.add_argument("--watch", action='store_true', help='Keep watching the source folder and convert each new slide once its size is stable')
+    parser.add_argument("--settle-seconds", dest="settle_seconds", type=int, default=30, help='Watch mode: seconds a new file must stay unchanged before it is converted (default 30)')
+    parser.add_argument("--stow-url", dest="stow_url", default='', help='DICOMweb base URL; every converted instance is uploaded with STOW-RS while the next level converts')
+    parser.add_argument("--stow-connections", dest="stow_connections", type=int, default=4, help='Concurrent STOW-RS uploads, each on its own keep-alive connection (default 4)')
+    parser.add_argument("--cstore", dest="cstore", action='append', default=[], help='C-STORE every converted instance to AE_TITLE@host:port over one persistent association (repeat for several destinations)')
+    parser.add_argument("--calling-ae", dest="calling_ae", default='WSI2DCM', help='Our AE title for C-STORE (default WSI2DCM)')
+    parser.add_argument("--prefetch-mb", dest="prefetch_mb", type=int, default=0, help='Read the next slide ahead (metadata and up to this many MiB of the first frames it converts) while the current one converts; 0 (default) disables it')
+    parser.add_argument("--encode-processes", dest="encode_processes", default='0', help='Encode frames in N processes fed through a shared-memory tile ring instead of in the converting process, auto for the encoder share of the CPU budget (default 0)')
+    parser.add_argument("--cpu-budget", dest="cpu_budget", type=int, default=0, help='Cores this conversion may use, split between the reader, encoder and writer stages (default: no split, every stage keeps its own default)')
+    parser.add_argument("--concurrent-slides", dest="concurrent_slides", type=int, default=1, help='Slides converted at the same time on this machine (e.g. several workers), each gets cpu-budget / N cores (default 1)')
+    parser.add_argument("--levels", dest="levels", default='default', help='Levels to convert: default (iSyntax 1, OpenSlide 1..N-1), all, missing (levels without a complete DICOM in the output folder) or a list such as 0,2,4-6')
+    parser.add_argument("--roi", dest="roi", default='', help='Convert only a region: x0,y0,x1,y1 in level 0 pixels, or a GeoJSON file with one region per feature (bounding box)')
+    parser.add_argument("--plan", dest="plan", action='store_true', help='Estimate frames, output size, peak RAM and time per slide from the headers and a few sampled frames instead of converting')
+    parser.add_argument("--benchmark-backends", dest="benchmark_backends", action='store_true', help='Time regions/second of each iSyntax render backend on the source files instead of converting')
 
     args = parser.parse_args()
 
@@ -23,9 +47,52 @@ if __name__ == "__main__":
 
     converter.convert_mode = convert_mode_type[args.convert_mode]
     converter.convert_api = convert_api_type[args.convert_api]
+    converter.isyntax_backend = args.isyntax_backend
+    converter.output_format = args.output_format
+    converter.deterministic_uids = args.deterministic_uids
+    if args.tile_size != "auto" and not (args.tile_size.isdigit() and int(args.tile_size) >= MIN_TILE_SIZE):
+        parser.error(f"--tile-size must be auto or a number of pixels >= {MIN_TILE_SIZE}")
+    converter.tile_size = args.tile_size
+    converter.read_threads = args.read_threads
+    converter.cache_mb = args.cache_mb
+    converter.worker_folder = args.worker_folder
+    converter.lease_timeout = args.lease_timeout
+    if args.split_bands > 0 and not args.worker_folder:
+        parser.error("--split-bands needs --worker-folder")
+    converter.split_bands = args.split_bands
+
+    converter.settle_seconds = args.settle_seconds
+    converter.stow_url = args.stow_url
+    converter.stow_connections = args.stow_connections
+    converter.cstore_destinations = args.cstore
+    converter.calling_ae = args.calling_ae
+    converter.prefetch_mb = args.prefetch_mb
+    if args.encode_processes != "auto" and not args.encode_processes.isdigit():
+        parser.error("--encode-processes must be auto or a number of processes")
+    converter.encode_processes = -1 if args.encode_processes == "auto" else int(args.encode_processes)
+    converter.cpu_budget = args.cpu_budget
+    converter.concurrent_slides = args.concurrent_slides
+    if args.roi and (args.output_format in ('tiff', 'zarr') or args.split_bands > 0):
+        parser.error("--roi only applies to DICOM output without --split-bands")
+    converter.roi = args.roi
+    try:
+        parse_levels(args.levels)
+    except ValueError as e:
+        parser.error(str(e))
+    converter.levels = args.levels
+    if args.watch and args.convert_mode != 'folder':
+        parser.error("--watch needs -mode folder")
+
+    if args.watch:
+        converter.watch()
+        exit()
 
     valid = converter.check_valid()
-    if valid == "OK":
+    if valid == "OK" and args.benchmark_backends:
+        converter.benchmark_backends()
+    elif valid == "OK" and args.plan:
+        converter.plan()
+    elif valid == "OK":
         converter.convert()
     else:
         print(valid)
@@ -34,10 +101,28 @@ if __name__ == "__main__":
 Openslide
 
 python wsi2dcm.py -s "source_path" -o "output_path" -m "metadata_path" -mode metadata -api Openslide
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api Openslide --output-format tiff
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api Openslide --output-format dicom+zarr
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api Openslide --read-threads 16 --cache-mb 1024
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api Openslide --encode-processes 8
+python wsi2dcm.py -s "//nas/wsi/batch_1" -o "//nas/wsi/output" -mode folder -api iSyntax --worker-folder "//nas/wsi/queue" --encode-processes auto --cpu-budget 32 --concurrent-slides 2
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api Openslide --plan
+python wsi2dcm.py -s "slide.svs" -o "output_path" -mode single_file -api Openslide --roi 20000,15000,28000,21000
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api Openslide --levels missing
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api iSyntax --prefetch-mb 2048
+python wsi2dcm.py -s "//nas/wsi/batch_1" -o "//nas/wsi/output" -mode folder -api Openslide --worker-folder "//nas/wsi/queue"
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api Openslide --stow-url "http://pacs:8080/dicom-web" --stow-connections 8
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api iSyntax --cstore PACS@10.0.0.5:104 --calling-ae WSI2DCM
+python wsi2dcm.py -s "landing_path" -o "output_path" -mode folder -api Openslide --watch --settle-seconds 60
+python wsi2dcm.py -s "//nas/wsi/huge.svs" -o "//nas/wsi/output" -mode single_file -api Openslide --worker-folder "//nas/wsi/queue" --split-bands 12
 python wsi2dcm.py -s "D:\AUUFFC_data\_WSI\_ncku_wsi_nash\send1\batch_1" -o "D:\AUUFFC_data\_WSI\_ncku_wsi_nash\send1\output" -m "D:\AUUFFC_data\_WSI\_ncku_wsi_nash\send1\metadata" -mode metadata -api Openslide
 
 iSyntax
 
 python wsi2dcm.py -s "source_path" -o "output_path" -m "metadata_path" -mode metadata -api iSyntax
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api iSyntax --isyntax-backend SOFTWARE
+python wsi2dcm.py -s "file.isyntax" -o "output_path" -mode single_file -api iSyntax --roi "annotations.geojson"
+python wsi2dcm.py -s "source_path" -o "output_path" -mode folder -api iSyntax --levels 0
+python wsi2dcm.py -s "file.isyntax" -o "output_path" -mode single_file -api iSyntax --benchmark-backends
 
 """
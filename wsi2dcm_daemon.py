@@ -0,0 +1,23 @@
+import argparse
+
+from api.conversion_daemon import serve, ISYNTAX_BACKENDS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the WSI to DICOM conversion daemon")
+    parser.add_argument("--host", default='127.0.0.1', help='Address to listen on (default 127.0.0.1, local only)')
+    parser.add_argument("--port", type=int, default=8642, help='HTTP port (default 8642)')
+    parser.add_argument("--isyntax-backend", dest="isyntax_backend", choices=ISYNTAX_BACKENDS, default='AUTO', help='PixelEngine render backend for every iSyntax job of the daemon')
+    parser.add_argument("--no-warm-up", dest="warm_up", action='store_false', help='Initialize the PixelEngine on the first iSyntax job instead of at startup')
+
+    args = parser.parse_args()
+    serve(args.host, args.port, args.warm_up, args.isyntax_backend)
+
+"""
+python wsi2dcm_daemon.py --port 8642
+python wsi2dcm_daemon.py --port 8642 --isyntax-backend SOFTWARE
+
+curl -X POST http://127.0.0.1:8642/jobs -d '{"source": "slide.isyntax", "output": "output_path", "mode": "single_file", "api": "iSyntax"}'
+curl -X POST http://127.0.0.1:8642/jobs -d '{"source": "source_path", "output": "output_path", "mode": "folder", "api": "Openslide", "options": {"output_format": "dicom+zarr"}}'
+curl http://127.0.0.1:8642/jobs/1/events
+"""
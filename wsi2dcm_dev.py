@@ -95,7 +95,7 @@ class iSyntax2Dcm(Singleton):
                     # print(file_info.convert_status)
                     file_info.output_folder = f"{raw_outputFolder}/{i}/"
                     os.makedirs(file_info.output_folder, exist_ok=True)
-                    imgs2dcm(tmp_folder, file_info, "png", print)
+                    imgs2dcm(tmp_folder, file_info, "png", print, level=i)
                     file_info.convert_status = f"Completed ({output_file}_{i})"
                     # print(file_info.convert_status)
 
@@ -1,17 +1,36 @@
 import os
-import glob
 import time
 import string
 import random
+import queue
+import threading
+from concurrent import futures
 
 from api.imgfile_info import imgfile_info
 from api.convert_api_type import convert_api_type
 from api.convert_mode_type import convert_mode_type
-from api.imgs2dcm import parse_tag_file, generate_random_string
+from api.imgs2dcm import parse_tag_file, generate_random_string, source_fingerprint, dataset_from_tag_file, encode_jpeg2000, ENCODER_SETTINGS
+from api.lease_queue import lease_queue, lease_lost, LEASE_TIMEOUT
+from api.frame_shards import split_rows, shard_writer, encode_band, merge_shards, remove_shards
+from api.folder_watcher import folder_watcher, SETTLE_SECONDS, POLL_INTERVAL
+from api.file_index import file_index
+from api.stow_sink import stow_sink, STOW_CONNECTIONS
+from api.sink_group import sink_group
+from api.slide_prefetch import slide_prefetcher
+from api.roi import parse_rois
+from api.level_selection import parse_levels
+from api.tile_ring import tile_ring
+from api.concurrency_budget import concurrency_budget, cpu_meter
+from api.throughput_store import save_throughput, read_key
+from api.conversion_plan import slide_plan, sample_positions, measure_samples, rates, frames_in_flight, print_plan, write_plan
+from pydicom.uid import generate_uid
 
 from iSyntax2Dcm import iSyntax2Dcm
 from Openslide2Dcm import Openslide2Dcm
 
+# Smallest --tile-size accepted: smaller frames only multiply the per-frame overhead
+MIN_TILE_SIZE = 16
+
 class wsi_converter:
 
     convert_mode: convert_mode_type = convert_mode_type.single_file
@@ -22,9 +41,45 @@ class wsi_converter:
     output_path: str = ''
     metadata_path: str = ''
     level: int = 4
-    tile_size: int = 10000
+    # "auto": frame size per level from the source's native tiling, otherwise a fixed frame size in pixels
+    tile_size: str = "auto"
+    isyntax_backend: str = "AUTO"
+    output_format: str = "dicom"
+    deterministic_uids: bool = False
+    # OpenSlide: threads reading tiles (one slide handle each) and the shared tile cache size in MiB
+    read_threads: int = 0
+    cache_mb: int = 256
+    # Shared folder (e.g. on the NAS) holding lease files; set to let several workers split file_list
+    worker_folder: str = ''
+    lease_timeout: int = LEASE_TIMEOUT
+    # With worker_folder: split each DICOM level into this many row bands converted by different workers
+    split_bands: int = 0
+    # Watch mode: seconds a new file's size must stay unchanged, rescan interval without inotify
+    settle_seconds: int = SETTLE_SECONDS
+    poll_interval: int = POLL_INTERVAL
+    # DICOMweb base URL to upload every converted instance to with STOW-RS, and concurrent uploads
+    stow_url: str = ''
+    stow_connections: int = STOW_CONNECTIONS
+    # DIMSE destinations (AE_TITLE@host:port) to C-STORE every converted instance to, and our AE title
+    cstore_destinations: list = []
+    calling_ae: str = "WSI2DCM"
+    # Read the next slide ahead while the current one converts, at most this many MiB (0: off)
+    prefetch_mb: int = 0
+    # "x0,y0,x1,y1" in level 0 pixels or a GeoJSON file: convert only the tiles covering these regions
+    roi: str = ''
+    # default, all, missing or a list such as 0,2,4-6 (see api.level_selection)
+    levels: str = "default"
+    # Encode frames in this many processes fed through a shared-memory tile ring (0: encode in this process, -1: encoder share of the budget)
+    encode_processes: int = 0
+    # Cores this process may use (0: all) and slides converted at the same time on this machine sharing them
+    cpu_budget: int = 0
+    concurrent_slides: int = 1
+    sink = None
+    ring = None
 
     file_list: list = []
+    # root folder -> file_index, filled by get_file_list
+    indexes: dict = {}
 
     def __init__(self) -> None:
         pass
@@ -43,6 +98,7 @@ class wsi_converter:
     
     def get_file_list(self):
         self.file_list.clear()
+        self.indexes = {}
         if os.path.exists(self.source_path) and os.path.exists(self.output_path):
             if self.convert_mode == convert_mode_type.single_file:
                 if os.path.isfile(self.source_path):
@@ -52,47 +108,386 @@ class wsi_converter:
                         self.file_list.append(file_info)
             elif self.convert_mode == convert_mode_type.folder:
                 if os.path.isdir(self.source_path):
-                    img_files = []
-                    for ext in self.convert_api.ext_name:
-                        img_files.extend(glob.glob(os.path.join(self.source_path, "**", ext), recursive=True))
-                    for file_path in img_files:
-                        filename, extension = os.path.splitext(os.path.basename(file_path))
-                        file_info = imgfile_info(file_path, "", f"{self.output_path}/{filename}", f"{filename}.dcm")
-                        self.file_list.append(file_info)
+                    for file_path in self.file_index(self.source_path).match(self.convert_api.ext_name):
+                        self.file_list.append(self.make_file_info(file_path))
             elif self.convert_mode == convert_mode_type.metadata:
                 if os.path.isdir(self.metadata_path) and os.path.isdir(self.source_path):
-                    metadata_files = glob.glob(os.path.join(self.metadata_path, "**", '*.txt'), recursive=True)
-                    img_files = []
-                    for ext in self.convert_api.ext_name:
-                        img_files.extend(glob.glob(os.path.join(self.source_path, "**", ext), recursive=True))
+                    metadata_files = self.file_index(self.metadata_path).match(['*.txt'])
+                    img_files = self.file_index(self.source_path).match(self.convert_api.ext_name)
                     for metafile_path in metadata_files:
                         metadata_tags = parse_tag_file(metafile_path)
                         container_id = metadata_tags["Container Identifier"]
-                        for file_path in img_files:
-                            if file_path.find(container_id) != -1:
-                                filename, extension = os.path.splitext(os.path.basename(file_path))
-                                file_info = imgfile_info(file_path, metafile_path, f"{self.output_path}/{filename}", f"{filename}.dcm")
-                                self.file_list.append(file_info)
+                        for file_path in img_files.containing(container_id):
+                            self.file_list.append(self.make_file_info(file_path, metafile_path))
         return self.file_list
 
+    def file_index(self, root):
+        """
+        Index of every file below root from a single parallel walk; a folder inside an already
+        scanned tree (e.g. metadata stored under the source folder) is served from that walk
+        """
+        root = os.path.normpath(root)
+        for scanned_root, index in self.indexes.items():
+            if root == scanned_root or root.startswith(scanned_root + os.sep):
+                return file_index([path for path in index if path.startswith(root + os.sep)])
+        index = file_index.scan(root)
+        self.indexes[root] = index
+        return index
+
+    def make_file_info(self, file_path, metadata_file=""):
+        filename, extension = os.path.splitext(os.path.basename(file_path))
+        return imgfile_info(file_path, metadata_file, f"{self.output_path}/{filename}", f"{filename}.dcm")
+
+    def watch(self):
+        """
+        Convert every slide in source_path, then keep watching it and convert each new slide
+        as soon as its size has been stable for settle_seconds. Runs until interrupted.
+        """
+        if not os.path.isdir(self.source_path):
+            print("Source path must be a folder to watch")
+            return
+        watcher = folder_watcher(self.source_path, self.convert_api.ext_name, self.settle_seconds, self.poll_interval)
+        jobs = queue.Queue()
+        stopping = threading.Event()
+
+        def convert_jobs():
+            while True:
+                file_info = jobs.get()
+                # None: stop; slides still queued when stopping are left for the next run
+                if file_info is None or stopping.is_set():
+                    return
+                self.convert_file(file_info)
+                print(f"{jobs.qsize()} file(s) waiting")
+
+        self.open_sink()
+        self.open_ring()
+        job_thread = threading.Thread(target=convert_jobs, name="convert", daemon=True)
+        job_thread.start()
+        try:
+            for file_path in watcher.watch():
+                print(f"New file ready: {file_path}")
+                jobs.put(self.make_file_info(file_path))
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        finally:
+            watcher.close()
+            # The ring and the sink are still used by the slide being converted: finish it first
+            stopping.set()
+            jobs.put(None)
+            if job_thread.is_alive():
+                print("Waiting for the current slide to finish")
+            job_thread.join()
+            self.close_ring()
+            self.close_sink()
+
+    def open_sink(self):
+        sinks = []
+        if self.stow_url:
+            sinks.append(stow_sink(self.stow_url, self.stow_connections))
+        if self.cstore_destinations:
+            # pynetdicom is only imported when C-STORE output is requested
+            from api.cstore_sink import cstore_sink
+            sinks.append(cstore_sink(self.cstore_destinations, self.calling_ae))
+        self.sink = sink_group(sinks) if sinks else None
+
+    def close_sink(self):
+        """
+        Wait for the remaining uploads
+        """
+        if self.sink is None:
+            return
+        failed = self.sink.close()
+        self.sink = None
+        if failed:
+            print(f"{len(failed)} upload(s) failed:")
+            for path, error in failed:
+                print(f"  {path}: {error}")
+
+    def budget(self):
+        return concurrency_budget(self.cpu_budget, self.concurrent_slides)
+
+    def stages(self):
+        """
+        Threads per stage when a CPU budget was asked for (--cpu-budget, --concurrent-slides or --encode-processes),
+        otherwise None and every stage keeps its own default pool size
+        """
+        if self.cpu_budget <= 0 and self.concurrent_slides <= 1 and self.encode_processes == 0:
+            return None
+        # Without encoder processes or --split-bands threads the frames are encoded in the converting thread
+        return self.budget().stages(encoder_in_process=self.encode_processes == 0 and self.split_bands <= 0)
+
+    def open_ring(self):
+        # The encoder processes are started once and kept for every level and slide
+        stages = self.stages()
+        if stages is None:
+            self.ring = None
+            return
+        budget = self.budget()
+        print(f"Concurrency budget: {budget.slide_cores()} core(s) per slide ({budget.cores} for {budget.concurrent_slides} slide(s)): {stages}")
+        budget.configure_libraries()
+        processes = stages.encoder if self.encode_processes < 0 else self.encode_processes
+        self.ring = tile_ring(encode_jpeg2000, processes) if processes > 0 else None
+
+    def close_ring(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
     def convert(self):
+        self.open_sink()
+        self.open_ring()
+        try:
+            if self.worker_folder and self.split_bands > 0:
+                self.convert_in_bands()
+            elif self.worker_folder:
+                self.convert_as_worker()
+            elif self.prefetch_mb > 0:
+                self.convert_pipelined()
+            else:
+                for file_info in self.file_list:
+                    self.convert_file(file_info)
+        finally:
+            self.close_ring()
+            self.close_sink()
+
+    def convert_pipelined(self):
+        """
+        Convert file_list in order while the next slide is read ahead (metadata, fingerprint and
+        the first frames of its first converted level, at most prefetch_mb) during the conversion of the current one
+        """
+        # OpenSlide opens the next slide with its own handle; the PixelEngine input is busy with the current one
+        read_frames = getattr(self.get_converter(), "prefetch_frames", None)
+        prefetcher = slide_prefetcher(self.prefetch_mb * 1024 * 1024, read_frames)
+        try:
+            for index, file_info in enumerate(self.file_list):
+                # The first slide is not read ahead of itself, it is submitted after the previous one otherwise
+                prefetched = prefetcher.take(file_info)
+                if index + 1 < len(self.file_list):
+                    prefetcher.submit(self.file_list[index + 1], self.deterministic_uids)
+                self.convert_file(file_info, prefetched)
+        finally:
+            prefetcher.close()
+
+    def convert_as_worker(self):
+        """
+        Claim slides from file_list through lease files in worker_folder, so any number of
+        workers on different nodes can run the same command against the same source/output.
+        Leases are kept alive by heartbeats; a stalled worker's slides are re-queued after lease_timeout.
+        """
+        queue = lease_queue(self.worker_folder, self.lease_timeout)
+        files = {self.lease_name(file_info): file_info for file_info in self.file_list}
+        print(f"Worker {queue.worker}: {len(files)} file(s) in queue {self.worker_folder}")
+        for name, lease in queue.claim(files):
+            # A lost lease stops the conversion before the next DICOM file is written
+            files[name].stop_event = lease.lost
+            if self.convert_file(files[name]):
+                lease.finish("done")
+            else:
+                lease.finish("failed", files[name].convert_status)
+
+    def get_converter(self):
+        """
+        The converter singleton of convert_api, configured from this converter's settings
+        """
+        stages = self.stages()
+        if self.convert_api == convert_api_type.iSyntax:
+            iSyntax2Dcm.render_backend = self.isyntax_backend
+            converter = iSyntax2Dcm()._instance
+            if self.tile_size != "auto":
+                converter.tile_size = [int(self.tile_size), int(self.tile_size)]
+        elif self.convert_api == convert_api_type.Openslide:
+            converter = Openslide2Dcm()._instance
+            if self.tile_size != "auto":
+                converter.tileSize = int(self.tile_size)
+            if self.read_threads > 0:
+                converter.read_threads = self.read_threads
+            else:
+                converter.read_threads = stages.reader if stages is not None else Openslide2Dcm.read_threads
+            converter.cache_size = self.cache_mb * 1024 * 1024
+        converter.auto_tile_size = self.tile_size == "auto"
+        # 0: the writer pools size themselves to the CPU count
+        converter.write_threads = stages.writer if stages is not None else 0
+        # "dicom+zarr" writes the OME-Zarr from the same frames while converting to DICOM
+        converter.zarr_output = self.output_format == "dicom+zarr"
+        converter.dicom_sink = self.sink
+        converter.tile_ring = self.ring
+        converter.rois = parse_rois(self.roi)
+        converter.levels = parse_levels(self.levels)
+        return converter
+
+    def convert_in_bands(self):
+        """
+        Split every DICOM level into split_bands row bands, converted by all workers sharing worker_folder.
+        Each band is encoded into a shard under {worker_folder}/shards; once all bands of a level are done,
+        one worker merges the shards into the level's DICOM file by copying bytes.
+        """
+        queue = lease_queue(self.worker_folder, self.lease_timeout)
+        converter = self.get_converter()
+
+        levels = []
         for file_info in self.file_list:
-            start_time = time.time()  # Record start time for each image
+            name = self.lease_name(file_info)
+            # All workers must build the header of a slide from the same UID seed
+            seed = source_fingerprint(file_info.input_file) if self.deterministic_uids else generate_uid()
+            file_info.uid_seed = queue.shared_value(f"{name}#seed", seed)
+            file_info.deterministic_uids = self.deterministic_uids
+            for level, tile_size, rows, columns in converter.band_levels(file_info):
+                shard_folder = os.path.join(self.worker_folder, "shards", queue.key(name), str(level))
+                bands = {f"{name}#level{level}#rows{start}-{end}": (start, end) for start, end in split_rows(rows, self.split_bands)}
+                levels.append((file_info, name, level, tile_size, rows, columns, shard_folder, bands))
+        print(f"Worker {queue.worker}: {len(levels)} level(s) split into bands in {self.worker_folder}")
+
+        stages = self.stages()
+        encoder_threads = stages.encoder if stages is not None else None
+        band_jobs = {band: (entry, rows) for entry in levels for band, rows in entry[7].items()}
+        for band, lease in queue.claim(band_jobs):
+            (file_info, name, level, tile_size, rows, columns, shard_folder, _), (start, end) = band_jobs[band]
+            print(f"Encoding {band}")
+            try:
+                writer = shard_writer(os.path.join(shard_folder, f"rows_{start}_{end}"), start, end, columns)
+                # lease.guard stops encoding before the shard index is written once the lease is lost
+                encode_band(lease.guard(converter.level_band_frames(file_info, level, tile_size, start, end)), writer, encode_jpeg2000,
+                            ENCODER_SETTINGS, encoder_threads, self.ring)
+                lease.finish("done")
+            except Exception as e:
+                print(f"Error during band conversion: {e}, {band}")
+                lease.finish("failed", str(e))
+
+        merge_jobs = {f"{entry[1]}#level{entry[2]}#merge": entry for entry in levels}
+        for merge, lease in queue.claim(merge_jobs):
+            file_info, name, level, tile_size, rows, columns, shard_folder, bands = merge_jobs[merge]
+            shard_paths = [os.path.join(shard_folder, f"rows_{start}_{end}") for start, end in bands.values()]
+            output_file = os.path.join(file_info.output_folder, str(level), file_info.output_filename)
+            try:
+                ds = dataset_from_tag_file(file_info.metadata_file, level, file_info.uid_seed, deterministic=file_info.deterministic_uids,
+                                           frame_size=tile_size)
+                ds.Rows = tile_size[1]
+                ds.Columns = tile_size[0]
+                ds.TotalPixelMatrixRows = rows * tile_size[1]
+                ds.TotalPixelMatrixColumns = columns * tile_size[0]
+                if lease.lost.is_set():
+                    raise lease_lost(f"Lease lost: {merge}")
+                merge_shards(shard_paths, ds, output_file, rows)
+                remove_shards(shard_paths)
+                if self.sink is not None:
+                    self.sink.submit(output_file)
+                print(f"Merged {len(shard_paths)} band(s) into {output_file}")
+                lease.finish("done")
+            except Exception as e:
+                print(f"Error during shard merge: {e}, {output_file}")
+                lease.finish("failed", str(e))
+
+    def lease_name(self, file_info):
+        # Relative to the source folder so that nodes mounting the share at different paths agree
+        if os.path.isdir(self.source_path):
+            return os.path.relpath(file_info.input_file, self.source_path)
+        return os.path.basename(file_info.input_file)
+
+    def convert_file(self, file_info, prefetched=None) -> bool:
+        """
+        Convert one file, returns False when the conversion raised
+        prefetched: prefetched_slide of this file, if it was read ahead
+        """
+        succeeded = True
+        start_time = time.time()  # Record start time for each image
+        # the encoder processes are counted with this process
+        meter = cpu_meter(self.budget().slide_cores(), [worker.pid for worker in self.ring.workers] if self.ring is not None else [])
+        try:
+            # print(f"Processing file: {file_info.input_file}")
+            # Same source content -> same Study/Series/SOP Instance UIDs on every re-run
+            if prefetched is not None and prefetched.fingerprint:
+                file_info.uid_seed = prefetched.fingerprint
+            else:
+                file_info.uid_seed = source_fingerprint(file_info.input_file) if self.deterministic_uids else ""
+            file_info.deterministic_uids = self.deterministic_uids
+            converter = self.get_converter()
+            if self.output_format in ("tiff", "zarr"):
+                converter.convert_pyramid(file_info, self.output_format)
+            else:
+                converter.convert(file_info, self.tmp_folder + "/" + generate_random_string(8))
+            # The converters catch their own errors and report them through convert_status
+            succeeded = not file_info.convert_status.startswith("Error")
+            print(f"File processing completed")
+        except Exception as e:
+            succeeded = False
+            file_info.convert_status = f"Error during file conversion: {e}"
+            print(f"Error during file conversion: {e}, File path: {file_info.input_file}")
+
+        end_time = time.time()  # Record end time for each image
+        time_taken = end_time - start_time  # Calculate time difference for each image
+        print(f"started at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time))}")
+        print(f"ended at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time))}")
+        print(f"Time taken: {time_taken:.2f} seconds")
+        busy, utilization = meter.report()
+        print(f"CPU: {busy:.1f} of {meter.cores} budgeted core(s) busy ({utilization:.0%})")
+        print("================================================")
+        return succeeded
+
+    def plan(self, max_workers=8):
+        """
+        Estimate frames, output size, peak RAM and time of converting file_list without converting.
+        Level grids come from the slide headers; a few frames of the largest level are read and encoded
+        for the compression ratio. Slides are probed in parallel (iSyntax one at a time: the PixelEngine has one input).
+        The estimates are printed and written to {output_path}/plan.json.
+        """
+        converter = self.get_converter()
+        api = "iSyntax" if self.convert_api == convert_api_type.iSyntax else "Openslide"
+        # AUTO is stored under the backend it resolved to, as --benchmark-backends does
+        backend = (converter.backend_name or self.isyntax_backend) if self.convert_api == convert_api_type.iSyntax else f"{converter.read_threads}threads"
+        cache_bytes = 0 if self.convert_api == convert_api_type.iSyntax else converter.cache_size
+        in_flight = frames_in_flight(getattr(converter, "read_threads", 0))
+        engine_lock = threading.Lock() if self.convert_api == convert_api_type.iSyntax else None
+
+        def probe(file_info):
             try:
-                # print(f"Processing file: {file_info.input_file}")
-                if self.convert_api == convert_api_type.iSyntax:
-                    iSyntax2Dcm()._instance.convert(file_info, self.tmp_folder + "/" + generate_random_string(8))
-                elif self.convert_api == convert_api_type.Openslide:
-                    Openslide2Dcm()._instance.convert(file_info, self.tmp_folder + "/" + generate_random_string(8))
-                print(f"File processing completed")
+                if engine_lock is not None:
+                    engine_lock.acquire()
+                try:
+                    plan = slide_plan(file_info.input_file, converter.band_levels(file_info))
+                    if not plan.levels:
+                        plan.error = "No level to convert"
+                        return plan
+                    level, tile_size, rows, columns = max(plan.levels, key=lambda layout: layout[2] * layout[3])
+                    frames = converter.level_sample_frames(file_info, level, tile_size, sample_positions(rows, columns))
+                    measured = measure_samples(frames, encode_jpeg2000)
+                finally:
+                    if engine_lock is not None:
+                        engine_lock.release()
+                if measured is None:
+                    plan.error = "No frame could be sampled"
+                    return plan
+                read_seconds, encode_seconds = rates(api, backend, tile_size, measured)
+                plan.estimate(measured[0], read_seconds, encode_seconds, in_flight, cache_bytes)
             except Exception as e:
-                print(f"Error during file conversion: {e}, File path: {file_info.input_file}")
+                plan = slide_plan(file_info.input_file, [])
+                plan.error = f"Error: {e}"
+            return plan
 
-            end_time = time.time()  # Record end time for each image
-            time_taken = end_time - start_time  # Calculate time difference for each image
-            print(f"started at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time))}")
-            print(f"ended at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time))}")
-            print(f"Time taken: {time_taken:.2f} seconds")
+        with futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plan") as executor:
+            plans = list(executor.map(probe, self.file_list))
+
+        print_plan(plans)
+        os.makedirs(self.output_path, exist_ok=True)
+        plan_file = os.path.join(self.output_path, "plan.json")
+        write_plan(plan_file, plans)
+        print(f"Plan written to {plan_file}")
+        return plans
+
+    def benchmark_backends(self, max_regions=200):
+        """
+        Time regions/second of every iSyntax render backend on each file instead of converting
+        """
+        from api.iSyntax.sdk.backends import Backends
+        from api.iSyntax.sdk.backend_benchmark import benchmark_backends
+
+        # one Backends for all files
+        backends = Backends()
+        for file_info in self.file_list:
+            print(f"Benchmarking render backends: {file_info.input_file}")
+            results = benchmark_backends(file_info.input_file, 1, iSyntax2Dcm.tile_size, max_regions, backends=backends)
+            # kept for --plan time estimates, in pixels per second so any frame size can use them
+            for name, regions_per_second in results.items():
+                save_throughput(read_key("iSyntax", name), regions_per_second * iSyntax2Dcm.tile_size[0] * iSyntax2Dcm.tile_size[1])
             print("================================================")
 
     def reset(self):